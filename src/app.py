@@ -6,19 +6,37 @@ import os
 import time
 import signal
 import json
+import multiprocessing
 import uuid
 
 import click
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 from tornado_json.application import Application
 from tornado.log import enable_pretty_logging
 from tornado_json.routes import get_routes
 from pony.orm import db_session
 
 import wlsports.api
+import wlsports.api.events
+import wlsports.api.metrics
 import wlsports.db
-from wlsports.config import Config
+import wlsports.generations
+import wlsports.invitations
+import wlsports.migrations
+import wlsports.search
+import wlsports.sessions
+import wlsports.sqlstats
+from wlsports.cache import ResponseCache
+from wlsports.config import Config, SQLITE_PROFILES
+from wlsports.dal import DataLayer
+from wlsports.events import EventBus
+from wlsports.hashing import PasswordHasher
+from wlsports.matchqueue import MatchQueue
+from wlsports.metrics import LagMonitor, Metrics
+from wlsports.sessions import SessionStore
+from wlsports.process import fork_workers
 
 
 def sig_handler(sig, frame):
@@ -33,6 +51,8 @@ def shutdown():
 
     logging.info('Stopping http server')
     http_server.stop()
+    application.settings['password_hasher'].shutdown()
+    application.settings['data_layer'].shutdown()
 
     logging.info('Will shutdown in %s seconds ...',
                  MAX_WAIT_SECONDS_BEFORE_SHUTDOWN)
@@ -51,6 +71,61 @@ def shutdown():
     stop_loop()
 
 
+def make_application(app_config):
+    """Create the application, and everything its handlers expect in its
+    settings, from ``app_config``; the database must be bound already
+    """
+    # bcrypt runs on its own process pool, off the IOLoop
+    password_hasher = PasswordHasher(workers=app_config.hash_workers)
+    # ... and database work on thread pools, also off the IOLoop
+    data_layer = DataLayer(
+        read_threads=app_config.db_read_threads,
+        write_threads=app_config.db_write_threads,
+        max_pending=app_config.db_max_pending,
+        group_commit=app_config.db_group_commit,
+        group_commit_window=app_config.db_group_commit_window / 1000.0
+    )
+    response_cache = ResponseCache(max_entries=app_config.response_cache_size)
+    session_store = SessionStore(max_entries=app_config.session_cache_size)
+    event_bus = EventBus()
+    match_queue = MatchQueue(data_layer, event_bus,
+                             interval=app_config.matchmaking_interval)
+    metrics = Metrics(
+        password_hasher=password_hasher,
+        data_layer=data_layer,
+        response_cache=response_cache,
+        session_store=session_store,
+        event_bus=event_bus,
+        match_queue=match_queue
+    )
+
+    settings = dict(
+        template_path=os.path.join(
+            os.path.dirname(__file__), "templates"),
+        static_path=os.path.join(os.path.dirname(__file__), "static"),
+        gzip=True,
+        cookie_secret=app_config.cookie_secret,
+        app_config=app_config,
+        password_hasher=password_hasher,
+        data_layer=data_layer,
+        response_cache=response_cache,
+        session_store=session_store,
+        event_bus=event_bus,
+        match_queue=match_queue,
+        metrics=metrics,
+        login_url="/api/auth/playerlogin"
+    )
+
+    return Application(
+        routes=get_routes(wlsports.api) + [
+            (wlsports.api.events.SOCKET_URL, wlsports.api.events.Socket),
+            (wlsports.api.metrics.URL, wlsports.api.metrics.Metrics)
+        ],
+        settings=settings,
+        db_conn=wlsports.db,
+    )
+
+
 @click.command()
 @click.option('-p', '--port', default=8888, type=int, required=True,
               help="Port to start server on")
@@ -64,69 +139,173 @@ def shutdown():
               help=("Set this to an empty string to generate a new cookie secret "
                     "each time the server is restarted, or to any string which is "
                     "the cookie secret."))
+@click.option('--workers', default=1, type=int,
+              help=("Number of server processes sharing the port; "
+                    "0 uses one per CPU."))
+@click.option('--hash-workers', default=0, type=int,
+              help=("Number of processes used for password hashing, per "
+                    "server process; 0 splits the CPUs between server "
+                    "processes."))
+@click.option('--sqlite-profile', default="durable",
+              type=click.Choice(sorted(SQLITE_PROFILES)),
+              help=("Set of SQLite settings to start from; the --sqlite-* "
+                    "options below override single settings of it. "
+                    "durable fsyncs every commit; wal is faster, but a "
+                    "power failure can lose the last commits."))
+@click.option('--sqlite-journal-mode', default=None,
+              type=click.Choice(["DELETE", "TRUNCATE", "PERSIST", "MEMORY",
+                                 "WAL", "OFF"]))
+@click.option('--sqlite-synchronous', default=None,
+              type=click.Choice(["OFF", "NORMAL", "FULL", "EXTRA"]))
+@click.option('--sqlite-mmap-size', default=None, type=int,
+              help="Bytes of the database file to memory-map")
+@click.option('--sqlite-cache-size', default=None, type=int,
+              help="Page cache size; negative values are in KiB")
+@click.option('--sqlite-busy-timeout', default=None, type=int,
+              help="Milliseconds to wait for a locked database")
+@click.option('--sqlite-temp-store', default=None,
+              type=click.Choice(["DEFAULT", "FILE", "MEMORY"]))
+@click.option('--db-read-threads', default=4, type=int,
+              help="Threads running database reads, per server process")
+@click.option('--db-write-threads', default=1, type=int,
+              help="Threads running database writes, per server process")
+@click.option('--db-max-pending', default=256, type=int,
+              help=("Database reads (and, separately, writes) that may be "
+                    "queued before requests are turned away with a 503"))
+@click.option('--db-group-commit', default=0, type=int,
+              help=("Most short writes (e.g., accepting invitations) of "
+                    "concurrent requests committed together in one "
+                    "transaction; 0 commits each on its own"))
+@click.option('--db-group-commit-window', default=2.0, type=float,
+              help=("Milliseconds a short write may wait for others to "
+                    "share its commit with, with --db-group-commit"))
+@click.option('--response-cache-size', default=1024, type=int,
+              help=("Number of game and team responses kept in memory, "
+                    "per server process"))
+@click.option('--admin', 'admins', multiple=True,
+              help=("Username of a player allowed to use admin endpoints, "
+                    "e.g., the bulk import; may be given several times"))
+@click.option('--n-plus-one-threshold', default=10, type=int,
+              help=("Log a warning for requests running the same SELECT at "
+                    "least this many times; 0 disables the check"))
+@click.option('--output-validation-rate', default=1.0, type=float,
+              help=("Share of responses checked against their output "
+                    "schema, from 0 (none; input is still validated) to 1 "
+                    "(all)"))
+@click.option('--session-cache-size', default=10000, type=int,
+              help=("Number of logged in sessions kept in memory, per "
+                    "server process"))
+@click.option('--matchmaking-interval', default=1.0, type=float,
+              help=("Seconds teams queued for matchmaking wait for others "
+                    "to be matched along with"))
 @click.option('--debug', is_flag=True)
-def main(port, db, session_timeout_days, cookie_secret, debug):
+def main(port, db, session_timeout_days, cookie_secret, workers,
+         hash_workers, sqlite_profile, sqlite_journal_mode,
+         sqlite_synchronous, sqlite_mmap_size, sqlite_cache_size,
+         sqlite_busy_timeout, sqlite_temp_store, db_read_threads,
+         db_write_threads, db_max_pending, db_group_commit,
+         db_group_commit_window, response_cache_size, admins,
+         n_plus_one_threshold, output_validation_rate, session_cache_size,
+         matchmaking_interval, debug):
     """
     - Get options from config file
     - Gather all routes
     - Create the server
     - Start the server
     """
-    global http_server
+    global http_server, application
 
     enable_pretty_logging()
 
+    workers = workers or multiprocessing.cpu_count()
+    hash_workers = hash_workers or max(
+        multiprocessing.cpu_count() // workers, 1)
+    # All workers must sign cookies with the same secret
+    cookie_secret = cookie_secret or uuid.uuid4().hex
+    sqlite = SQLITE_PROFILES[sqlite_profile]._replace(**{
+        k: v for k, v in dict(
+            journal_mode=sqlite_journal_mode,
+            synchronous=sqlite_synchronous,
+            mmap_size=sqlite_mmap_size,
+            cache_size=sqlite_cache_size,
+            busy_timeout=sqlite_busy_timeout,
+            temp_store=sqlite_temp_store,
+        ).items() if v is not None
+    })
+
     # Create application configuration
     app_config = Config(
         port=port,
         db_file=db,
         session_timeout_days=session_timeout_days,
         cookie_secret=cookie_secret,
-        debug=debug
+        debug=debug,
+        workers=workers,
+        hash_workers=hash_workers,
+        sqlite=sqlite,
+        db_read_threads=db_read_threads,
+        db_write_threads=db_write_threads,
+        db_max_pending=db_max_pending,
+        response_cache_size=response_cache_size,
+        admins=frozenset(admins),
+        n_plus_one_threshold=n_plus_one_threshold,
+        output_validation_rate=output_validation_rate,
+        session_cache_size=session_cache_size,
+        db_group_commit=db_group_commit,
+        db_group_commit_window=db_group_commit_window,
+        matchmaking_interval=matchmaking_interval
     )
     # Configure and initialize database
     if debug:
         wlsports.db.sql_debug(True)
+    wlsports.db.use_sqlite_profile(sqlite)
+    wlsports.sqlstats.install(wlsports.db.database)
     wlsports.db.database.bind("sqlite", db, create_db=True)
     wlsports.db.database.generate_mapping(create_tables=True)
+    for migration in wlsports.migrations.migrate():
+        logging.info("Applied migration %d: %s", migration.version,
+                     migration.description)
+    with db_session:
+        if wlsports.migrations.current_version() > \
+                wlsports.migrations.LATEST:
+            logging.warning("The database has migrations this version "
+                            "doesn't know about; is it out of date?")
     # Create sports if they don't exist
     with db_session:
-        for name, players_per_team in [
-            ("Basketball", 5),
-            ("Soccer", 11)
-        ]:
-            if not wlsports.db.Sport.get(name=name):
-                wlsports.db.Sport(
-                    name=name,
-                    players_per_team=players_per_team
-                )
+        wlsports.db.create_sports()
+        wlsports.invitations.sync()
+        wlsports.sessions.purge_expired()
+        if not wlsports.search.setup():
+            logging.warning("SQLite has no FTS5; player search will only "
+                            "match username prefixes")
 
-    settings = dict(
-        template_path=os.path.join(
-            os.path.dirname(__file__), "templates"),
-        static_path=os.path.join(os.path.dirname(__file__), "static"),
-        gzip=True,
-        cookie_secret=(cookie_secret if cookie_secret
-                       else uuid.uuid4().hex),
-        app_config=app_config,
-        login_url="/api/auth/playerlogin"
-    )
+    # Bind to port
+    sockets = tornado.netutil.bind_sockets(port)
+
+    if workers > 1:
+        # Each worker opens its own database connections after the fork
+        wlsports.db.database.disconnect()
+        wlsports.generations.enable_sharing()
+        worker_id = fork_workers(workers)
+        logging.info("Worker %d started (pid %d)", worker_id, os.getpid())
 
     # Create server
-    http_server = tornado.httpserver.HTTPServer(
-        Application(
-            routes=get_routes(wlsports.api),
-            settings=settings,
-            db_conn=wlsports.db,
-        )
-    )
-    # Bind to port
-    http_server.listen(port)
+    application = make_application(app_config)
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.add_sockets(sockets)
 
     # Register signal handlers for quitting
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
+    LagMonitor(application.settings['metrics'].ioloop_lag).start()
+    # Expired sessions are otherwise only purged above, at startup
+    tornado.ioloop.PeriodicCallback(
+        lambda: application.settings['data_layer'].write(
+            wlsports.sessions.purge_expired),
+        wlsports.sessions.PURGE_INTERVAL * 1000
+    ).start()
+
     # Start IO loop
     tornado.ioloop.IOLoop.instance().start()
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""Accepted invitations per second with and without group commit
+
+Run from src/:
+
+    python -m benchmarks.group_commit --profiles durable,wal \
+        --group-commit 0,8,32 --accepts 2000 --concurrency 64
+
+For every SQLite profile and ``--db-group-commit`` setting, a league is
+generated with benchmarks.league into a fresh database and served
+in-process (see benchmarks.load), and ``--accepts`` open invitations
+are accepted through ``POST /api/game/inviterespond``, ``--concurrency``
+at a time, by players logged in beforehand. Every run gets its own
+process, as a Pony database can only be bound once per process.
+
+Group commit pays off most where commits are expensive, i.e., with the
+durable profile, which syncs every commit to disk.
+"""
+from __future__ import division, print_function
+
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import click
+import tornado.httpserver
+import tornado.netutil
+from pony.orm import db_session, select
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+import wlsports.db
+from app import make_application
+from benchmarks.league import generate_league
+from benchmarks.load import make_config
+from benchmarks.storage import percentile
+from wlsports import sessions
+from wlsports.config import SQLITE_PROFILES
+from wlsports.db import Invitation
+
+
+@gen.coroutine
+def accept_all(base_url, plan, concurrency):
+    """Accept the invitations of ``plan``, ``concurrency`` at a time
+
+    :param plan: [(cookie, game ID), ...]
+    :returns: (seconds taken, latencies in milliseconds, errors)
+    """
+    http_client = AsyncHTTPClient(force_instance=True,
+                                  max_clients=concurrency)
+    latencies = []
+    errors = [0]
+    queue = iter(plan)
+
+    @gen.coroutine
+    def worker():
+        for cookie, game_id in queue:
+            started = time.time()
+            response = yield http_client.fetch(
+                base_url + "/api/game/inviterespond", method="POST",
+                headers={"Cookie": cookie},
+                body=json.dumps({"id": game_id, "decision": "Accept"}),
+                raise_error=False
+            )
+            latencies.append((time.time() - started) * 1000)
+            if response.code >= 400:
+                errors[0] += 1
+
+    started = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - started
+    http_client.close()
+    raise gen.Return((elapsed, latencies, errors[0]))
+
+
+def run(profile, group_commit, window, num_players, num_accepts,
+        concurrency, seed, results):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmpdir, "bench.sqlite")
+        wlsports.db.use_sqlite_profile(SQLITE_PROFILES[profile])
+        wlsports.db.database.bind("sqlite", db_file, create_db=True)
+        wlsports.db.database.generate_mapping(create_tables=True)
+        generate_league(num_players, max(num_players // 10, 2),
+                        games_per_team=1, open_games_per_team=3, seed=seed)
+
+        rng = random.Random(seed)
+        with db_session:
+            invitations = sorted(select(
+                (i.player.username, i.game.id) for i in Invitation))
+            rng.shuffle(invitations)
+            invitations = invitations[:num_accepts]
+            cookies = {
+                username: "{}={}".format(
+                    sessions.COOKIE_NAME, sessions.create(username, 1)[0])
+                for username in {username for username, _ in invitations}
+            }
+        plan = [(cookies[username], game_id)
+                for username, game_id in invitations]
+
+        application = make_application(make_config(db_file, profile)._replace(
+            db_group_commit=group_commit, db_group_commit_window=window))
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        base_url = "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.add_sockets(sockets)
+        try:
+            elapsed, latencies, errors = IOLoop.current().run_sync(
+                lambda: accept_all(base_url, plan, concurrency))
+        finally:
+            http_server.stop()
+            application.settings['password_hasher'].shutdown()
+            application.settings['data_layer'].shutdown()
+
+        data_layer = application.settings['data_layer']
+        if data_layer.group_commit is not None:
+            stats = data_layer.group_commit.stats()
+            per_commit = stats["units"] / max(stats["batches"], 1)
+        else:
+            per_commit = 1.0
+        results[(profile, group_commit)] = {
+            "accepts": len(plan),
+            "rps": len(plan) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "errors": errors,
+            "per_commit": per_commit,
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@click.command()
+@click.option('--profiles', default="durable,wal",
+              help="Comma-separated SQLite profiles")
+@click.option('--group-commit', 'group_commits', default="0,32",
+              help="Comma-separated --db-group-commit settings; 0 is off")
+@click.option('--window', default=2.0,
+              help="--db-group-commit-window, in milliseconds")
+@click.option('--players', default=2000, help="Number of players")
+@click.option('--accepts', default=2000,
+              help="Invitations to accept per run")
+@click.option('--concurrency', default=64,
+              help="Requests in flight at a time")
+@click.option('--seed', default=0)
+def main(profiles, group_commits, window, players, accepts, concurrency,
+         seed):
+    results = multiprocessing.Manager().dict()
+    print("{:>8} {:>6} {:>9} {:>10} {:>10} {:>7} {:>12}".format(
+        "profile", "group", "accepts/s", "p50 (ms)", "p95 (ms)", "errors",
+        "writes/commit"))
+    for profile in profiles.split(","):
+        for group_commit in [int(g) for g in group_commits.split(",")]:
+            process = multiprocessing.Process(target=run, args=(
+                profile, group_commit, window, players, accepts,
+                concurrency, seed, results))
+            process.start()
+            process.join()
+            result = results.get((profile, group_commit))
+            if result is None:
+                print("{:>8} {:>6} failed".format(profile, group_commit))
+                continue
+            print("{:>8} {:>6} {:>9.0f} {:>10.1f} {:>10.1f} {:>7} "
+                  "{:>12.1f}".format(
+                      profile, group_commit or "off", result["rps"],
+                      result["p50"], result["p95"], result["errors"],
+                      result["per_commit"]))
+
+
+if __name__ == '__main__':
+    main()
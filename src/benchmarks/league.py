@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""Synthetic league generator
+
+Run from src/ to create a database to try the server against:
+
+    python -m benchmarks.league --db /tmp/league.sqlite --players 10000
+
+or use ``generate_league`` from other benchmarks (see benchmarks.load).
+Rows are written straight through the Pony entities in wlsports.db, in
+batched transactions. Every player's password is ``PASSWORD``; they
+all share one real bcrypt hash, so logging in costs what it does in
+production without generating the league taking hours.
+"""
+from __future__ import print_function
+
+import json
+import random
+import timeit
+
+import bcrypt
+import click
+from pony.orm import db_session, select
+
+import wlsports.db
+import wlsports.invitations
+import wlsports.search
+from wlsports import scores
+from wlsports.db import Game, Player, Sport, Team
+from wlsports.results import record_result
+
+PASSWORD = "password"
+CITIES = ["Vancouver", "Burnaby", "Richmond", "Surrey", "Toronto",
+          "Montreal", "Calgary", "Seattle"]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley",
+               "Jamie", "Avery", "Quinn", "Robin", "Drew"]
+LAST_NAMES = ["Smith", "Lee", "Wong", "Singh", "Brown", "Martin", "Roy",
+              "Tremblay", "Gagnon", "Chen", "Patel", "Nguyen"]
+BATCH_SIZE = 1000
+
+
+def generate_league(num_players, teams_per_sport, games_per_team=5,
+                    open_games_per_team=1, seed=0):
+    """Fill the bound database with a league
+
+    Players are ``p0`` to ``p<num_players - 1>``; teams of each sport are
+    ``<sport>0``, ``<sport>1``, ... and have the sport's number of
+    players, drawn at random. Each team plays about ``games_per_team``
+    finished games against teams of its sport and hosts
+    ``open_games_per_team`` games that are still open, with invitations.
+
+    :returns: Dict with numbers of players, teams and games created
+    """
+    rng = random.Random(seed)
+    salt = bcrypt.gensalt()
+    hashed = bcrypt.hashpw(PASSWORD.encode(), salt)
+
+    with db_session:
+        wlsports.db.create_sports()
+        wlsports.search.setup()
+        sports = list(select((s.name, s.players_per_team) for s in Sport))
+
+    for first in range(0, num_players, BATCH_SIZE):
+        with db_session:
+            for i in range(first, min(first + BATCH_SIZE, num_players)):
+                Player(
+                    username="p{}".format(i),
+                    salt=salt.decode(),
+                    password=hashed.decode(),
+                    first=rng.choice(FIRST_NAMES),
+                    last=rng.choice(LAST_NAMES),
+                    birthday="19{:02d}-{:02d}-{:02d}".format(
+                        rng.randint(60, 99), rng.randint(1, 12),
+                        rng.randint(1, 28)),
+                    city=rng.choice(CITIES),
+                    country="Canada",
+                )
+
+    num_games = 0
+    for sport_name, players_per_team in sports:
+        names = ["{}{}".format(sport_name, t) for t in range(teams_per_sport)]
+        for first in range(0, teams_per_sport, BATCH_SIZE):
+            with db_session:
+                sport = Sport[sport_name]
+                for name in names[first:first + BATCH_SIZE]:
+                    usernames = rng.sample(
+                        range(num_players), min(players_per_team, num_players)
+                    )
+                    Team(name=name, sport=sport,
+                         users=[Player["p{}".format(u)] for u in usernames],
+                         wins=0, losses=0, ties=0, points_ratio=0.0)
+
+        if teams_per_sport < 2:
+            continue
+        pairs = [rng.sample(names, 2) for _ in
+                 range(teams_per_sport * games_per_team // 2)]
+        for first in range(0, len(pairs), BATCH_SIZE):
+            with db_session:
+                for name_a, name_b in pairs[first:first + BATCH_SIZE]:
+                    team_a, team_b = Team[name_a], Team[name_b]
+                    final_score = {name_a: rng.randint(1, 6),
+                                   name_b: rng.randint(1, 6)}
+                    record_result(team_a, team_b, final_score)
+                    players = list(team_a.users) + list(team_b.users)
+                    game = Game(teams=[team_a, team_b], host=players[0],
+                                accepted_players=players, cancelled=False,
+                                final_score=json.dumps(final_score))
+                    scores.record(game, team_a, team_b, final_score)
+                    num_games += 1
+
+        for first in range(0, teams_per_sport, BATCH_SIZE):
+            with db_session:
+                for name in names[first:first + BATCH_SIZE]:
+                    for _ in range(open_games_per_team):
+                        team = Team[name]
+                        rival = Team[next(
+                            n for n in rng.sample(names, 2) if n != name)]
+                        host = rng.choice(list(team.users))
+                        game = Game(teams=[team, rival], host=host,
+                                    accepted_players=[host])
+                        wlsports.invitations.invite_teams(game)
+                        num_games += 1
+
+    return {
+        "players": num_players,
+        "teams": teams_per_sport * len(sports),
+        "games": num_games,
+    }
+
+
+@click.command()
+@click.option('--db', required=True, help="Path of database file to create")
+@click.option('--players', default=10000, help="Number of players")
+@click.option('--teams-per-sport', default=None, type=int,
+              help="Number of teams per sport; default: a tenth of the "
+                   "number of players")
+@click.option('--games-per-team', default=5,
+              help="Finished games per team, roughly")
+@click.option('--seed', default=0)
+def main(db, players, teams_per_sport, games_per_team, seed):
+    wlsports.db.database.bind("sqlite", db, create_db=True)
+    wlsports.db.database.generate_mapping(create_tables=True)
+    elapsed = timeit.timeit(lambda: print(generate_league(
+        players, teams_per_sport or max(players // 10, 2), games_per_team,
+        seed=seed)), number=1)
+    print("Generated in {:.1f}s".format(elapsed))
+
+
+if __name__ == '__main__':
+    main()
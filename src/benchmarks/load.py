@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""Throughput and latency per endpoint under concurrent load
+
+Run from src/:
+
+    python -m benchmarks.load --scales 1000,10000 --output results.json
+    python -m benchmarks.load --scales 1000,10000 --compare results.json
+
+For every scale (number of players), a league is generated with
+benchmarks.league into a fresh database, and the application is served
+in-process by a single server process on a free local port. Clients log
+in as players that are on a team, then send ``--requests`` requests per
+mix of endpoints, ``--concurrency`` at a time. Every scale gets its own
+process, as a Pony database can only be bound once per process.
+
+Results are printed as a table and can be written as JSON with
+``--output``; ``--compare`` prints how requests per second and p95
+latencies changed from such a file.
+"""
+from __future__ import division, print_function
+
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+import click
+import tornado.httpserver
+import tornado.netutil
+from pony.orm import db_session, select
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+import wlsports.db
+import wlsports.sqlstats
+from app import make_application
+from benchmarks.league import PASSWORD, generate_league
+from benchmarks.storage import percentile
+from wlsports.config import Config, SQLITE_PROFILES
+from wlsports.db import Game, Team
+
+
+def team(client, league, rng):
+    return "GET", "/api/team/team/{}".format(rng.choice(league["teams"])), None
+
+
+def game(client, league, rng):
+    return "GET", "/api/game/game/{}".format(
+        rng.randint(1, league["max_game_id"])), None
+
+
+def invitations(client, league, rng):
+    return "GET", "/api/player/invitations", None
+
+
+def me(client, league, rng):
+    return "GET", "/api/player/me", None
+
+
+def search(client, league, rng):
+    return "POST", "/api/player/search", {
+        "query": rng.choice(["al", "sam lee", "vancouver", "p1", "chen"]),
+        "limit": 10,
+    }
+
+
+def matchmake(client, league, rng):
+    return "POST", "/api/team/matchmake", {"team_name": client["team"]}
+
+
+def login(client, league, rng):
+    return "POST", "/api/auth/playerlogin", {
+        "username": client["username"],
+        "password": PASSWORD,
+    }
+
+
+ENDPOINTS = {f.__name__: f for f in
+             [team, game, invitations, me, search, matchmake, login]}
+
+# Relative weights of endpoints in each mix
+MIXES = {
+    # Players browsing teams, games and their invitations
+    "browse": {"team": 40, "game": 30, "invitations": 15, "me": 10,
+               "search": 5},
+    # Browsing along with logins and matchmaking, which write
+    "mixed": {"team": 25, "game": 20, "invitations": 20, "me": 10,
+              "search": 10, "matchmake": 10, "login": 5},
+}
+
+
+def make_config(db_file, sqlite_profile):
+    return Config(
+        port=0,
+        db_file=db_file,
+        session_timeout_days=1,
+        cookie_secret="benchmark",
+        debug=False,
+        workers=1,
+        hash_workers=1,
+        sqlite=SQLITE_PROFILES[sqlite_profile],
+        db_read_threads=4,
+        db_write_threads=1,
+        db_max_pending=256,
+        response_cache_size=1024,
+        admins=frozenset(),
+        n_plus_one_threshold=0,
+        output_validation_rate=1.0,
+        session_cache_size=10000,
+        db_group_commit=0,
+        db_group_commit_window=2.0,
+        matchmaking_interval=1.0,
+    )
+
+
+@gen.coroutine
+def run_mix(base_url, clients, league, mix, num_requests, concurrency, seed):
+    """Send ``num_requests`` requests of ``mix``, ``concurrency`` at a time
+
+    :returns: {endpoint: {count, errors, rps, p50, p95, p99}}, with
+        latencies in milliseconds
+    """
+    http_client = AsyncHTTPClient(force_instance=True,
+                                  max_clients=concurrency)
+    rng = random.Random(seed)
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    plan = []
+    for name in _weighted_choices(rng, names, weights, num_requests):
+        client = rng.choice(clients)
+        plan.append((name, client, ENDPOINTS[name](client, league, rng)))
+    latencies = {name: [] for name in names}
+    errors = dict.fromkeys(names, 0)
+    queue = iter(plan)
+
+    @gen.coroutine
+    def worker():
+        for name, client, (method, path, body) in queue:
+            started = time.time()
+            response = yield http_client.fetch(
+                base_url + path, method=method,
+                headers={"Cookie": client["cookie"]},
+                body=None if body is None else json.dumps(body),
+                raise_error=False
+            )
+            latencies[name].append((time.time() - started) * 1000)
+            if response.code >= 400:
+                errors[name] += 1
+
+    started = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - started
+    http_client.close()
+
+    report = {}
+    for name in names:
+        samples = latencies[name]
+        if not samples:
+            continue
+        report[name] = {
+            "count": len(samples),
+            "errors": errors[name],
+            "rps": len(samples) / elapsed,
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+    report["all"] = {
+        "count": len(plan),
+        "errors": sum(errors.values()),
+        "rps": len(plan) / elapsed,
+        "p50": percentile(sum(latencies.values(), []), 50),
+        "p95": percentile(sum(latencies.values(), []), 95),
+        "p99": percentile(sum(latencies.values(), []), 99),
+    }
+    raise gen.Return(report)
+
+
+def _weighted_choices(rng, names, weights, n):
+    total = sum(weights)
+    choices = []
+    for _ in range(n):
+        x = rng.uniform(0, total)
+        for name, weight in zip(names, weights):
+            x -= weight
+            if x <= 0:
+                break
+        choices.append(name)
+    return choices
+
+
+@gen.coroutine
+def log_in(base_url, clients):
+    http_client = AsyncHTTPClient(force_instance=True)
+    for client in clients:
+        response = yield http_client.fetch(
+            base_url + "/api/auth/playerlogin", method="POST",
+            body=json.dumps({"username": client["username"],
+                             "password": PASSWORD})
+        )
+        client["cookie"] = "; ".join(
+            cookie.split(";", 1)[0]
+            for cookie in response.headers.get_list("Set-Cookie")
+        )
+    http_client.close()
+
+
+def run_scale(scale, mixes, num_requests, concurrency, num_clients,
+              games_per_team, sqlite_profile, seed, results):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmpdir, "bench.sqlite")
+        wlsports.db.use_sqlite_profile(SQLITE_PROFILES[sqlite_profile])
+        wlsports.sqlstats.install(wlsports.db.database)
+        wlsports.db.database.bind("sqlite", db_file, create_db=True)
+        wlsports.db.database.generate_mapping(create_tables=True)
+
+        started = time.time()
+        sizes = generate_league(scale, max(scale // 10, 2), games_per_team,
+                                seed=seed)
+        generate_time = time.time() - started
+
+        rng = random.Random(seed)
+        with db_session:
+            teams = list(select(t.name for t in Team))
+            max_game_id = max(select(g.id for g in Game))
+            clients = [
+                {"username": rng.choice(list(Team[name].users)).username,
+                 "team": name}
+                for name in rng.sample(teams, min(num_clients, len(teams)))
+            ]
+        league = {"teams": teams, "max_game_id": max_game_id}
+
+        application = make_application(
+            make_config(db_file, sqlite_profile))
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        base_url = "http://127.0.0.1:{}".format(
+            sockets[0].getsockname()[1])
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.add_sockets(sockets)
+
+        io_loop = IOLoop.current()
+        try:
+            io_loop.run_sync(lambda: log_in(base_url, clients))
+            by_mix = {}
+            for mix in mixes:
+                by_mix[mix] = io_loop.run_sync(lambda: run_mix(
+                    base_url, clients, league, MIXES[mix], num_requests,
+                    concurrency, seed
+                ))
+        finally:
+            http_server.stop()
+            application.settings['password_hasher'].shutdown()
+            application.settings['data_layer'].shutdown()
+
+        results[scale] = {"league": sizes, "generate_seconds": generate_time,
+                          "mixes": by_mix}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def print_results(scale, mix, endpoints, baseline=None):
+    for name, stats in sorted(endpoints.items()):
+        line = "{:>8} {:>7} {:>12} {:>7d} {:>7d} {:>9.1f} {:>9.2f} " \
+               "{:>9.2f} {:>9.2f}".format(
+                   scale, mix, name, stats["count"], stats["errors"],
+                   stats["rps"], stats["p50"], stats["p95"], stats["p99"])
+        if baseline is not None and name in baseline:
+            line += " {:>+8.1%} {:>+8.1%}".format(
+                stats["rps"] / baseline[name]["rps"] - 1,
+                stats["p95"] / baseline[name]["p95"] - 1)
+        print(line)
+
+
+@click.command()
+@click.option('--scales', default="1000,10000",
+              help="Comma-separated numbers of players; there are a tenth "
+                   "as many teams per sport")
+@click.option('--mixes', default=",".join(sorted(MIXES)),
+              help="Comma-separated names of endpoint mixes to run: {}"
+                   .format(", ".join(sorted(MIXES))))
+@click.option('--requests', 'num_requests', default=2000,
+              help="Requests per mix and scale")
+@click.option('--concurrency', default=16, help="Requests in flight")
+@click.option('--clients', 'num_clients', default=20,
+              help="Number of players logged in and sending requests")
+@click.option('--games-per-team', default=5,
+              help="Finished games per team in generated leagues, roughly")
+@click.option('--sqlite-profile', default="wal",
+              type=click.Choice(sorted(SQLITE_PROFILES)))
+@click.option('--seed', default=0)
+@click.option('--output', default=None, type=click.File('w'),
+              help="Write results to this file as JSON")
+@click.option('--compare', default=None, type=click.File('r'),
+              help="JSON results of an earlier run to compare with")
+def main(scales, mixes, num_requests, concurrency, num_clients,
+         games_per_team, sqlite_profile, seed, output, compare):
+    mixes = mixes.split(",")
+    for mix in mixes:
+        if mix not in MIXES:
+            raise click.BadParameter("No mix named {}".format(mix),
+                                     param_hint="--mixes")
+    baseline = json.load(compare)["scales"] if compare else {}
+
+    results = multiprocessing.Manager().dict()
+    header = "{:>8} {:>7} {:>12} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "players", "mix", "endpoint", "count", "errors", "req/s",
+        "p50 (ms)", "p95 (ms)", "p99 (ms)")
+    if baseline:
+        header += " {:>8} {:>8}".format("req/s", "p95")
+    print(header)
+    for scale in [int(s) for s in scales.split(",")]:
+        process = multiprocessing.Process(
+            target=run_scale,
+            args=(scale, mixes, num_requests, concurrency, num_clients,
+                  games_per_team, sqlite_profile, seed, results)
+        )
+        process.start()
+        process.join()
+        if scale not in results:
+            print("{:>8} failed".format(scale))
+            continue
+        for mix in mixes:
+            print_results(
+                scale, mix, results[scale]["mixes"][mix],
+                baseline.get(str(scale), {}).get("mixes", {}).get(mix)
+                if baseline else None
+            )
+
+    if output is not None:
+        json.dump({
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": multiprocessing.cpu_count(),
+                "requests": num_requests,
+                "concurrency": concurrency,
+                "clients": num_clients,
+                "games_per_team": games_per_team,
+                "sqlite_profile": sqlite_profile,
+                "seed": seed,
+            },
+            "scales": {str(scale): result
+                       for scale, result in results.items()},
+        }, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Matchmaking latency as the number of teams in a sport grows
+
+Run from src/:
+
+    python -m benchmarks.matchmake --scales 100,1000,10000
+
+For every scale, an in-memory league is grown to that size and rivals are
+picked for random teams with ``find_rival``. The previous approach of
+re-ranking the whole sport per matchmake is timed alongside it for
+comparison.
+
+Matchmaking is then timed again with a game finished before each one:
+two random teams play, their stats are updated with ``record_result``
+and they are re-slotted in the index, like Finish and ``refresh_team``
+do, so the index keeps changing. The same is timed with the order by
+summed ranking sorted again after every game, as the index used to do.
+"""
+from __future__ import print_function
+
+import random
+import timeit
+
+import click
+from pony.orm import db_session, select
+
+import wlsports.db
+from wlsports.db import Player, Sport, Team
+from wlsports.matchmaking import conflicting_teams, find_rival
+from wlsports.ranking import RankingIndex
+from wlsports.results import record_result
+
+
+class TeamStats(object):
+    """Stand-in for a Team entity, for record_result"""
+
+    def __init__(self, name, wins, losses, ties, points_ratio):
+        self.name = name
+        self.wins = wins
+        self.losses = losses
+        self.ties = ties
+        self.points_ratio = points_ratio
+
+
+def create_teams(first, last, players_per_team=2):
+    """Create teams numbered ``first`` to ``last - 1``"""
+    with db_session:
+        sport = Sport.get(name="Soccer") or Sport(
+            name="Soccer", players_per_team=players_per_team)
+        for t in range(first, last):
+            players = [
+                Player(username="p{}_{}".format(t, i), salt="salt", first="F",
+                       last="L", password="password", birthday="1990-01-01",
+                       city="Vancouver", country="Canada")
+                for i in range(players_per_team)
+            ]
+            Team(name="t{}".format(t), users=players, sport=sport,
+                 wins=random.randint(0, 20), losses=random.randint(0, 20),
+                 ties=random.randint(0, 5),
+                 points_ratio=random.uniform(0, 3))
+
+
+def rerank_sport(sport_name):
+    """What every matchmake used to do before picking a rival"""
+    teams = select(t for t in Team if t.sport.name == sport_name)[:]
+    rankings = {}
+    by_wl = sorted(teams, key=lambda t: float(t.wins) / (t.losses or 1),
+                   reverse=True)
+    for i, team in enumerate(by_wl):
+        rankings[team.name] = i
+    by_points = sorted(teams, key=lambda t: t.points_ratio, reverse=True)
+    for i, team in enumerate(by_points):
+        rankings[team.name] += i
+    return rankings
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+@click.command()
+@click.option('--scales', default="100,1000,10000",
+              help="Comma-separated numbers of teams to benchmark")
+@click.option('--samples', default=200, help="Matchmakes per scale")
+def main(scales, samples):
+    random.seed(0)
+    wlsports.db.database.bind("sqlite", ":memory:")
+    wlsports.db.database.generate_mapping(create_tables=True)
+
+    num_created = 0
+    print("{:>8} {:>12} {:>12} {:>14} {:>16} {:>16} {:>16}".format(
+        "teams", "p50 (ms)", "p99 (ms)", "re-rank (ms)",
+        "finish p50 (ms)", "finish p99 (ms)", "re-sort p50 (ms)"))
+    for num_teams in sorted(int(s) for s in scales.split(",")):
+        create_teams(num_created, num_teams)
+        num_created = num_teams
+
+        with db_session:
+            rankings = RankingIndex("Soccer")
+            rankings.load()
+            rankings.position("t0")
+
+        # Like a request, each matchmake gets its own db_session
+        @db_session
+        def matchmake():
+            team_name = "t{}".format(random.randrange(num_teams))
+            find_rival(rankings, team_name, conflicting_teams(team_name))
+
+        latencies = [timeit.timeit(matchmake, number=1) * 1000
+                     for _ in range(samples)]
+        rerank = timeit.timeit(db_session(lambda: rerank_sport("Soccer")),
+                               number=3) / 3 * 1000
+
+        with db_session:
+            stats = {
+                row[0]: TeamStats(*row) for row in select(
+                    (t.name, t.wins, t.losses, t.ties, t.points_ratio)
+                    for t in Team)
+            }
+
+        def finish(resort=False):
+            if resort:
+                # As if the order had never been built, so it is sorted
+                #   again by the next matchmake
+                rankings._invalidate()
+            team_a, team_b = (stats["t{}".format(t)] for t in
+                              random.sample(range(num_teams), 2))
+            record_result(team_a, team_b, {team_a.name: random.randint(0, 5),
+                                           team_b.name: random.randint(0, 5)})
+            for team in (team_a, team_b):
+                rankings.update(team.name, team.wins, team.losses,
+                                team.points_ratio)
+
+        def finish_and_matchmake():
+            finish()
+            matchmake()
+
+        def finish_resort_and_matchmake():
+            finish(resort=True)
+            matchmake()
+
+        with_finishes = [
+            timeit.timeit(finish_and_matchmake, number=1) * 1000
+            for _ in range(samples)]
+        with_resorts = [
+            timeit.timeit(finish_resort_and_matchmake, number=1) * 1000
+            for _ in range(samples)]
+
+        print("{:>8} {:>12.3f} {:>12.3f} {:>14.3f} {:>16.3f} {:>16.3f} "
+              "{:>16.3f}".format(
+                  num_teams, percentile(latencies, 50),
+                  percentile(latencies, 99), rerank,
+                  percentile(with_finishes, 50),
+                  percentile(with_finishes, 99),
+                  percentile(with_resorts, 50)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Database time per matchmade team, by matchmaking batch size
+
+Run from src/:
+
+    python -m benchmarks.matchqueue --profiles durable,wal \
+        --players 20000 --teams 2000 --batch-sizes 1,10,100,1000
+
+For every SQLite profile, a league is generated with benchmarks.league
+into a fresh database, and ``--teams`` random teams are matched in
+batches of each of ``--batch-sizes``, through the write lane of a
+DataLayer, the way the matchmaking queue does it (see
+wlsports.matchqueue.match): per sport, one lookup of the rankings, one
+query for the rosters of the whole batch, and one transaction for all
+of its games. A batch of 1 costs what ``POST /api/team/matchmake`` does
+per team. Every profile gets its own process, as a Pony database can
+only be bound once per process.
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+
+import click
+from pony.orm import db_session, select
+
+import wlsports.db
+from benchmarks.league import generate_league
+from wlsports.config import SQLITE_PROFILES
+from wlsports.dal import DataLayer
+from wlsports.db import Team
+from wlsports.matchqueue import match
+
+
+def run(profile, num_players, num_teams, batch_sizes, seed, results):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmpdir, "bench.sqlite")
+        wlsports.db.use_sqlite_profile(SQLITE_PROFILES[profile])
+        wlsports.db.database.bind("sqlite", db_file, create_db=True)
+        wlsports.db.database.generate_mapping(create_tables=True)
+        generate_league(num_players, max(num_players // 10, 2), seed=seed)
+
+        rng = random.Random(seed)
+        with db_session:
+            teams = sorted(select(
+                (t.name, t.sport.name, min(p.username for p in t.users))
+                for t in Team if t.users))
+        data_layer = DataLayer(write_threads=1)
+        try:
+            for batch_size in batch_sizes:
+                chosen = rng.sample(teams, min(num_teams, len(teams)))
+                matched = 0
+                started = time.time()
+                for first in range(0, len(chosen), batch_size):
+                    by_sport = defaultdict(list)
+                    for i, (team, sport, host) in enumerate(
+                            chosen[first:first + batch_size]):
+                        by_sport[sport].append((i, team, host))
+                    for sport, requests in sorted(by_sport.items()):
+                        game_ids, _ = data_layer.write(
+                            match, sport, requests).result()
+                        matched += len(game_ids)
+                elapsed = time.time() - started
+                results[(profile, batch_size)] = {
+                    "teams": len(chosen),
+                    "matched": matched,
+                    "per_team": elapsed / len(chosen) * 1000,
+                    "rate": len(chosen) / elapsed,
+                }
+        finally:
+            data_layer.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@click.command()
+@click.option('--profiles', default="durable,wal",
+              help="Comma-separated SQLite profiles")
+@click.option('--players', default=20000, help="Number of players")
+@click.option('--teams', default=2000,
+              help="Teams to match per batch size")
+@click.option('--batch-sizes', default="1,10,100,1000",
+              help="Comma-separated numbers of teams matched together")
+@click.option('--seed', default=0)
+def main(profiles, players, teams, batch_sizes, seed):
+    batch_sizes = [int(b) for b in batch_sizes.split(",")]
+    results = multiprocessing.Manager().dict()
+    print("{:>8} {:>6} {:>8} {:>8} {:>9} {:>8}".format(
+        "profile", "batch", "teams", "matched", "ms/team", "teams/s"))
+    for profile in profiles.split(","):
+        process = multiprocessing.Process(target=run, args=(
+            profile, players, teams, batch_sizes, seed, results))
+        process.start()
+        process.join()
+        for batch_size in batch_sizes:
+            result = results.get((profile, batch_size))
+            if result is None:
+                print("{:>8} {:>6} failed".format(profile, batch_size))
+                continue
+            print("{:>8} {:>6} {:>8} {:>8} {:>9.2f} {:>8.0f}".format(
+                profile, batch_size, result["teams"], result["matched"],
+                result["per_team"], result["rate"]))
+
+
+if __name__ == '__main__':
+    main()
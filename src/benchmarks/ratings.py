@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Time to rebuild standings from the game history as it grows
+
+Run from src/:
+
+    python -m benchmarks.ratings --scales 100000,1000000
+
+For every scale (number of finished games), a history is written
+straight into a fresh database with plain SQL, much faster than
+benchmarks.league could, and ``wlsports.ratings.recompute`` is timed on
+it, along with the vectorized part of it alone.
+"""
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+import click
+from pony.orm import db_session, flush
+
+import wlsports.db
+from wlsports import ratings
+from wlsports.config import SQLITE_PROFILES
+from wlsports.db import Player, database
+
+
+def create_history(num_teams, num_games, seed=0):
+    rng = random.Random(seed)
+    with db_session:
+        wlsports.db.create_sports()
+        Player(username="host", salt="salt", first="F", last="L",
+               password="password", birthday="1990-01-01",
+               city="Vancouver", country="Canada")
+        flush()
+        connection = database.get_connection()
+        connection.executemany(
+            'INSERT INTO "Team" (name, sport, wins, losses, ties, '
+            'points_ratio) VALUES (?, \'Soccer\', 0, 0, 0, 0)',
+            (("t{}".format(t),) for t in range(num_teams))
+        )
+
+        def games():
+            for _ in range(num_games):
+                a, b = rng.sample(range(num_teams), 2)
+                yield json.dumps({"t{}".format(a): rng.randint(1, 6),
+                                  "t{}".format(b): rng.randint(1, 6)}),
+        connection.executemany(
+            'INSERT INTO "Game" (host, location, cancelled, final_score) '
+            'VALUES (\'host\', \'\', 0, ?)',
+            games()
+        )
+
+
+def run_scale(num_games, num_teams, results):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        wlsports.db.use_sqlite_profile(SQLITE_PROFILES["fast"])
+        wlsports.db.database.bind(
+            "sqlite", os.path.join(tmpdir, "bench.sqlite"), create_db=True)
+        wlsports.db.database.generate_mapping(create_tables=True)
+        create_history(num_teams, num_games)
+
+        with db_session:
+            names = list(database.select('SELECT name FROM "Team"'))
+            rows = list(database.select('SELECT final_score FROM "Game"'))
+        arrays = ratings.parse_scores(
+            rows, {name: i for i, name in enumerate(names)})
+        compute = timeit.timeit(
+            lambda: ratings.compute_stats(len(names), *arrays[:4]),
+            number=1)
+
+        with db_session:
+            report = ratings.recompute()
+        results[num_games] = (report["seconds"], compute)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@click.command()
+@click.option('--scales', default="10000,100000,1000000",
+              help="Comma-separated numbers of finished games")
+@click.option('--teams', default=10000, help="Number of teams")
+def main(scales, teams):
+    results = multiprocessing.Manager().dict()
+    print("{:>10} {:>14} {:>14} {:>14}".format(
+        "games", "recompute (s)", "games/s", "vectorized (s)"))
+    for num_games in [int(s) for s in scales.split(",")]:
+        process = multiprocessing.Process(
+            target=run_scale, args=(num_games, teams, results))
+        process.start()
+        process.join()
+        if num_games not in results:
+            print("{:>10} failed".format(num_games))
+            continue
+        total, compute = results[num_games]
+        print("{:>10} {:>14.2f} {:>14.0f} {:>14.3f}".format(
+            num_games, total, num_games / total, compute))
+
+
+if __name__ == '__main__':
+    main()
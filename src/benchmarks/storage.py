@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Write throughput and read latency for each SQLite profile
+
+Run from src/:
+
+    python -m benchmarks.storage --writes 500 --reads 2000
+
+Every profile gets a fresh database file in a temporary directory and
+its own process (a Pony database can only be bound once per process).
+Writes are small transactions like the ones the API makes: one player
+updated and committed per transaction. Reads are primary key lookups,
+each in its own db_session, made while another thread keeps writing.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import timeit
+
+import click
+from pony.orm import db_session
+
+import wlsports.db
+from wlsports.config import SQLITE_PROFILES
+from wlsports.db import Player
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def run_profile(profile_name, num_writes, num_reads, num_players, results):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        wlsports.db.use_sqlite_profile(SQLITE_PROFILES[profile_name])
+        wlsports.db.database.bind(
+            "sqlite", os.path.join(tmpdir, "bench.sqlite"), create_db=True)
+        wlsports.db.database.generate_mapping(create_tables=True)
+        with db_session:
+            for i in range(num_players):
+                Player(username="p{}".format(i), salt="salt", first="F",
+                       last="L", password="password", birthday="1990-01-01",
+                       city="Vancouver", country="Canada")
+
+        @db_session
+        def write(i):
+            Player["p{}".format(i % num_players)].bio = "bio {}".format(i)
+
+        @db_session
+        def read(i):
+            return Player["p{}".format(i % num_players)].city
+
+        elapsed = timeit.timeit(
+            lambda: [write(i) for i in range(num_writes)], number=1)
+        writes_per_sec = num_writes / elapsed
+
+        stop = threading.Event()
+
+        def background_writes():
+            i = 0
+            while not stop.is_set():
+                write(i)
+                i += 1
+
+        writer = threading.Thread(target=background_writes)
+        writer.start()
+        try:
+            latencies = [timeit.timeit(lambda: read(i), number=1) * 1000
+                         for i in range(num_reads)]
+        finally:
+            stop.set()
+            writer.join()
+
+        results[profile_name] = (writes_per_sec,
+                                 percentile(latencies, 50),
+                                 percentile(latencies, 99))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@click.command()
+@click.option('--profiles', default=",".join(sorted(SQLITE_PROFILES)),
+              help="Comma-separated names of profiles to compare")
+@click.option('--writes', default=500, help="Write transactions per profile")
+@click.option('--reads', default=2000, help="Reads per profile")
+@click.option('--players', default=1000, help="Players in the database")
+def main(profiles, writes, reads, players):
+    results = multiprocessing.Manager().dict()
+    print("{:>10} {:>12} {:>14} {:>14}".format(
+        "profile", "writes/s", "read p50 (ms)", "read p99 (ms)"))
+    for profile_name in profiles.split(","):
+        process = multiprocessing.Process(
+            target=run_profile,
+            args=(profile_name, writes, reads, players, results)
+        )
+        process.start()
+        process.join()
+        if profile_name not in results:
+            print("{:>10} failed".format(profile_name))
+            continue
+        print("{:>10} {:>12.1f} {:>14.3f} {:>14.3f}".format(
+            profile_name, *results[profile_name]))
+
+
+if __name__ == '__main__':
+    main()
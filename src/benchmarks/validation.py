@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""CPU time of schema validation per endpoint
+
+Run from src/:
+
+    python -m benchmarks.validation --players 1000 --repeat 2000
+
+A league is generated with benchmarks.league and served in-process; one
+real response of every endpoint below is fetched, along with the
+request that produced it. Validating that input and output is then
+timed three ways:
+
+* per request, as ``tornado_json.schema.validate`` does it, checking
+  the schemas and building validators every time
+* with the validators wlsports.schema compiles once
+* with the compiled input validator only, as with
+  --output-validation-rate 0
+"""
+from __future__ import division, print_function
+
+import json
+import os
+import shutil
+import tempfile
+import timeit
+
+import click
+import jsonschema
+import tornado.httpserver
+import tornado.netutil
+from pony.orm import db_session, select
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+import wlsports.db
+from app import make_application
+from benchmarks.league import PASSWORD, generate_league
+from benchmarks.load import make_config
+from wlsports.api.game import Batch, Game
+from wlsports.api.player import Invitations, Me, Search
+from wlsports.api.team import Team
+from wlsports.db import Game as GameEntity, Team as TeamEntity
+from wlsports.schema import compile_schema
+
+
+def endpoints(team_name, game_ids):
+    """[(name, handler method, HTTP method, path, body), ...]"""
+    return [
+        ("team", Team.get, "GET", "/api/team/team/{}".format(team_name),
+         None),
+        ("game", Game.get, "GET", "/api/game/game/{}".format(game_ids[0]),
+         None),
+        ("game batch", Batch.post, "POST", "/api/game/batch",
+         {"ids": game_ids}),
+        ("me", Me.get, "GET", "/api/player/me", None),
+        ("invitations", Invitations.get, "GET", "/api/player/invitations",
+         None),
+        ("search", Search.post, "POST", "/api/player/search",
+         {"query": "al", "limit": 50}),
+    ]
+
+
+@gen.coroutine
+def fetch_all(base_url, username, requests):
+    """Log in as ``username`` and make ``requests``
+
+    :returns: [(input, output), ...] of the requests
+    """
+    http_client = AsyncHTTPClient(force_instance=True)
+    response = yield http_client.fetch(
+        base_url + "/api/auth/playerlogin", method="POST",
+        body=json.dumps({"username": username, "password": PASSWORD})
+    )
+    cookie = "; ".join(c.split(";", 1)[0]
+                       for c in response.headers.get_list("Set-Cookie"))
+    samples = []
+    for method, path, body in requests:
+        response = yield http_client.fetch(
+            base_url + path, method=method, headers={"Cookie": cookie},
+            body=None if body is None else json.dumps(body)
+        )
+        samples.append((body, json.loads(response.body.decode())["data"]))
+    http_client.close()
+    raise gen.Return(samples)
+
+
+def wrap_output_schema(output_schema):
+    return {
+        "type": "object",
+        "properties": {"result": output_schema},
+        "required": ["result"]
+    }
+
+
+def per_request(method, input_, output):
+    if method.input_schema is not None:
+        jsonschema.validate(input_, method.input_schema)
+    jsonschema.validate({"result": output},
+                        wrap_output_schema(method.output_schema))
+
+
+@click.command()
+@click.option('--players', default=1000, help="Players in the league")
+@click.option('--repeat', default=2000, help="Validations timed per endpoint")
+def main(players, repeat):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmpdir, "bench.sqlite")
+        wlsports.db.database.bind("sqlite", db_file, create_db=True)
+        wlsports.db.database.generate_mapping(create_tables=True)
+        generate_league(players, max(players // 10, 2))
+        with db_session:
+            team = select(t for t in TeamEntity).first()
+            team_name, username = team.name, list(team.users)[0].username
+            game_ids = list(select(g.id for g in GameEntity)
+                            .order_by(lambda g: g)[:100])
+
+        application = make_application(make_config(db_file, "wal"))
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        base_url = "http://127.0.0.1:{}".format(sockets[0].getsockname()[1])
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.add_sockets(sockets)
+        try:
+            cases = endpoints(team_name, game_ids)
+            samples = IOLoop.current().run_sync(lambda: fetch_all(
+                base_url, username, [case[2:] for case in cases]))
+        finally:
+            http_server.stop()
+            application.settings['password_hasher'].shutdown()
+            application.settings['data_layer'].shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("{:>12} {:>12} {:>14} {:>14} {:>14} {:>8}".format(
+        "endpoint", "output (KB)", "per request", "compiled",
+        "input only", "saved"))
+    print("{:>12} {:>12} {:>14} {:>14} {:>14} {:>8}".format(
+        "", "", "(us)", "(us)", "(us)", ""))
+    for (name, method, _, _, _), (input_, output) in zip(cases, samples):
+        input_validator = compile_schema(method.input_schema) \
+            if method.input_schema is not None else None
+        output_validator = compile_schema(
+            wrap_output_schema(method.output_schema))
+
+        def compiled_input():
+            if input_validator is not None:
+                input_validator.validate(input_)
+
+        def compiled():
+            compiled_input()
+            output_validator.validate({"result": output})
+
+        times = [
+            timeit.timeit(fn, number=repeat) / repeat * 1e6
+            for fn in [lambda: per_request(method, input_, output), compiled,
+                       compiled_input]
+        ]
+        print("{:>12} {:>12.1f} {:>14.1f} {:>14.1f} {:>14.1f} {:>8.0%}"
+              .format(name, len(json.dumps(output)) / 1024, times[0],
+                      times[1], times[2], 1 - times[2] / times[0]))
+
+
+if __name__ == '__main__':
+    main()
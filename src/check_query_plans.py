@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Fail if any hot query has to scan a whole table
+
+    ./check_query_plans.py --db ../welikesports.sqlite
+
+Migrates the database first, like the server does when it starts, then
+prints SQLite's plan for every statement of the hot queries (see
+wlsports.queryplans). Exits with status 1 if any of them is a full scan.
+Use a copy of a production database, one from benchmarks.league, or a
+path that doesn't exist yet, to check the plans on a new, empty database;
+the queries' changes are rolled back, but migrations are not.
+"""
+from __future__ import print_function
+
+import sys
+
+import click
+
+import wlsports.db
+from wlsports import migrations, queryplans
+from wlsports.config import SQLITE_PROFILES
+
+
+@click.command()
+@click.option('--db', default="../welikesports.sqlite", type=str,
+              help="Path of database file")
+@click.option('--sqlite-profile', default="durable",
+              type=click.Choice(sorted(SQLITE_PROFILES)),
+              help="Same as the server's, if it is running")
+@click.option('--verbose', '-v', is_flag=True,
+              help="Print the plans of all statements, not just failures")
+def main(db, sqlite_profile, verbose):
+    wlsports.db.use_sqlite_profile(SQLITE_PROFILES[sqlite_profile])
+    wlsports.db.database.bind("sqlite", db, create_db=True)
+    wlsports.db.database.generate_mapping(create_tables=True)
+    migrations.migrate()
+
+    plans = queryplans.check()
+    failed = [plan for plan in plans if plan.full_scans]
+    for plan in plans:
+        if plan.full_scans or verbose:
+            print("{}: {}".format(
+                "FULL SCAN" if plan.full_scans else "ok", plan.query))
+            print("    " + " ".join(plan.sql.split()))
+            for step in plan.steps:
+                print("      " + step)
+    print("{} statements of {} hot queries checked, {} with full scans"
+          .format(len(plans), len({plan.query for plan in plans}),
+                  len(failed)))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
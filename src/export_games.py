@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Export game history as NDJSON
+
+    ./export_games.py --db ../welikesports.sqlite > games.ndjson
+
+Writes the same lines as GET /api/game/export, one game per line ordered
+by ID, reading a chunk of games per short db_session, so memory use does
+not grow with the number of games. Safe to run while the server is
+running.
+"""
+from __future__ import print_function
+
+import sys
+
+import click
+from pony.orm import db_session
+
+import wlsports.db
+from wlsports.config import SQLITE_PROFILES
+from wlsports.games import EXPORT_CHUNK_SIZE, export_chunk
+from wlsports.util import parse_date
+
+
+def _date(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_date(value)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
+
+@click.command()
+@click.option('--db', default="../welikesports.sqlite", type=str,
+              help="Path of database file")
+@click.option('--output', '-o', default="-", type=click.File('w'),
+              help="File to write to; default: stdout")
+@click.option('--team', default=None, help="Only games of this team")
+@click.option('--player', default=None,
+              help="Only games of teams with this player")
+@click.option('--date-from', default=None, callback=_date,
+              help="Only games on or after this date (YYYY-MM-DD)")
+@click.option('--date-to', default=None, callback=_date,
+              help="Only games on or before this date (YYYY-MM-DD)")
+@click.option('--after', default=None, type=int,
+              help="Only games with greater IDs, e.g., to resume an export")
+@click.option('--chunk-size', default=EXPORT_CHUNK_SIZE, type=int,
+              help="Games read per db_session")
+@click.option('--sqlite-profile', default="durable",
+              type=click.Choice(sorted(SQLITE_PROFILES)),
+              help="Same as the server's, if it is running")
+def main(db, output, team, player, date_from, date_to, after, chunk_size,
+         sqlite_profile):
+    wlsports.db.use_sqlite_profile(SQLITE_PROFILES[sqlite_profile])
+    wlsports.db.database.bind("sqlite", db)
+    wlsports.db.database.generate_mapping(create_tables=True)
+
+    filters = {k: v for k, v in dict(
+        team=team, player=player, date_from=date_from, date_to=date_to
+    ).items() if v is not None}
+    count = 0
+    more = True
+    while more:
+        with db_session:
+            text, after, more = export_chunk(after=after, limit=chunk_size,
+                                             **filters)
+        output.write(text)
+        output.flush()
+        count += text.count("\n")
+    print("Exported {} games".format(count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
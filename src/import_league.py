@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Bulk import of players, teams and historical games
+
+    ./import_league.py --db ../welikesports.sqlite players.csv teams.ndjson
+
+Takes the same NDJSON and CSV records as POST /api/league/import (see
+wlsports.importer), straight into the database. Files are imported in
+the order given; ``-`` reads from stdin.
+
+Run this while the server is stopped, or with the server running with
+--workers > 1; a single server process won't notice the new standings
+until it is restarted. Use the endpoint otherwise.
+"""
+from __future__ import print_function
+
+import sys
+
+import click
+from pony.orm import db_session
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import wlsports.db
+import wlsports.generations
+import wlsports.search
+from wlsports.config import SQLITE_PROFILES
+from wlsports.dal import DataLayer
+from wlsports.hashing import PasswordHasher
+from wlsports.importer import Importer, RecordParser, BATCH_SIZE, \
+    FORMATS, KINDS
+
+READ_SIZE = 64 * 1024
+
+
+@click.command()
+@click.argument('files', nargs=-1, required=True, type=click.File('rb'))
+@click.option('--db', default="../welikesports.sqlite", type=str,
+              help="Path of database file")
+@click.option('--format', 'fmt', default=None, type=click.Choice(FORMATS),
+              help="Format of all files; by default, files ending in .csv "
+                   "are CSV and everything else is NDJSON")
+@click.option('--type', 'kind', default=None, type=click.Choice(KINDS),
+              help="Type of records in CSV files without a type column")
+@click.option('--batch-size', default=BATCH_SIZE, type=int,
+              help="Records inserted per transaction")
+@click.option('--hash-workers', default=0, type=int,
+              help="Number of processes hashing passwords; 0 uses one per "
+                   "CPU")
+@click.option('--sqlite-profile', default="durable",
+              type=click.Choice(sorted(SQLITE_PROFILES)),
+              help="Same as the server's, if it is running")
+def main(files, db, fmt, kind, batch_size, hash_workers, sqlite_profile):
+    wlsports.db.use_sqlite_profile(SQLITE_PROFILES[sqlite_profile])
+    wlsports.db.database.bind("sqlite", db, create_db=True)
+    wlsports.db.database.generate_mapping(create_tables=True)
+    with db_session:
+        wlsports.db.create_sports()
+        wlsports.search.setup()
+    # Let running server workers know about changed standings
+    wlsports.generations.enable_sharing()
+
+    password_hasher = PasswordHasher(workers=hash_workers)
+    data_layer = DataLayer(read_threads=1, write_threads=1)
+
+    @gen.coroutine
+    def import_file(f):
+        parser = RecordParser(
+            fmt or ("csv" if f.name.endswith(".csv") else "ndjson"),
+            kind=kind
+        )
+        importer = Importer(password_hasher, data_layer.read,
+                            data_layer.write, batch_size=batch_size)
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            for row in parser.feed(data):
+                yield importer.add(*row)
+        for row in parser.close():
+            yield importer.add(*row)
+        yield importer.flush()
+        raise gen.Return(importer.report())
+
+    failed = False
+    try:
+        for f in files:
+            report = IOLoop.current().run_sync(lambda: import_file(f))
+            print("{}: {}".format(f.name, ", ".join(
+                "{} {}".format(n, kind_)
+                for kind_, n in sorted(report["imported"].items())
+            )))
+            for error in report["errors"]:
+                print("{}:{}: {}".format(f.name, error["line"],
+                                         error["error"]), file=sys.stderr)
+            if report["error_count"] > len(report["errors"]):
+                print("{}: ... {} errors in total".format(
+                    f.name, report["error_count"]), file=sys.stderr)
+            failed = failed or report["error_count"] > 0
+    finally:
+        password_hasher.shutdown()
+        data_layer.shutdown()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
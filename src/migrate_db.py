@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Bring a database up to date with the current schema
+
+    ./migrate_db.py --db ../welikesports.sqlite
+
+Creates missing tables and declared indexes, then applies pending
+migrations (see wlsports.migrations). The server does the same when it
+starts; running this beforehand keeps a long migration, e.g., indexing
+a large table, from holding up the start.
+
+With ``--dry-run``, nothing is written: the database is only read over a
+plain connection, without Pony, whose mapping would fail on the tables
+it doesn't have yet. The tables and indexes that would be created are
+those of a new database that are missing from it.
+"""
+from __future__ import print_function
+
+import os
+import sqlite3
+
+import click
+from pony.orm import db_session
+
+import wlsports.db
+from wlsports import migrations
+from wlsports.config import SQLITE_PROFILES
+
+
+@click.command()
+@click.option('--db', default="../welikesports.sqlite", type=str,
+              help="Path of database file")
+@click.option('--sqlite-profile', default="durable",
+              type=click.Choice(sorted(SQLITE_PROFILES)),
+              help="Same as the server's, if it is running")
+@click.option('--dry-run', is_flag=True,
+              help="Only list the migrations that would be applied")
+def main(db, sqlite_profile, dry_run):
+    if dry_run:
+        preview(db)
+        return
+
+    wlsports.db.use_sqlite_profile(SQLITE_PROFILES[sqlite_profile])
+    wlsports.db.database.bind("sqlite", db, create_db=True)
+    wlsports.db.database.generate_mapping(create_tables=True)
+
+    with db_session:
+        version = migrations.current_version()
+    print("Database is at version {}, the latest is {}".format(
+        version, migrations.LATEST))
+    for migration in migrations.migrate():
+        print("Applied {}: {}".format(migration.version,
+                                      migration.description))
+
+
+def preview(db):
+    """Print what running without --dry-run would do to ``db``"""
+    if not os.path.exists(db):
+        print("{} does not exist; it would be created with all tables, "
+              "and all migrations would be applied".format(db))
+        return
+    connection = sqlite3.connect(db)
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        existing = _schema_objects(connection)
+    finally:
+        connection.close()
+
+    # What generate_mapping(create_tables=True) creates, from a new
+    #   in-memory database
+    wlsports.db.database.bind("sqlite", ":memory:")
+    wlsports.db.database.generate_mapping(create_tables=True)
+    with db_session:
+        wanted = _schema_objects(wlsports.db.database.get_connection())
+
+    print("Database is at version {}, the latest is {}".format(
+        version, migrations.LATEST))
+    # Tables first, as they are created first
+    for kind, name in sorted(wanted - existing,
+                             key=lambda o: (o[0] != "table", o[1])):
+        print("Would create {} {}".format(kind, name))
+    for migration in migrations.MIGRATIONS:
+        if migration.version > version:
+            print("Would apply {}: {}".format(
+                migration.version, migration.description))
+
+
+def _schema_objects(connection):
+    """{(type, name), ...} of the tables and indexes of ``connection``"""
+    return set(connection.execute(
+        "SELECT type, name FROM sqlite_master "
+        "WHERE type IN ('table', 'index') AND name NOT LIKE 'sqlite_%'"
+    ).fetchall())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Rebuild the standings of all teams from their game history
+
+    ./recompute_ratings.py --db ../welikesports.sqlite
+
+Does what POST /api/league/recompute does (see wlsports.ratings),
+straight on the database. Like ./import_league.py, run this while the
+server is stopped or running with --workers > 1; a single server process
+won't notice the new standings until it is restarted.
+"""
+from __future__ import print_function
+
+import click
+from pony.orm import db_session
+
+import wlsports.db
+import wlsports.generations
+from wlsports import ratings
+from wlsports.config import SQLITE_PROFILES
+
+
+@click.command()
+@click.option('--db', default="../welikesports.sqlite", type=str,
+              help="Path of database file")
+@click.option('--sqlite-profile', default="durable",
+              type=click.Choice(sorted(SQLITE_PROFILES)),
+              help="Same as the server's, if it is running")
+def main(db, sqlite_profile):
+    wlsports.db.use_sqlite_profile(SQLITE_PROFILES[sqlite_profile])
+    wlsports.db.database.bind("sqlite", db)
+    wlsports.db.database.generate_mapping(create_tables=True)
+    # Let running server workers know about changed standings
+    wlsports.generations.enable_sharing()
+
+    with db_session:
+        report = ratings.recompute()
+    print("Recomputed {teams} teams from {games} games in {seconds:.2f}s; "
+          "skipped {skipped} games".format(**report))
+
+
+if __name__ == '__main__':
+    main()
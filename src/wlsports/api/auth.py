@@ -1,9 +1,10 @@
-import bcrypt
-from tornado_json import schema
+from tornado import gen
+from wlsports import schema
+from tornado_json.gen import coroutine
 from tornado_json.exceptions import APIError, api_assert
 from tornado.web import authenticated
-from pony.orm import db_session
 
+from wlsports import sessions
 from wlsports.handlers import APIHandler
 from wlsports.db import Player as PlayerEntity
 
@@ -26,6 +27,7 @@ class PlayerLogin(APIHandler):
             }
         },
     )
+    @coroutine
     def post(self):
         """
         POST the required credentials to get back a cookie
@@ -39,28 +41,27 @@ class PlayerLogin(APIHandler):
             log_message="Username field is empty!"
         )
 
-        with db_session:
-            player = PlayerEntity.get(username=self.body['username'])
+        def get_credentials(username):
+            player = PlayerEntity.get(username=username)
             api_assert(
                 player is not None,
                 400,
-                log_message="No such player {}".format(self.body['username'])
+                log_message="No such player {}".format(username)
             )
+            return player.username, player.salt, player.password
+
+        username, salt, hashed = yield self.db_read(
+            get_credentials, self.body['username']
+        )
 
-        password = self.body['password']
         # Check if the given password hashed with the player's known
         #   salt matches the stored password
-        password_match = bcrypt.hashpw(
-            password.encode(),
-            player.salt.encode()
-        ) == player.password.encode()
+        password_match = yield self.settings['password_hasher'].check_password(
+            self.body['password'], salt, hashed
+        )
         if password_match:
-            self.set_secure_cookie(
-                "user",
-                self.body['username'],
-                self.settings['app_config'].session_timeout_days
-            )
-            return {"username": player.username}
+            yield self.start_session(username)
+            raise gen.Return({"username": username})
         else:
             raise APIError(
                 400,
@@ -75,7 +76,7 @@ class PlayerLogin(APIHandler):
 
         Should be obvious from status code (403 vs. 200).
         """
-        if not self.get_current_user():
+        if not self.current_user:
             raise APIError(
                 403,
                 log_message="Please post to {} to get a cookie".format(
@@ -83,3 +84,64 @@ class PlayerLogin(APIHandler):
             )
         else:
             return "You are already logged in."
+
+
+class Logout(APIHandler):
+
+    @authenticated
+    @schema.validate(
+        output_schema={"type": "string"}
+    )
+    @coroutine
+    def post(self):
+        """
+        POST to end the session of this cookie; other sessions of the
+        player stay logged in
+        """
+        yield self.end_session()
+        raise gen.Return("Logged out.")
+
+
+class Revoke(APIHandler):
+
+    @authenticated
+    @schema.validate(
+        input_schema={
+            "type": "object",
+            "properties": {
+                "username": {"type": "string"},
+            },
+        },
+        input_example={
+            "username": "johnny"
+        },
+        output_schema={
+            "type": "object",
+            "properties": {
+                "revoked": {"type": "number"}
+            }
+        },
+        output_example={
+            "revoked": 3
+        }
+    )
+    @coroutine
+    def post(self):
+        """
+        POST to log a player out everywhere, by revoking all of their
+        sessions, including the current one
+
+        * `username`: (Optional) Player whose sessions to revoke; only
+            admins may give anyone but themselves. Defaults to self.
+
+        Returns the number of sessions revoked.
+        """
+        username = self.body.get('username') or self.current_user
+        if username != self.current_user:
+            self.assert_admin()
+
+        revoked = yield self.db_write(sessions.revoke_player, username)
+        self.settings['session_store'].discard_player(username)
+        if username == self.current_user:
+            self.clear_cookie(sessions.COOKIE_NAME)
+        raise gen.Return({"revoked": revoked})
@@ -0,0 +1,154 @@
+import json
+from datetime import timedelta
+
+from tornado import gen
+from tornado.web import HTTPError, authenticated
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+from tornado_json.exceptions import api_assert, APIError
+from tornado_json.gen import coroutine
+
+from wlsports import schema
+from wlsports.handlers import APIHandler, AuthMixin
+
+
+DEFAULT_POLL_SECONDS = 30
+MAX_POLL_SECONDS = 120
+SOCKET_URL = r"/api/events/socket/?"
+
+
+class Poll(APIHandler):
+
+    _waiting = None
+
+    @authenticated
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "events": {"type": "array"},
+                "last_id": {"type": "number"},
+                "reset": {"type": "boolean"}
+            }
+        },
+        output_example={
+            "events": [
+                {"id": 41, "type": "invitation", "game_id": 7},
+                {"id": 42, "type": "game", "game_id": 7,
+                 "change": "updated", "date": "2015-06-13",
+                 "location": "Park"}
+            ],
+            "last_id": 42,
+            "reset": False
+        }
+    )
+    @coroutine
+    def get(self):
+        """
+        GET your events after the one with ID `since`, waiting for one if
+        there are none yet (long polling)
+
+        Query arguments:
+
+        * `since`: (Optional) `last_id` of the previous response; without
+          it, only events from now on are returned
+        * `timeout`: (Optional) Seconds to wait for an event, at most 120;
+          defaults to 30. An empty list of `events` is returned if none
+          came.
+
+        Events have an `id`, a `game_id` and a `type`:
+
+        * `invitation`: You were invited to a new game
+        * `game`: A game you are in has changed; `change` is `accepted`
+          (by `player`), `cancelled`, `updated` (with its new `date` and
+          `location`) or `finished` (with its `final_score`)
+        * `matchmaking`: A team you queued for matchmaking was matched
+          or not; the event is the settled ticket (see
+          `/api/team/matchqueue`), with its `game_id` or `reason`
+
+        If `reset` is true, events may have been missed, e.g., because
+        the server restarted; refetch your invitations and games, then
+        carry on from `last_id`.
+        """
+        bus = self.settings['event_bus']
+        try:
+            since = self.get_query_argument("since", None)
+            since = bus.last_id if since is None else int(since)
+            timeout = float(self.get_query_argument(
+                "timeout", DEFAULT_POLL_SECONDS))
+        except ValueError:
+            raise APIError(400, log_message="since and timeout must be "
+                                            "numbers")
+        api_assert(0 <= timeout <= MAX_POLL_SECONDS, 400,
+                   log_message="timeout must be between 0 and {}".format(
+                       MAX_POLL_SECONDS))
+
+        events, complete = bus.since(self.current_user, since)
+        if not events and complete and timeout:
+            self._waiting = bus.wait(self.current_user)
+            try:
+                yield gen.with_timeout(timedelta(seconds=timeout),
+                                       self._waiting)
+            except gen.TimeoutError:
+                pass
+            finally:
+                self.on_connection_close()
+            events, complete = bus.since(self.current_user, since)
+
+        raise gen.Return({
+            "events": events,
+            "last_id": events[-1]["id"] if events and complete
+            else bus.last_id,
+            "reset": not complete
+        })
+
+    def on_connection_close(self):
+        if self._waiting is not None and not self._waiting.done():
+            self._waiting.set_result(None)
+
+
+class Socket(AuthMixin, WebSocketHandler):
+    """Events for the logged in player as they happen, over a WebSocket
+
+    Every event (see Poll) is sent as one JSON text message. Connect
+    with `?since=` the ID of the last event seen to get the ones missed
+    since first; if some of them are gone, a message of type `reset`
+    comes first.
+
+    get_routes only picks up APIHandlers and ViewHandlers, so this is
+    routed by make_application in app.py, at ``SOCKET_URL``.
+    """
+
+    @gen.coroutine
+    def prepare(self):
+        self.current_user = yield self.resolve_session(
+            self.settings['data_layer'].read)
+        if self.current_user is None:
+            raise HTTPError(403)
+
+    def open(self):
+        bus = self.settings['event_bus']
+        bus.subscribe(self.current_user, self.send_event)
+        since = self.get_query_argument("since", None)
+        if since is not None:
+            try:
+                events, complete = bus.since(self.current_user, int(since))
+            except ValueError:
+                events, complete = [], False
+            if not complete:
+                self.send_event({"type": "reset", "id": bus.last_id})
+            for event in events:
+                self.send_event(event)
+
+    def send_event(self, event):
+        try:
+            self.write_message(json.dumps(event))
+        except WebSocketClosedError:
+            self.on_close()
+
+    def on_message(self, message):
+        # Nothing to receive; clients may send anything as a keepalive
+        pass
+
+    def on_close(self):
+        self.settings['event_bus'].unsubscribe(
+            self.current_user, self.send_event)
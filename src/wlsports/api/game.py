@@ -2,18 +2,29 @@ from __future__ import division
 
 import json
 
-import bcrypt
+from tornado import gen
 from tornado_json.exceptions import api_assert, APIError
-from tornado_json import schema
-from pony.orm import db_session, select, commit
+from wlsports import schema
+from tornado_json.gen import coroutine
+from pony.orm import commit
+import tornado.web
+from tornado.iostream import StreamClosedError
 from tornado.web import authenticated
 
+from wlsports import cache, scores
+from wlsports.dal import after_commit
+from wlsports.events import game_players
 from wlsports.db import Game as GameEntity
 from wlsports.db import Player as PlayerEntity
 from wlsports.db import Team as TeamEntity
+from wlsports.games import MAX_GAMES, export_chunk, find_games, \
+    get_games
 from wlsports.handlers import APIHandler
-from wlsports.util import validate_date_text
-from wlsports.api.player import get_player_invitations
+from wlsports.ranking import refresh_team
+from wlsports.ranking import bump as bump_rankings
+from wlsports.results import record_result
+from wlsports.util import parse_date, validate_date_text
+from wlsports.invitations import accept, cancel, is_invited
 
 
 class Game(APIHandler):
@@ -34,26 +45,215 @@ class Game(APIHandler):
             }
         }
     )
+    @coroutine
     def get(self, game_id):
         """GET game with game_id"""
-        with db_session:
-            game = GameEntity.get(id=game_id)
+        try:
+            game_id = int(game_id)
+        except ValueError:
+            raise APIError(
+                400,
+                log_message="No such game {} exists!".format(game_id)
+            )
+        key = cache.game_key(game_id)
+
+        def get_game():
+            versions = cache.versions(key)
+            games = get_games([game_id])
             api_assert(
-                game is not None,
+                games,
                 400,
                 log_message="No such game {} exists!".format(game_id)
             )
-            game_dict = game.to_dict(with_collections=True)
-        if not game_dict["location"]:
-            game_dict["location"] = ""
-        if not game_dict["date"]:
-            game_dict["date"] = ""
-        if not game_dict["cancelled"]:
-            game_dict["cancelled"] = False
-        if not game_dict["final_score"]:
-            game_dict["final_score"] = ""
+            return games[0], versions
+
+        game_dict = yield self.get_cached(key, get_game)
+        raise gen.Return(game_dict)
+
+
+class Batch(APIHandler):
+
+    @schema.validate(
+        input_schema={
+            "type": "object",
+            "properties": {
+                "ids": {
+                    "type": "array",
+                    "items": {"type": "number"},
+                    "maxItems": MAX_GAMES
+                },
+                "team": {"type": "string"},
+                "player": {"type": "string"},
+                "date_from": {"type": "string"},
+                "date_to": {"type": "string"},
+                "limit": {"type": "number"},
+                "cursor": {"type": ["string", "null"]},
+            }
+        },
+        input_example={
+            "team": "Red",
+            "date_from": "2015-06-01",
+            "date_to": "2015-06-30",
+            "limit": 20
+        },
+        output_schema={
+            "type": "object",
+            "properties": {
+                "games": {"type": "array"},
+                "cursor": {"type": ["string", "null"]}
+            }
+        },
+        output_example={
+            "games": [
+                {
+                    "id": 7,
+                    "teams": ["Blue", "Red"],
+                    "host": "alice",
+                    "location": "Park",
+                    "date": "2015-06-13",
+                    "accepted_players": ["alice", "bob"],
+                    "cancelled": False,
+                    "final_score": ""
+                }
+            ],
+            "cursor": "7"
+        }
+    )
+    @coroutine
+    def post(self):
+        """
+        POST to get many games at once, each like `GET /api/game/game/<id>`
+
+        Either by ID:
+
+        * `ids`: Array of up to 100 game IDs; games that don't exist are
+          left out
+
+        Or all games matching every one of the given filters, by ID:
+
+        * `team`: Name of one of the teams
+        * `player`: Username of a player on either team
+        * `date_from`, `date_to`: Inclusive, in YYYY-MM-DD format
+        * `limit`: Number of games to return; default 20, at most 100
+        * `cursor`: From the previous page, to get the next one; `null`
+          in the output when there are no more games
+        """
+        attrs = dict(self.body)
+
+        if "ids" in attrs:
+            games = yield self.db_read(
+                get_games, [int(game_id) for game_id in attrs["ids"]]
+            )
+            raise gen.Return({"games": games, "cursor": None})
+
+        filters = {k: attrs[k] for k in ("team", "player") if k in attrs}
+        for k in ("date_from", "date_to"):
+            if k in attrs:
+                try:
+                    filters[k] = parse_date(attrs[k])
+                except ValueError as err:
+                    raise APIError(400, log_message=str(err))
+        if attrs.get("cursor") is not None:
+            try:
+                filters["after"] = int(attrs["cursor"])
+            except ValueError:
+                raise APIError(400, log_message="Invalid cursor")
+        limit = max(1, min(int(attrs.get("limit", 20)), MAX_GAMES))
+
+        games, more = yield self.db_read(find_games, limit=limit, **filters)
+        raise gen.Return({
+            "games": games,
+            "cursor": str(games[-1]["id"]) if more else None
+        })
 
-        return game_dict
+
+class Export(APIHandler):
+
+    # Every chunk runs the same queries
+    check_n_plus_one = False
+
+    @schema.validate(
+        # Of each line
+        output_schema={
+            "type": "object",
+            "properties": {
+                "id": {"type": "number"},
+                "teams": {"type": "array"},
+                "host": {"type": "string"},
+                "location": {"type": "string"},
+                "date": {"type": "string"},
+                "accepted_players": {"type": "array"},
+                "cancelled": {"type": "boolean"},
+                "final_score": {"type": "string"}
+            }
+        },
+        output_example={
+            "id": 7,
+            "teams": ["Blue", "Red"],
+            "host": "alice",
+            "location": "Park",
+            "date": "2015-06-13",
+            "accepted_players": ["alice", "bob"],
+            "cancelled": False,
+            "final_score": "{\"Blue\": 3, \"Red\": 1}"
+        }
+    )
+    @coroutine
+    def get(self):
+        """
+        GET all games as NDJSON (`application/x-ndjson`): one game per
+        line, like `GET /api/game/game/<id>`, ordered by ID; the output
+        schema is that of each line
+
+        Games are streamed in chunks as they are read, however many there
+        are. Optional query arguments, like the filters of
+        `POST /api/game/batch`:
+
+        * `team`: Name of one of the teams
+        * `player`: Username of a player on either team
+        * `date_from`, `date_to`: Inclusive, in YYYY-MM-DD format
+        * `after`: Only games with greater IDs, e.g., the last ID of an
+          interrupted export
+        """
+        filters = {}
+        for k in ("team", "player"):
+            value = self.get_query_argument(k, None)
+            if value:
+                filters[k] = value
+        for k in ("date_from", "date_to"):
+            value = self.get_query_argument(k, None)
+            if value:
+                try:
+                    filters[k] = parse_date(value)
+                except ValueError as err:
+                    raise APIError(400, log_message=str(err))
+        after = self.get_query_argument("after", None)
+        if after:
+            try:
+                after = int(after)
+            except ValueError:
+                raise APIError(400, log_message="Invalid after")
+        else:
+            after = None
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        more = True
+        while more:
+            # A short db_session per chunk
+            text, after, more = yield self.db_read(
+                export_chunk, after=after, **filters
+            )
+            if not text:
+                break
+            self.write(text)
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                # The client went away
+                break
+        # Instead of the JSend envelope of everything else; Finish here
+        #   is the handler below
+        raise tornado.web.Finish()
 
 
 class DateAndLoc(APIHandler):
@@ -82,6 +282,7 @@ class DateAndLoc(APIHandler):
             }
         }
     )
+    @coroutine
     def post(self):
         """(Game host only) Update date and location of game
 
@@ -90,8 +291,9 @@ class DateAndLoc(APIHandler):
         * `id`: ID of game to change
         """
         attrs = dict(self.body)
+        bus = self.settings['event_bus']
 
-        with db_session:
+        def update_game(username):
             game = GameEntity.get(id=attrs['id'])
             api_assert(
                 game is not None,
@@ -100,7 +302,7 @@ class DateAndLoc(APIHandler):
             )
 
             api_assert(
-                game.host.username == self.get_current_user(),
+                game.host.username == username,
                 403,
                 log_message="Only the host of this game may edit it!"
             )
@@ -115,7 +317,14 @@ class DateAndLoc(APIHandler):
 
             game.location = attrs['location']
             game.date = attrs['date']
-            commit()
+            after_commit(cache.invalidate, cache.game_key(game.id))
+            after_commit(bus.publish, game_players(game) - {username}, {
+                "type": "game",
+                "game_id": game.id,
+                "change": "updated",
+                "date": attrs['date'],
+                "location": attrs['location']
+            })
 
             game_dict = {k: v for k, v in game.to_dict().items() if k in [
                 "id",
@@ -126,6 +335,9 @@ class DateAndLoc(APIHandler):
 
             return game_dict
 
+        result = yield self.db_write_grouped(update_game, self.current_user)
+        raise gen.Return(result)
+
 
 class InviteRespond(APIHandler):
 
@@ -142,6 +354,7 @@ class InviteRespond(APIHandler):
             "type": "string"
         }
     )
+    @coroutine
     def post(self):
         """Decline or accept invite
 
@@ -149,30 +362,41 @@ class InviteRespond(APIHandler):
         * `decision`: Either "Accept" or "Decline"
         """
         attrs = dict(self.body)
+        bus = self.settings['event_bus']
 
-        with db_session:
+        def respond(username):
             game = GameEntity.get(id=attrs['id'])
-            me = PlayerEntity[self.get_current_user()]
+            me = PlayerEntity[username]
             api_assert(
                 game is not None,
                 400,
                 log_message="No such game {} exists!".format(attrs['id'])
             )
-            player_invites = get_player_invitations(me.username)
             api_assert(
-                attrs['id'] in player_invites,
+                is_invited(me.username, game.id),
                 400,
                 log_message="This game is not in your list of invitations!"
             )
 
             if attrs['decision'] == "Accept":
-                game.accepted_players.add(me)
-                return "You successfully joined game {}!".format(attrs['id'])
-            elif attrs['decision'] == "Decline":
-                game.cancelled = True
-                return "You declined and the game ({}) has been cancelled!".format(
+                accept(me, game)
+                message = "You successfully joined game {}!".format(
                     attrs['id']
                 )
+                event = {"change": "accepted", "player": username}
+            elif attrs['decision'] == "Decline":
+                cancel(game)
+                message = "You declined and the game ({}) has been " \
+                          "cancelled!".format(attrs['id'])
+                event = {"change": "cancelled"}
+            after_commit(cache.invalidate, cache.game_key(game.id))
+            after_commit(bus.publish, game_players(game) - {username},
+                         dict(event, type="game", game_id=game.id))
+
+            return message
+
+        result = yield self.db_write_grouped(respond, self.current_user)
+        raise gen.Return(result)
 
 
 class Finish(APIHandler):
@@ -183,7 +407,10 @@ class Finish(APIHandler):
             "type": "object",
             "properties": {
                 "id": {"type": "number"},
-                "final_score": {"type": "object"}
+                "final_score": {
+                    "type": "object",
+                    "additionalProperties": {"type": "number", "minimum": 0}
+                }
             }
         },
         input_example={
@@ -195,13 +422,15 @@ class Finish(APIHandler):
         },
         output_schema={"type": "string"}
     )
+    @coroutine
     def post(self):
         """
         (Game host only) POST to finalize game
         """
         attrs = dict(self.body)
+        bus = self.settings['event_bus']
 
-        with db_session:
+        def finish_game(username):
             game = GameEntity.get(id=attrs['id'])
             api_assert(
                 game is not None,
@@ -210,7 +439,7 @@ class Finish(APIHandler):
             )
 
             api_assert(
-                game.host.username == self.get_current_user(),
+                game.host.username == username,
                 403,
                 log_message="Only the host of this game may edit it!"
             )
@@ -228,6 +457,12 @@ class Finish(APIHandler):
                 "Not everyone has accepted invites for this game yet!"
             )
 
+            api_assert(
+                not game.final_score,
+                409,
+                log_message="Game has already been finished"
+            )
+
             team_names = [team.name for team in game.teams]
             team_a = TeamEntity[team_names[0]]
             team_b = TeamEntity[team_names[1]]
@@ -241,31 +476,31 @@ class Finish(APIHandler):
                     "{} is not part of this game!".format(team_name)
                 )
 
-            # Set wins, losses and ties
-            if final_score[team_a.name] > final_score[team_b.name]:
-                team_a.wins += 1
-                team_b.losses += 1
-            elif final_score[team_a.name] < final_score[team_b.name]:
-                team_b.wins += 1
-                team_a.losses += 1
-            else:
-                team_a.ties += 1
-                team_b.ties += 1
-
-            # Calculate new points_ratio
-            for team1, team2 in [(team_a, team_b), (team_b, team_a)]:
-                total_games = team1.wins + team1.losses + team1.ties
-                team1.points_ratio = (
-                    (
-                        team1.points_ratio * max(total_games, 0)
-                    ) + (
-                        final_score[team1.name] / final_score[team2.name]
-                    )
-                ) / total_games
+            record_result(team_a, team_b, final_score)
 
             # Set final score
             game.final_score = json.dumps(final_score)
+            scores.record(game, team_a, team_b, final_score)
+            generation = bump_rankings(team_a.sport.name)
+            commit()
+            refresh_team(team_a, generation)
+            refresh_team(team_b, generation)
+            cache.invalidate(
+                cache.game_key(game.id),
+                cache.team_key(team_a.name),
+                cache.team_key(team_b.name),
+                cache.sport_key(team_a.sport.name)
+            )
+            after_commit(bus.publish, game_players(game) - {username}, {
+                "type": "game",
+                "game_id": game.id,
+                "change": "finished",
+                "final_score": game.final_score
+            })
 
             return "Game results recorded with final score: {}".format(
                 json.dumps(final_score)
             )
+
+        result = yield self.db_write(finish_game, self.current_user)
+        raise gen.Return(result)
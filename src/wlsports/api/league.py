@@ -0,0 +1,138 @@
+from tornado import gen
+from wlsports import schema
+from tornado_json.exceptions import api_assert
+from tornado_json.gen import coroutine
+from tornado.web import authenticated, stream_request_body
+
+from wlsports import ratings
+from wlsports.handlers import APIHandler
+from wlsports.importer import Importer, RecordParser, KINDS
+
+
+# Streamed, so this does not need to fit in memory
+MAX_IMPORT_BYTES = 1024 ** 3
+
+
+@stream_request_body
+class Import(APIHandler):
+
+    @gen.coroutine
+    def prepare(self):
+        # The session has to be resolved before the body streams in
+        yield super(Import, self).prepare()
+        self._start_import()
+
+    @authenticated
+    def _start_import(self):
+        self.assert_admin()
+        self.request.connection.set_max_body_size(MAX_IMPORT_BYTES)
+
+        kind = self.get_query_argument("type", None)
+        api_assert(
+            kind is None or kind in KINDS,
+            400,
+            log_message="type must be one of {}".format(", ".join(KINDS))
+        )
+        content_type = self.request.headers.get("Content-Type", "")
+        self._parser = RecordParser(
+            "csv" if content_type.startswith("text/csv") else "ndjson",
+            kind=kind
+        )
+        self._importer = Importer(
+            self.settings['password_hasher'],
+            self.db_read,
+            self.db_write
+        )
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        # Yielding here holds off reading more of the body until the
+        #   current batch has been inserted
+        for row in self._parser.feed(chunk):
+            yield self._importer.add(*row)
+
+    @schema.validate(
+        input_schema=None,
+        output_schema={
+            "type": "object",
+            "properties": {
+                "imported": {
+                    "type": "object",
+                    "properties": {
+                        "players": {"type": "number"},
+                        "teams": {"type": "number"},
+                        "games": {"type": "number"}
+                    }
+                },
+                "errors": {"type": "array"},
+                "error_count": {"type": "number"}
+            }
+        },
+        output_example={
+            "imported": {"players": 2, "teams": 1, "games": 0},
+            "errors": [
+                {"line": 3, "error": "Username bob is already taken"}
+            ],
+            "error_count": 1
+        }
+    )
+    @coroutine
+    def post(self):
+        """
+        (Admin only) POST players, teams and historical games in bulk
+
+        The body is streamed and inserted in batches as it arrives. Records
+        that fail are skipped and listed in `errors` by line number; the
+        rest are imported regardless.
+
+        * NDJSON (default): one object per line, each with a `type` of
+          `player`, `team` or `game`. Players have the same fields as
+          `PUT /api/player/player`, teams the same as `PUT /api/team/team`
+          (any existing sport). Games have `teams` (two team names),
+          `final_score` (team name to score) and optionally `host`
+          (defaults to a player of either team), `date` and `location`.
+        * CSV (`Content-Type: text/csv`): a header line, then one record
+          per line, with a `type` column or `?type=` for the whole body.
+          Team `usernames` are separated by `;`; games have the columns
+          `team_a`, `team_b`, `score_a` and `score_b` instead of `teams`
+          and `final_score`.
+        """
+        for row in self._parser.close():
+            yield self._importer.add(*row)
+        yield self._importer.flush()
+
+        raise gen.Return(self._importer.report())
+
+
+class Recompute(APIHandler):
+
+    @authenticated
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "teams": {"type": "number"},
+                "games": {"type": "number"},
+                "skipped": {"type": "number"},
+                "seconds": {"type": "number"}
+            }
+        },
+        output_example={
+            "teams": 1200,
+            "games": 48000,
+            "skipped": 2,
+            "seconds": 0.4
+        }
+    )
+    @coroutine
+    def post(self):
+        """
+        (Admin only) POST to rebuild the wins, losses, ties and points
+        ratios of all teams from the final scores of all finished games
+
+        Games count in the order they were created in. Games whose final
+        score can't be counted (e.g., it isn't a number) are `skipped`.
+        """
+        self.assert_admin()
+        report = yield self.db_write(ratings.recompute)
+        raise gen.Return(report)
@@ -0,0 +1,18 @@
+from tornado.web import RequestHandler
+
+
+URL = r"/api/metrics/?"
+
+
+class Metrics(RequestHandler):
+    """Metrics of this server process for Prometheus to scrape; see
+    wlsports.metrics
+
+    Not a ViewHandler, so that get_routes doesn't route it at
+    /api/metrics/metrics too; make_application in app.py routes it at
+    ``URL``, like events.Socket.
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.settings['metrics'].render())
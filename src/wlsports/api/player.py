@@ -1,11 +1,13 @@
-import bcrypt
+from tornado import gen
 from tornado_json.exceptions import api_assert, APIError
-from tornado_json import schema
-from pony.orm import db_session, CommitException, select
+from wlsports import schema
+from tornado_json.gen import coroutine
 from tornado.web import authenticated
 
 from wlsports.db import Player as PlayerEntity
 from wlsports.handlers import APIHandler
+from wlsports.invitations import get_player_invitations
+from wlsports.search import MAX_LIMIT, search_players
 
 
 class Player(APIHandler):
@@ -41,6 +43,7 @@ class Player(APIHandler):
             }
         }
     )
+    @coroutine
     def put(self):
         """
         PUT the required parameters to permanently register a new player
@@ -56,38 +59,31 @@ class Player(APIHandler):
         * `bio`
         """
         attrs = dict(self.body)
+        api_assert(
+            attrs['username'],
+            400,
+            log_message="Provided username is empty!"
+        )
+        # Check before hashing so taken usernames don't cost a bcrypt round
+        yield self.db_read(_assert_username_free, attrs['username'])
 
         # Set salt and password
-        salt = bcrypt.gensalt(rounds=12)
-        attrs['password'] = bcrypt.hashpw(
-            password=attrs['password'].encode(),
-            salt=salt
-        ).decode()
-        attrs['salt'] = salt.decode()
+        attrs['salt'], attrs['password'] = \
+            yield self.settings['password_hasher'].hash_password(
+                attrs['password']
+            )
 
         # Create player
-        with db_session:
-            api_assert(
-                attrs['username'],
-                400,
-                log_message="Provided username is empty!"
-            )
-            if PlayerEntity.get(username=attrs['username']):
-                raise APIError(
-                    409,
-                    log_message="Player with username {} already exists!"
-                    .format(attrs['username'])
-                )
-            player = PlayerEntity(**attrs)
+        def create_player():
+            _assert_username_free(attrs['username'])
+            PlayerEntity(**attrs)
+
+        yield self.db_write(create_player)
 
         # Log the user in
-        self.set_secure_cookie(
-            "user",
-            attrs['username'],
-            self.settings['app_config'].session_timeout_days
-        )
+        yield self.start_session(attrs['username'])
 
-        return {"username": player.username}
+        raise gen.Return({"username": attrs['username']})
 
 
 class Me(APIHandler):
@@ -111,6 +107,7 @@ class Me(APIHandler):
             }
         }
     )
+    @coroutine
     def get(self):
         """
         (Player only) GET to retrieve player info
@@ -118,15 +115,19 @@ class Me(APIHandler):
         * `games`: Array of game IDs that player has accepted
         * `teams`: Array of team names
         """
-        with db_session:
-            player = PlayerEntity[self.get_current_user()]
+        def get_player(username):
+            player = PlayerEntity[username]
             player_dict = player.to_dict(
-                exclude=["salt", "password"],
+                exclude=["salt", "password", "invitations",
+                         "sessions"],
                 with_collections=True
             )
             player_dict['birthday'] = str(player_dict['birthday'])
+            return player_dict
+
+        player_dict = yield self.db_read(get_player, self.current_user)
 
-        return player_dict
+        raise gen.Return(player_dict)
 
 
 class Search(APIHandler):
@@ -135,24 +136,69 @@ class Search(APIHandler):
         input_schema={
             "type": "object",
             "properties": {
-                "query": {"type": "string"}
-            }
+                "query": {"type": "string"},
+                "limit": {"type": "integer", "minimum": 1,
+                          "maximum": MAX_LIMIT},
+                "cursor": {"type": ["string", "null"]},
+                "paginate": {"type": "boolean"},
+            },
+            "required": ["query"],
+        },
+        input_example={
+            "query": "jo van",
+            "limit": 10
         },
         output_schema={
-            "type": "array"
-        }
+            "oneOf": [
+                {"type": "array"},
+                {
+                    "type": "object",
+                    "properties": {
+                        "usernames": {"type": "array"},
+                        "cursor": {"type": ["string", "null"]},
+                    }
+                }
+            ]
+        },
+        output_example=["johnny", "jo_vancity"]
     )
+    @coroutine
     def post(self):
         """
-        Search for players whose name starts with query
+        Search for players by username, first and last name, and city
+
+        Each word of `query` has to match the start of a word in one of
+        those fields; best matches come first.
+
+        * `query`
+        * `limit`: Maximum number of results (default 10, at most 50)
+        * `paginate`: (Optional) If true, an object of the `usernames`
+          and a `cursor` for the next page is returned instead of an
+          array of usernames, e.g.,
+          `{"usernames": ["johnny"], "cursor": "10"}`
+        * `cursor`: `cursor` from the previous page to get the next one
+          (implies `paginate`); it is `null` when there are no more
+          results
         """
-        with db_session:
-            usernames = select(
-                p.username for p in PlayerEntity
-                if p.username.startswith(self.body['query'])
-            )[:]
+        try:
+            offset = int(self.body.get('cursor') or 0)
+        except ValueError:
+            offset = -1
+        api_assert(offset >= 0, 400, log_message="Invalid cursor")
+
+        usernames, next_offset = yield self.db_read(
+            search_players,
+            self.body['query'],
+            limit=self.body.get('limit', 10),
+            offset=offset
+        )
 
-        return usernames
+        if not self.body.get('paginate') and 'cursor' not in self.body:
+            raise gen.Return(usernames)
+        raise gen.Return({
+            "usernames": usernames,
+            "cursor": str(next_offset) if next_offset is not None else None
+        })
 
 
 class Invitations(APIHandler):
@@ -163,23 +209,21 @@ class Invitations(APIHandler):
             "type": "array"
         }
     )
+    @coroutine
     def get(self):
         """
         GET array of IDs for open game invitations for self
         """
-        username = self.get_current_user()
-        with db_session:
-            return get_player_invitations(username)
-
-
-def get_player_invitations(username):
-    player = PlayerEntity[username]
-    teams = player.teams
-    team_games = [game for team in teams for game in team.games]
-    # Get games that the team is added for that have not been
-    # cancelled
-    team_game_ids = {game.id for game in team_games
-                     if game.cancelled is not True}
-    player_accepted_ids = {game.id for game in player.accepted_games}
-
-    return list(team_game_ids - player_accepted_ids)
+        invitations = yield self.db_read(
+            get_player_invitations, self.current_user
+        )
+        raise gen.Return(invitations)
+
+
+def _assert_username_free(username):
+    if PlayerEntity.get(username=username):
+        raise APIError(
+            409,
+            log_message="Player with username {} already exists!"
+            .format(username)
+        )
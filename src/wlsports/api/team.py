@@ -1,18 +1,24 @@
-from collections import defaultdict
-from random import choice, randint
+import hashlib
 
+from tornado import gen
 from tornado_json.exceptions import api_assert, APIError
-from tornado_json import schema
-from pony.orm import db_session, CommitException, select, commit
-from tornado.web import authenticated
+from wlsports import schema
+from tornado_json.gen import coroutine
+from pony.orm import commit, flush
+from tornado.web import Finish, authenticated
 
+from wlsports import cache, generations, leaderboard, matchqueue, scores
+from wlsports.dal import after_commit
 from wlsports.db import Team as TeamEntity
 from wlsports.db import Player as PlayerEntity
 from wlsports.db import Sport as SportEntity
 from wlsports.db import Game as GameEntity
 
 from wlsports.handlers import APIHandler
-from wlsports.util import invert_dict_nonunique
+from wlsports.invitations import invite_teams
+from wlsports.matchmaking import conflicting_teams, find_rival
+from wlsports.ranking import get_index, refresh_team
+from wlsports.ranking import bump as bump_rankings
 
 
 class Team(APIHandler):
@@ -35,6 +41,7 @@ class Team(APIHandler):
             }
         }
     )
+    @coroutine
     def put(self):
         """
         PUT to create a team
@@ -45,7 +52,7 @@ class Team(APIHandler):
         """
         attrs = dict(self.body)
 
-        with db_session:
+        def create_team():
             if TeamEntity.get(name=attrs['name']):
                 raise APIError(
                     409,
@@ -77,9 +84,17 @@ class Team(APIHandler):
                 ties=0,
                 points_ratio=0.0
             )
+            generation = bump_rankings(sport.name)
+            commit()
+            refresh_team(team, generation)
+            cache.invalidate(cache.team_key(team.name),
+                             cache.sport_key(sport.name))
 
             return {'name': team.name}
 
+        result = yield self.db_write(create_team)
+        raise gen.Return(result)
+
     @schema.validate(
         output_schema={
             "type": "object",
@@ -95,11 +110,15 @@ class Team(APIHandler):
             }
         },
     )
+    @coroutine
     def get(self, name):
         """
         Get team with `name`
         """
-        with db_session:
+        key = cache.team_key(name)
+
+        def get_team():
+            versions = cache.versions(key)
             team = TeamEntity.get(name=name)
             if team is None:
                 raise APIError(
@@ -108,16 +127,20 @@ class Team(APIHandler):
                     .format(name)
                 )
 
-            team_dict = team.to_dict(with_collections=True)
+            team_dict = team.to_dict(
+                with_collections=True, exclude=["scores", "opponent_scores"]
+            )
             team_dict["usernames"] = team_dict.pop("users")
-            rankings = {k: i for i, (k, v) in enumerate(sorted(
-                get_team_rankings(team, filter_for_matchmaking=False).items(),
-                key=lambda x: x[1]
-            ))}
-            my_ranking = rankings[team.name]
+            # The ranking also depends on every other team of the sport
+            versions += cache.versions(cache.sport_key(team.sport.name))
+            rankings = get_index(team.sport.name)
+            my_ranking = rankings.position(team.name)
             team_dict["ranking"] = "{}/{}".format(my_ranking+1, len(rankings))
 
-            return team_dict
+            return team_dict, versions
+
+        team_dict = yield self.get_cached(key, get_team)
+        raise gen.Return(team_dict)
 
 
 class Matchmake(APIHandler):
@@ -137,6 +160,7 @@ class Matchmake(APIHandler):
             }
         }
     )
+    @coroutine
     def post(self):
         """
         Does matchmaking by finding a rival team for the provided `team_name`,
@@ -144,95 +168,375 @@ class Matchmake(APIHandler):
         for that game
         """
         team_name = self.body['team_name']
-        with db_session:
+        bus = self.settings['event_bus']
+
+        def matchmake(username):
             myteam = TeamEntity.get(name=team_name)
             api_assert(
-                PlayerEntity[self.get_current_user()] in myteam.users,
+                myteam is not None,
+                400,
+                log_message="Team with name {} does not exist!"
+                .format(team_name)
+            )
+            me = PlayerEntity[username]
+            api_assert(
+                me in myteam.users,
                 403,
                 log_message="You can only matchmake for teams that you are"
                             " a part of!"
             )
-            overall_rankings = get_team_rankings(myteam)
-            myranking = overall_rankings[myteam.name]
-
-            ranking_vals = overall_rankings.values()
-            rankings_by_ranking = invert_dict_nonunique(overall_rankings)
-
-            who_you_verse_index = None
-            print(overall_rankings)
-            while (who_you_verse_index not in ranking_vals):
-                print(who_you_verse_index)
-                from time import sleep
-                sleep(0.4)
-                if len(rankings_by_ranking) == 1:
-                    who_you_verse_index = myranking
-                else:
-                    who_you_verse_index = choice(
-                        [rval for rval in ranking_vals
-                         if rval != myranking and
-                         abs(rval - myranking) <= 10]
-                    )
-
-            rival_team_name = rankings_by_ranking[who_you_verse_index][0]
-            if rival_team_name == myteam.name:
-                rival_team_name = rankings_by_ranking[who_you_verse_index][1]
+
+            # Find a team close in ranking that doesn't contain any
+            #   players from myteam
+            rival_team_name = find_rival(
+                get_index(myteam.sport.name),
+                myteam.name,
+                conflicting_teams(myteam.name)
+            )
+            api_assert(
+                rival_team_name is not None,
+                409,
+                "There are no other teams with all different people!"
+            )
             rival_team = TeamEntity[rival_team_name]
 
             game = GameEntity(
                 teams=[myteam, rival_team],
-                host=PlayerEntity[self.get_current_user()],
-                accepted_players=[PlayerEntity[self.get_current_user()]]
+                host=me,
+                accepted_players=[me]
+            )
+            invite_teams(game)
+            # For the game's ID
+            flush()
+            after_commit(
+                cache.invalidate,
+                cache.game_key(game.id),
+                cache.team_key(myteam.name),
+                cache.team_key(rival_team.name)
+            )
+            after_commit(
+                bus.publish,
+                [i.player.username for i in game.invitations],
+                {"type": "invitation", "game_id": game.id}
             )
-            commit()
 
             return {"game_id": game.id}
 
+        result = yield self.db_write_grouped(matchmake, self.current_user)
+        raise gen.Return(result)
 
-def get_team_rankings(myteam, filter_for_matchmaking=True):
-    team_name = myteam.name
-    sport_name = myteam.sport.name
-    if myteam is None:
-        raise APIError(
-            400,
-            log_message="Team with name {} does not exist!"
-            .format(team_name)
-        )
 
-    ### Figure out rival team
-
-    # Find teams that are of the same sport and also
-    # that they don't contain any players from myteam
-    sport_teams = select(team for team in TeamEntity
-                         if team.sport.name == sport_name)[:]
-    print sport_teams, [[player.username for player in team.users] for team in sport_teams ]
-
-    if filter_for_matchmaking:
-        myteam_names = [player.username for player in myteam.users]
-        print myteam_names
-        sport_teams = [team for team in sport_teams if all(
-            player.username not in myteam_names for player in team.users
-        )]
-        print sport_teams
-        sport_teams.append(myteam)
-        num_teams = len(sport_teams)
+# Output of MatchQueue and Ticket
+_TICKET_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "ticket": {"type": "string"},
+        "team": {"type": "string"},
+        "status": {"enum": [matchqueue.WAITING, matchqueue.MATCHED,
+                            matchqueue.FAILED, matchqueue.CANCELLED]},
+        "game_id": {"type": ["number", "null"]},
+        "reason": {"type": ["string", "null"]}
+    }
+}
+
+
+class MatchQueue(APIHandler):
+
+    @authenticated
+    @schema.validate(
+        input_schema={
+            "type": "object",
+            "properties": {
+                "team_name": {"type": "string"}
+            },
+            "required": ["team_name"]
+        },
+        output_schema=_TICKET_SCHEMA,
+        output_example={
+            "ticket": "5f0c3b9e8a7d41c2b6e0d9f4a1c7e352",
+            "team": "Red",
+            "status": "waiting",
+            "game_id": None,
+            "reason": None
+        }
+    )
+    @coroutine
+    def post(self):
+        """
+        Queue team `team_name` for matchmaking, and get a ticket for it
+
+        Like Matchmake, but teams that queue around the same time are
+        matched together, with each other where they are close enough in
+        ranking, about a second later. GET the ticket at
+        `/api/team/ticket/<ticket>`, or wait for a `matchmaking` event
+        (see `/api/events/poll`), until its `status` changes from
+        `waiting` to `matched`, with the `game_id` of the new game
+        (hosted by whoever queued the team), or `failed`, with the
+        `reason`.
+
+        If the team is queued already, its ticket is returned.
+        """
+        team_name = self.body['team_name']
+
+        def check_team(username):
+            team = TeamEntity.get(name=team_name)
+            api_assert(
+                team is not None,
+                400,
+                log_message="Team with name {} does not exist!"
+                .format(team_name)
+            )
+            players = [p.username for p in team.users]
+            api_assert(
+                username in players,
+                403,
+                log_message="You can only matchmake for teams that you are"
+                            " a part of!"
+            )
+            return team.sport.name, players
+
+        sport, players = yield self.db_read(check_team, self.current_user)
+        ticket = self.settings['match_queue'].submit(
+            team_name, sport, self.current_user, players)
+        raise gen.Return(ticket.to_dict())
+
+
+class Ticket(APIHandler):
+
+    @authenticated
+    @schema.validate(
+        output_schema=_TICKET_SCHEMA,
+        output_example={
+            "ticket": "5f0c3b9e8a7d41c2b6e0d9f4a1c7e352",
+            "team": "Red",
+            "status": "matched",
+            "game_id": 42,
+            "reason": None
+        }
+    )
+    def get(self, ticket):
+        """
+        GET matchmaking `ticket` of one of your teams; see MatchQueue
+
+        Tickets are forgotten some time after they are settled.
+        """
+        return self._get_ticket(ticket).to_dict()
+
+    @authenticated
+    @schema.validate(
+        output_schema=_TICKET_SCHEMA,
+    )
+    def delete(self, ticket):
+        """
+        DELETE matchmaking `ticket` to take its team out of the queue; the
+        ticket is then `cancelled`. A 409 means the team is being
+        matched already.
+        """
+        ticket = self._get_ticket(ticket)
         api_assert(
-            num_teams > 1,
+            self.settings['match_queue'].cancel(ticket),
             409,
-            "There are no other teams with all different people!"
+            log_message="Ticket {} is {} already".format(
+                ticket.id,
+                "being matched" if ticket.status == matchqueue.WAITING
+                else ticket.status
+            )
+        )
+        return ticket.to_dict()
+
+    def _get_ticket(self, ticket_id):
+        ticket = self.settings['match_queue'].get(ticket_id)
+        # Someone else's ticket might as well not exist
+        api_assert(
+            ticket is not None and self.current_user in ticket.players,
+            400,
+            log_message="No such ticket {}".format(ticket_id)
         )
+        return ticket
+
+
+class Leaderboard(APIHandler):
+
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": {
+                "sport": {"type": "string"},
+                "version": {"type": "string"},
+                "total": {"type": "number"},
+                "teams": {"type": "array"},
+                "cursor": {"type": ["string", "null"]},
+            }
+        },
+        output_example={
+            "sport": "Soccer",
+            "version": "3f2a9c0d51e87b64",
+            "total": 42,
+            "teams": [
+                {"ranking": 1, "name": "Red", "city": "Vancouver", "wins": 9,
+                 "losses": 1, "ties": 0, "points_ratio": 2.75}
+            ],
+            "cursor": "1"
+        }
+    )
+    @coroutine
+    def get(self):
+        """
+        GET teams of a sport in ranking order, a page at a time
+
+        Query arguments:
+
+        * `sport`: Name of the sport
+        * `limit`: (Optional) Teams per page; defaults to 20, at most 100
+        * `offset` or `cursor`: (Optional) Number of teams to skip, or
+          `cursor` from the previous page to get the next one; `cursor`
+          is `null` on the last page
+        * `city`: (Optional) Only teams from this city, i.e., whose
+          players mostly live there
+
+        Pages are served from a snapshot of the standings that changes
+        when results are recorded or teams are added; `version`
+        identifies it, and is part of the ETag of every page. `total` is
+        the number of teams matching `city`.
+        """
+        sport = self.get_query_argument("sport", "")
+        api_assert(sport, 400, log_message="sport is required")
+        city = self.get_query_argument("city", None) or None
+        try:
+            limit = int(self.get_query_argument(
+                "limit", leaderboard.DEFAULT_LIMIT))
+            offset = int(self.get_query_argument("cursor", None) or
+                         self.get_query_argument("offset", 0))
+        except ValueError:
+            raise APIError(400, log_message="limit, offset and cursor must "
+                                            "be integers")
+        api_assert(1 <= limit <= leaderboard.MAX_LIMIT, 400,
+                   log_message="limit must be between 1 and {}".format(
+                       leaderboard.MAX_LIMIT))
+        api_assert(offset >= 0, 400, log_message="Invalid offset or cursor")
+
+        snapshot = None
+        if not generations.is_shared():
+            snapshot = leaderboard.current_snapshot(sport)
+        if snapshot is None:
+            snapshot = yield self.db_read(leaderboard.get_snapshot, sport)
+        api_assert(snapshot is not None, 400,
+                   log_message="No such sport {}".format(sport))
+
+        self.set_header("Etag", '"{}-{}-{}-{}"'.format(
+            snapshot.version, offset, limit,
+            hashlib.sha1((city or "").encode("utf-8")).hexdigest()[:8]
+        ))
+        if self.check_etag_header():
+            self.set_status(304)
+            raise Finish()
+
+        teams, total = snapshot.page(offset, limit, city)
+        raise gen.Return({
+            "sport": sport,
+            "version": snapshot.version,
+            "total": total,
+            "teams": teams,
+            "cursor": str(offset + limit) if offset + limit < total else None,
+        })
+
+
+# Output of Stats and HeadToHead
+_RECORD_PROPERTIES = {
+    "games": {"type": "number"},
+    "wins": {"type": "number"},
+    "losses": {"type": "number"},
+    "ties": {"type": "number"},
+    "points_for": {"type": "number"},
+    "points_against": {"type": "number"}
+}
+
+
+def _get_team_or_400(name):
+    team = TeamEntity.get(name=name)
+    if team is None:
+        raise APIError(
+            400,
+            log_message="Team with name {} does not exist!".format(name)
+        )
+    return team
+
+
+class Stats(APIHandler):
+
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": dict(_RECORD_PROPERTIES, name={"type": "string"})
+        },
+        output_example={
+            "name": "Red",
+            "games": 12,
+            "wins": 7,
+            "losses": 4,
+            "ties": 1,
+            "points_for": 31.0,
+            "points_against": 22.0
+        }
+    )
+    @coroutine
+    def get(self, name):
+        """
+        GET the record of team with `name` over all of its finished games:
+        numbers of `games`, `wins`, `losses` and `ties`, and the total
+        points scored by it (`points_for`) and against it
+        (`points_against`)
+        """
+        key = "{}:stats".format(cache.team_key(name))
+
+        def get_stats():
+            versions = cache.versions(cache.team_key(name))
+            team = _get_team_or_400(name)
+            # Imports only invalidate the standings of the sport
+            versions += cache.versions(cache.sport_key(team.sport.name))
+            return dict(scores.team_record(name), name=name), versions
+
+        stats = yield self.get_cached(key, get_stats)
+        raise gen.Return(stats)
+
+
+class HeadToHead(APIHandler):
+
+    @schema.validate(
+        output_schema={
+            "type": "object",
+            "properties": dict(_RECORD_PROPERTIES,
+                               name={"type": "string"},
+                               opponent={"type": "string"})
+        },
+        output_example={
+            "name": "Red",
+            "opponent": "Blue",
+            "games": 3,
+            "wins": 2,
+            "losses": 1,
+            "ties": 0,
+            "points_for": 9.0,
+            "points_against": 6.0
+        }
+    )
+    @coroutine
+    def get(self, name, opponent):
+        """
+        GET the record of team with `name` in its finished games against
+        team `opponent`, like Stats: `wins` and `points_for` are those
+        of `name`
+        """
+        key = "head-to-head:{}:{}".format(name, opponent)
+
+        def get_head_to_head():
+            versions = cache.versions(cache.team_key(name),
+                                      cache.team_key(opponent))
+            team = _get_team_or_400(name)
+            _get_team_or_400(opponent)
+            versions += cache.versions(cache.sport_key(team.sport.name))
+            record = scores.head_to_head(name, opponent)
+            return dict(record, name=name, opponent=opponent), versions
 
-    overall_rankings = defaultdict(lambda: 0)
-
-    teams_wlratio = sorted([
-        (team, float(team.wins) / (team.losses or 1))
-        for team in sport_teams
-    ], key=lambda t: t[1], reverse=True)
-    for i, (team, wlratio) in enumerate(teams_wlratio):
-        overall_rankings[team.name] += i
-    teams_pointsratio = sorted([
-        (team, team.points_ratio) for team in sport_teams
-    ], key=lambda t: t[1], reverse=True)
-    for i, (team, points_ratio) in enumerate(teams_pointsratio):
-        overall_rankings[team.name] += i
-
-    return overall_rankings
+        record = yield self.get_cached(key, get_head_to_head)
+        raise gen.Return(record)
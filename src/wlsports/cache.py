@@ -0,0 +1,123 @@
+"""Response cache for frequently polled GET resources
+
+Entries hold the serialized JSend response for a resource together with
+the generations (see wlsports.generations) of every resource it was
+built from, e.g., a team's page depends on the team itself and on the
+standings of its sport. An entry is only served while all of those
+generations are unchanged; write paths call ``invalidate()`` for what
+they changed once the change is committed.
+
+Generations must be read with ``versions()`` *before* reading the data
+they guard: a change committed in between then merely invalidates the
+fresh entry, instead of leaving a stale one behind.
+
+Every response carries an ETag derived from its body, so clients that
+send it back in If-None-Match get a 304 while the entry is current.
+"""
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+
+from tornado.escape import json_encode
+
+from wlsports import generations
+
+
+CachedResponse = namedtuple(
+    "CachedResponse",
+    ["body", "etag", "versions"]
+)
+
+
+def game_key(game_id):
+    return "game:{}".format(game_id)
+
+
+def team_key(team_name):
+    return "team:{}".format(team_name)
+
+
+def sport_key(sport_name):
+    """Standings (wins, losses, ratios, rankings) of teams of a sport"""
+    return "sport:{}".format(sport_name)
+
+
+def versions(*keys):
+    """Current generations of ``keys``, for ``ResponseCache.put``"""
+    return tuple((key, generations.current(key)) for key in keys)
+
+
+def invalidate(*keys):
+    """Mark cached responses depending on ``keys`` as out of date
+
+    Call after the change has been committed. With shared generations,
+    this needs a db_session.
+    """
+    for key in keys:
+        generations.bump(key)
+
+
+class ResponseCache(object):
+    """LRU of CachedResponse by resource key"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Cached response for ``key`` if it is still current, else ``None``
+
+        With shared generations, this needs a db_session.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # Most recently used entries go last
+                self._entries[key] = entry
+        if entry is not None and entry.versions != versions(
+                *(k for k, _ in entry.versions)):
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, data, versions):
+        """Cache ``data`` as the response for ``key``
+
+        :param versions: From ``versions()``, read before ``data`` was
+        :rtype: CachedResponse
+        """
+        # Same envelope JSendMixin.success writes
+        body = json_encode({"status": "success", "data": data})
+        entry = CachedResponse(
+            body=body,
+            etag='"{}"'.format(hashlib.sha1(body.encode("utf-8")).hexdigest()),
+            versions=versions
+        )
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -3,5 +3,50 @@ from collections import namedtuple
 
 Config = namedtuple(
     'Config',
-    ['port', 'db_file', 'session_timeout_days', 'cookie_secret', 'debug']
+    ['port', 'db_file', 'session_timeout_days', 'cookie_secret', 'debug',
+     'workers', 'hash_workers', 'sqlite', 'db_read_threads',
+     'db_write_threads', 'db_max_pending', 'response_cache_size', 'admins',
+     'n_plus_one_threshold', 'output_validation_rate',
+     'session_cache_size', 'db_group_commit', 'db_group_commit_window',
+     'matchmaking_interval']
 )
+
+# PRAGMAs applied to every SQLite connection; see
+#   wlsports.db.use_sqlite_profile
+SQLiteProfile = namedtuple(
+    'SQLiteProfile',
+    ['journal_mode', 'synchronous', 'mmap_size', 'cache_size',
+     'busy_timeout', 'temp_store']
+)
+
+SQLITE_PROFILES = {
+    # SQLite's own defaults: rollback journal, fsync on every commit
+    "durable": SQLiteProfile(
+        journal_mode="DELETE",
+        synchronous="FULL",
+        mmap_size=0,
+        cache_size=-2000,
+        busy_timeout=5000,
+        temp_store="DEFAULT",
+    ),
+    # Readers don't block the writer, and commits only fsync at
+    #   checkpoints; an OS crash can lose the last commits but never
+    #   corrupts the database
+    "wal": SQLiteProfile(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        mmap_size=256 * 1024 * 1024,
+        cache_size=-64000,
+        busy_timeout=5000,
+        temp_store="MEMORY",
+    ),
+    # No fsync at all; for benchmarks and throwaway databases
+    "fast": SQLiteProfile(
+        journal_mode="WAL",
+        synchronous="OFF",
+        mmap_size=256 * 1024 * 1024,
+        cache_size=-64000,
+        busy_timeout=5000,
+        temp_store="MEMORY",
+    ),
+}
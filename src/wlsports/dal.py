@@ -0,0 +1,312 @@
+"""Database access off the IOLoop
+
+Handlers hand units of work (plain functions) to a DataLayer and yield
+the returned future. Each unit runs inside its own db_session on a
+worker thread, so Pony's per-thread connections and sessions work as
+usual, and a slow query only holds up the request that made it.
+
+Reads and writes go through separate lanes: a pool of reader threads,
+and a writer pool that defaults to one thread since SQLite only allows
+one writer at a time anyway. Each lane accepts a bounded number of
+pending units; past that, requests fail fast with a 503 instead of
+queueing without limit.
+
+Units must not return entities, since their db_session is over by the
+time the handler gets the result; return plain values instead. Anything
+that has to wait for the commit (e.g., cache.invalidate) can be left to
+``after_commit``.
+
+Optionally, short writes that don't need a transaction of their own
+(``DataLayer.write_grouped``) are group committed: those queued by
+concurrent requests run one after the other in a single transaction, so
+a burst of them costs one commit (and fsync) instead of one each. See
+GroupCommit.
+"""
+# Imported by time.strptime on first use, which isn't thread safe on
+#   Python 2; Pony parses datetimes from SQLite with it, on the lanes'
+#   threads, and hands back the raw string if that fails
+import _strptime  # noqa: F401
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from pony.orm import db_session, flush, rollback
+from tornado_json.exceptions import APIError
+
+
+_local = threading.local()
+
+
+def after_commit(fn, *args, **kwargs):
+    """Run ``fn(*args, **kwargs)`` once the current unit of work has been
+    committed, in a db_session of its own
+
+    Only for units run by a DataLayer. Nothing runs if the unit fails;
+    if ``fn`` raises, the error is logged, as the unit has succeeded.
+    """
+    hooks = getattr(_local, "hooks", None)
+    if hooks is None:
+        raise RuntimeError("after_commit needs a DataLayer unit of work")
+    hooks.append((fn, args, kwargs))
+
+
+@contextmanager
+def _collecting_hooks(hooks):
+    previous = getattr(_local, "hooks", None)
+    _local.hooks = hooks
+    try:
+        yield
+    finally:
+        _local.hooks = previous
+
+
+def _run_hooks(hooks):
+    # The unit has been committed by now, so it succeeded whatever
+    #   happens here; a failing hook is logged rather than failing it
+    if hooks:
+        with db_session:
+            for fn, args, kwargs in hooks:
+                try:
+                    fn(*args, **kwargs)
+                except Exception:
+                    logging.exception("after_commit hook %r failed", fn)
+
+
+def _fail(future, exc_info):
+    if hasattr(future, "set_exception_info"):
+        # The futures backport keeps the traceback this way
+        future.set_exception_info(exc_info[1], exc_info[2])
+    else:
+        future.set_exception(exc_info[1])
+
+
+class Lane(object):
+    """Thread pool with a bounded number of pending units of work"""
+
+    def __init__(self, name, threads, max_pending):
+        self.name = name
+        self.threads = threads
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+
+    def submit(self, fn, *args, **kwargs):
+        self.admit()
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def admit(self):
+        """Count one more pending unit, or raise a 503 if there are too
+        many already
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise APIError(
+                    503,
+                    log_message="Server is busy; please try again"
+                )
+            self.pending += 1
+
+    def release(self, n=1):
+        with self._lock:
+            self.pending -= n
+
+    def run_later(self, fn, *args):
+        """Run ``fn(*args)`` on one of the lane's threads, without counting
+        it as a unit of work or opening a db_session
+        """
+        return self._executor.submit(fn, *args)
+
+    def _run(self, fn, args, kwargs):
+        try:
+            hooks = []
+            with _collecting_hooks(hooks):
+                with db_session:
+                    result = fn(*args, **kwargs)
+            _run_hooks(hooks)
+            return result
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "threads": self.threads,
+            "pending": self.pending,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class GroupCommit(object):
+    """Runs short write units of concurrent requests in shared transactions
+
+    Queued units are taken off in batches of up to ``max_units``, once
+    that many are queued or the oldest has waited ``window`` seconds,
+    whichever comes first; while the write lane is busy, more simply
+    pile up for the next batch. One batch runs at a time, on a thread of
+    the write lane, with its units one after the other in one db_session.
+
+    Each unit still gets its own result. If one raises, the transaction
+    is rolled back, that unit fails with its exception, and the rest of
+    the batch runs again without it, so the units that succeed only ever
+    see each other's changes. If the commit fails, every unit of the
+    batch fails with its error; once it has succeeded, so have they, and
+    failing ``after_commit`` hooks are only logged.
+
+    Units must not commit, and whatever they do past their database
+    changes has to be left to ``after_commit``, since they may run more
+    than once.
+    """
+
+    def __init__(self, lane, max_units, window):
+        self.lane = lane
+        self.max_units = max_units
+        self.window = window
+        self.batches = 0
+        self.units = 0
+        self.retries = 0
+        # (fn, args, kwargs, future, time queued)
+        self._queue = []
+        self._scheduled = False
+        self._ready = threading.Condition()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)`` for the next batch
+
+        :returns: Future for the return value of ``fn``, resolved once
+            its batch has been committed
+        """
+        self.lane.admit()
+        future = Future()
+        with self._ready:
+            self._queue.append((fn, args, kwargs, future, time.time()))
+            if len(self._queue) >= self.max_units:
+                self._ready.notify()
+            if not self._scheduled:
+                self._scheduled = True
+                self.lane.run_later(self._run_next)
+        return future
+
+    def _run_next(self):
+        with self._ready:
+            deadline = self._queue[0][4] + self.window
+            while len(self._queue) < self.max_units:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            batch = self._queue[:self.max_units]
+            del self._queue[:self.max_units]
+        try:
+            self._commit([unit[:4] for unit in batch])
+        finally:
+            self.lane.release(len(batch))
+            # Only now, so that batches never overlap, however many
+            #   threads the write lane has
+            with self._ready:
+                if self._queue:
+                    self.lane.run_later(self._run_next)
+                else:
+                    self._scheduled = False
+
+    def _commit(self, batch):
+        while batch:
+            results = []
+            hooks = []
+            failed = None
+            try:
+                with _collecting_hooks(hooks):
+                    with db_session:
+                        for i, (fn, args, kwargs, _) in enumerate(batch):
+                            try:
+                                results.append(fn(*args, **kwargs))
+                                flush()
+                            except Exception:
+                                failed = i, sys.exc_info()
+                                rollback()
+                                break
+            except Exception:
+                exc_info = sys.exc_info()
+                for _, _, _, future in batch:
+                    _fail(future, exc_info)
+                return
+
+            if failed is None:
+                # Committed; hook failures are only logged
+                _run_hooks(hooks)
+                self.batches += 1
+                self.units += len(batch)
+                for (_, _, _, future), result in zip(batch, results):
+                    future.set_result(result)
+                return
+            i, exc_info = failed
+            _fail(batch[i][3], exc_info)
+            batch = batch[:i] + batch[i + 1:]
+            # Those before it run again
+            self.retries += i
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "units": self.units,
+            "retries": self.retries,
+        }
+
+
+class DataLayer(object):
+    """Read and write lanes for db_session units of work"""
+
+    def __init__(self, read_threads=4, write_threads=1, max_pending=256,
+                 group_commit=0, group_commit_window=0.002):
+        """
+        :param group_commit: Most write_grouped units per transaction; 0
+            or 1 gives each its own, like ``write``
+        :param group_commit_window: Seconds a write_grouped unit may wait
+            for others to share its transaction
+        """
+        self.reads = Lane("read", read_threads, max_pending)
+        self.writes = Lane("write", write_threads, max_pending)
+        self.group_commit = None
+        if group_commit > 1:
+            self.group_commit = GroupCommit(
+                self.writes, group_commit, group_commit_window)
+
+    def read(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` in a db_session on the read lane
+
+        :returns: Future for the return value of ``fn``
+        """
+        return self.reads.submit(fn, *args, **kwargs)
+
+    def write(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` in a db_session on the write lane;
+        the session commits when ``fn`` returns
+
+        :returns: Future for the return value of ``fn``
+        """
+        return self.writes.submit(fn, *args, **kwargs)
+
+    def write_grouped(self, fn, *args, **kwargs):
+        """Like ``write``, but ``fn`` may share its transaction with those
+        of other requests, if group commit is on; see GroupCommit for
+        what ``fn`` must not do
+
+        :returns: Future for the return value of ``fn``
+        """
+        if self.group_commit is None:
+            return self.writes.submit(fn, *args, **kwargs)
+        return self.group_commit.submit(fn, *args, **kwargs)
+
+    def stats(self):
+        return {"read": self.reads.stats(), "write": self.writes.stats()}
+
+    def shutdown(self):
+        self.reads.shutdown()
+        self.writes.shutdown()
@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, datetime
 
 from pony.orm import Database, PrimaryKey, Required, Optional, sql_debug, \
     LongStr, Set
@@ -22,6 +22,8 @@ class Player(database.Entity):
 
     accepted_games = Set("Game", reverse="accepted_players")
     games_hosted = Set("Game", reverse="host")
+    invitations = Set("Invitation")
+    sessions = Set("Session")
 
 
 class Sport(database.Entity):
@@ -35,6 +37,8 @@ class Team(database.Entity):
     users = Set(Player)
     games = Set("Game")
     sport = Required(Sport)
+    scores = Set("GameScore", reverse="team")
+    opponent_scores = Set("GameScore", reverse="opponent")
 
     wins = Required(int)
     losses = Required(int)
@@ -48,12 +52,97 @@ class Game(database.Entity):
     host = Required(Player, reverse="games_hosted")
 
     location = Optional(str)
-    date = Optional(date)
+    date = Optional(date, index=True)
 
     accepted_players = Set(Player, reverse="accepted_games")
 
     cancelled = Optional(bool)
     final_score = Optional(str)
+    scores = Set("GameScore")
+
+    invitations = Set("Invitation")
+
+
+class Invitation(database.Entity):
+    """Open invitation of a player to a game
+
+    Materialized from team rosters, accepted players and cancellations
+    by wlsports.invitations
+    """
+    player = Required(Player)
+    game = Required(Game)
+    PrimaryKey(player, game)
+
+
+class GameScore(database.Entity):
+    """Score of one team of a finished game, against the other one
+
+    Written along with ``Game.final_score`` by wlsports.scores, so that
+    results can be aggregated in SQL
+    """
+    game = Required(Game)
+    team = Required(Team, reverse="scores")
+    opponent = Required(Team, reverse="opponent_scores")
+    points_for = Required(float)
+    points_against = Required(float)
+    PrimaryKey(game, team)
+    # Pony can't index floats; the index covering the aggregates of a
+    #   team comes from migration 2 (see wlsports.migrations)
+
+
+class Session(database.Entity):
+    """Login session; the ID is the value of the session cookie. See
+    wlsports.sessions
+    """
+    id = PrimaryKey(str)
+    player = Required(Player)
+    created = Required(datetime)
+    expires = Optional(datetime, index=True)
+
+
+class Generation(database.Entity):
+    """Named change counter for in-process caches; see
+    wlsports.generations
+    """
+    name = PrimaryKey(str)
+    value = Required(int)
+
+
+def use_sqlite_profile(profile):
+    """Apply PRAGMAs from ``profile`` (a wlsports.config.SQLiteProfile) to
+    every connection Pony opens from now on
+
+    Call before binding so that the first connection gets them too.
+    """
+    pragmas = [
+        "PRAGMA journal_mode = {}".format(profile.journal_mode),
+        "PRAGMA synchronous = {}".format(profile.synchronous),
+        "PRAGMA mmap_size = {:d}".format(profile.mmap_size),
+        "PRAGMA cache_size = {:d}".format(profile.cache_size),
+        "PRAGMA busy_timeout = {:d}".format(profile.busy_timeout),
+        "PRAGMA temp_store = {}".format(profile.temp_store),
+    ]
+
+    @database.on_connect(provider="sqlite")
+    def apply_sqlite_profile(db, connection):
+        cursor = connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+
+
+def create_sports():
+    """Create the sports teams can play if they don't exist yet; needs a
+    db_session
+    """
+    for name, players_per_team in [
+        ("Basketball", 5),
+        ("Soccer", 11)
+    ]:
+        if not Sport.get(name=name):
+            Sport(
+                name=name,
+                players_per_team=players_per_team
+            )
 
 
 def _bind_db(db="../../welikesports.sqlite", debug=True):
@@ -0,0 +1,129 @@
+"""Notifications of invitations and game changes, pushed to players
+
+Write paths publish an event for every player a change concerns once it
+has been committed (see wlsports.dal.after_commit), e.g., an invitation
+to a new game, or a teammate accepting one. Players subscribed through
+the long polling or WebSocket endpoints of wlsports.api.events get them
+as they happen, instead of polling their invitations and games.
+
+The bus lives in memory and only reaches subscribers of the same server
+process; with several worker processes, a player only hears about
+changes handled by the worker they are connected to. Events carry IDs
+that increase within a process, and the last few of each player are
+kept so that a client can pick up after the last one it saw; where that
+isn't possible (too many missed, or the server restarted), it is told to
+reset, i.e., to refetch its invitations and games.
+
+Everything except ``publish`` must be called on the IOLoop.
+"""
+from collections import OrderedDict, defaultdict, deque
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+
+def game_players(game):
+    """Usernames of everyone on ``game``'s teams, and its host; needs a
+    db_session
+    """
+    return {p.username for team in game.teams for p in team.users} | \
+        {game.host.username}
+
+
+class EventBus(object):
+    """Recent events and subscribers, by player"""
+
+    def __init__(self, backlog=20, max_players=10000, io_loop=None):
+        """
+        :param backlog: Most recent events kept per player
+        :param max_players: Most players events are kept for; those who
+            got none for the longest are forgotten first
+        """
+        self.backlog = backlog
+        self.max_players = max_players
+        self.io_loop = io_loop or IOLoop.current()
+        self.last_id = 0
+        self.published = 0
+        # Username to deque of their latest events
+        self._recent = OrderedDict()
+        # Username to ID of the last event dropped from their backlog
+        self._dropped = {}
+        # ID of the last event of any player who was forgotten
+        self._forgotten = 0
+        self._subscribers = defaultdict(set)
+
+    def publish(self, usernames, event):
+        """Send ``event`` (a dict, which gets an ``id``) to ``usernames``;
+        may be called from any thread
+        """
+        self.io_loop.add_callback(self._publish, list(usernames), event)
+
+    def _publish(self, usernames, event):
+        self.last_id += 1
+        self.published += 1
+        event = dict(event, id=self.last_id)
+        for username in usernames:
+            recent = self._recent.pop(username, None)
+            if recent is None:
+                recent = deque(maxlen=self.backlog)
+                if self._forgotten:
+                    # They may have been forgotten before
+                    self._dropped[username] = self._forgotten
+            elif len(recent) == self.backlog:
+                self._dropped[username] = recent[0]["id"]
+            recent.append(event)
+            self._recent[username] = recent
+            for callback in list(self._subscribers.get(username, ())):
+                callback(event)
+        while len(self._recent) > self.max_players:
+            username, recent = self._recent.popitem(last=False)
+            self._dropped.pop(username, None)
+            self._forgotten = max(self._forgotten, recent[-1]["id"])
+
+    def since(self, username, last_id):
+        """Events for ``username`` after the one with ID ``last_id``
+
+        :returns: (events, whether they are all there were)
+        """
+        if last_id > self.last_id:
+            # From before a restart
+            return [], False
+        recent = self._recent.get(username)
+        if recent is None:
+            return [], last_id >= self._forgotten
+        return ([event for event in recent if event["id"] > last_id],
+                last_id >= self._dropped.get(username, 0))
+
+    def subscribe(self, username, callback):
+        """Call ``callback(event)`` for every event for ``username`` from
+        now on, until unsubscribed
+        """
+        self._subscribers[username].add(callback)
+
+    def unsubscribe(self, username, callback):
+        callbacks = self._subscribers.get(username)
+        if callbacks is not None:
+            callbacks.discard(callback)
+            if not callbacks:
+                del self._subscribers[username]
+
+    def wait(self, username):
+        """Future resolved with the next event for ``username``; cancel a
+        wait that is no longer needed by resolving it with None
+        """
+        future = Future()
+
+        def deliver(event):
+            if not future.done():
+                future.set_result(event)
+        self.subscribe(username, deliver)
+        future.add_done_callback(
+            lambda _: self.unsubscribe(username, deliver))
+        return future
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "subscribers": sum(len(c) for c in self._subscribers.values()),
+            "players": len(self._recent),
+        }
@@ -0,0 +1,140 @@
+"""Loading games in bulk
+
+``to_dict(with_collections=True)`` loads the teams and the accepted
+players of every game with queries of their own, i.e., two more queries
+per game. The functions here load any number of games with a fixed
+number of queries: one for the games themselves, one for the teams of
+all of them and one for their accepted players.
+
+All functions must be called inside a db_session.
+"""
+import json
+from collections import defaultdict
+
+from pony.orm import select
+
+from wlsports.db import Game as GameEntity
+from wlsports.db import Player as PlayerEntity
+from wlsports.db import Team as TeamEntity
+
+
+MAX_GAMES = 100
+# Games per chunk of an NDJSON export
+EXPORT_CHUNK_SIZE = 1000
+
+
+def game_dicts(games):
+    """Dicts of ``games`` (loaded Game entities), in the same order, in
+    the shape of ``GET /api/game/game/<id>``
+    """
+    # The host's username is the foreign key itself, so this does not
+    #   load the host
+    return _dicts([
+        (game.id, game.host.username, game.location, game.date,
+         game.cancelled, game.final_score)
+        for game in games
+    ])
+
+
+def _dicts(rows):
+    """Game dicts from ``(id, host, location, date, cancelled,
+    final_score)`` rows
+    """
+    ids = [row[0] for row in rows]
+    if not ids:
+        return []
+    teams = defaultdict(list)
+    for game_id, name in select(
+            (g.id, t.name) for g in GameEntity for t in g.teams
+            if g.id in ids):
+        teams[game_id].append(name)
+    accepted_players = defaultdict(list)
+    for game_id, username in select(
+            (g.id, p.username) for g in GameEntity for p in g.accepted_players
+            if g.id in ids):
+        accepted_players[game_id].append(username)
+
+    return [
+        {
+            "id": game_id,
+            "teams": sorted(teams[game_id]),
+            "host": host,
+            "location": location or "",
+            "date": str(date or ""),
+            "accepted_players": sorted(accepted_players[game_id]),
+            "cancelled": cancelled or False,
+            "final_score": final_score or "",
+        }
+        for game_id, host, location, date, cancelled, final_score in rows
+    ]
+
+
+def get_games(game_ids):
+    """Dicts of the games with ``game_ids`` that exist, in the given order"""
+    games = {g.id: g for g in select(g for g in GameEntity if g.id in game_ids)}
+    return game_dicts([games[i] for i in game_ids if i in games])
+
+
+def find_games(team=None, player=None, date_from=None, date_to=None,
+               after=None, limit=MAX_GAMES):
+    """Dicts of games matching all of the given filters, ordered by ID
+
+    :param player: Username of a player on either team
+    :type  date_from, date_to: datetime.date
+    :param date_from, date_to: Inclusive; games without a date never match
+    :param after: Only return games with a greater ID; for paging
+    :returns: (game dicts, whether there are more)
+    """
+    query = _filter(select(g for g in GameEntity), team, player, date_from,
+                    date_to, after)
+
+    # Fetch one extra game to find out whether there is another page
+    games = list(query.order_by(GameEntity.id).limit(limit + 1))
+    return game_dicts(games[:limit]), len(games) > limit
+
+
+def export_chunk(after=None, limit=EXPORT_CHUNK_SIZE, **filters):
+    """The next ``limit`` games after ID ``after`` matching ``filters``
+    (see ``find_games``), as NDJSON
+
+    Exports call this in a short db_session per chunk, passing the
+    returned ID back in as ``after``, so that neither Pony's identity map
+    nor a long-running transaction grows with the number of games.
+
+    :returns: (NDJSON text, ID of the last game in it, whether there are
+        more)
+    """
+    # Plain rows rather than entities, which take longer to load than
+    #   everything else put together
+    query = _filter(
+        select((g.id, g.host.username, g.location, g.date, g.cancelled,
+                g.final_score) for g in GameEntity),
+        after=after, **filters
+    )
+    rows = list(query.order_by(1).limit(limit + 1))
+    dicts = _dicts(rows[:limit])
+    text = "".join(json.dumps(d) + "\n" for d in dicts)
+    return text, dicts[-1]["id"] if dicts else after, len(rows) > limit
+
+
+def _filter(query, team=None, player=None, date_from=None, date_to=None,
+            after=None):
+    """``query`` over games ``g`` narrowed down by the filters of
+    ``find_games``
+    """
+    # IDs from the join tables, rather than a membership test per game,
+    #   so SQLite looks the games up instead of scanning them all
+    if team is not None:
+        query = query.where(lambda g: g.id in select(
+            tg.id for t in TeamEntity if t.name == team for tg in t.games))
+    if player is not None:
+        query = query.where(lambda g: g.id in select(
+            tg.id for p in PlayerEntity if p.username == player
+            for t in p.teams for tg in t.games))
+    if date_from is not None:
+        query = query.where(lambda g: g.date >= date_from)
+    if date_to is not None:
+        query = query.where(lambda g: g.date <= date_to)
+    if after is not None:
+        query = query.where(lambda g: g.id > after)
+    return query
@@ -0,0 +1,58 @@
+"""Generation counters for in-process caches
+
+Caches kept in memory (e.g., rankings) are built from the database and
+then patched by the process that makes a change. Every change also bumps
+a named generation counter, and a cache remembers the generation it is
+current as of; if the two differ, the cache has missed a change and is
+rebuilt.
+
+With a single server process the counters only live in memory. With
+several worker processes sharing a database, ``enable_sharing()`` moves
+them into the Generation table so that a change made by one worker is
+noticed by all others; reading a counter then costs one primary key
+lookup. All functions must be called inside a db_session in that case.
+"""
+from wlsports.db import database
+
+
+_shared = False
+# Only written by bump(), so that reads of names that were never bumped
+# (e.g., cache keys of teams that don't exist) don't add entries
+_local = {}
+
+
+def enable_sharing():
+    """Keep counters in the database; call before forking workers"""
+    global _shared
+    _shared = True
+
+
+def is_shared():
+    """Whether counters live in the database (and need a db_session)"""
+    return _shared
+
+
+def current(name):
+    """Current generation of ``name``"""
+    if not _shared:
+        return _local.get(name, 0)
+    rows = database.select('SELECT value FROM "Generation" WHERE name = $name')
+    return rows[0] if rows else 0
+
+
+def bump(name):
+    """Increment and return the generation of ``name``
+
+    In shared mode this is part of the current transaction, so call it
+    before committing the change it stands for.
+    """
+    if not _shared:
+        _local[name] = _local.get(name, 0) + 1
+        return _local[name]
+    database.execute(
+        'INSERT OR IGNORE INTO "Generation" (name, value) VALUES ($name, 0)'
+    )
+    database.execute(
+        'UPDATE "Generation" SET value = value + 1 WHERE name = $name'
+    )
+    return current(name)
@@ -1,29 +1,43 @@
+import json
+import logging
+
+from tornado import gen
+from tornado.web import Finish
 from tornado_json import requesthandlers
+from tornado_json.exceptions import api_assert
+
+from wlsports import generations, sessions
+from wlsports.sqlstats import QueryStats
+
+
+sql_log = logging.getLogger("wlsports.sql")
 
 
 class AuthMixin(object):
 
     def get_current_user(self):
-        cookie = self.get_secure_cookie("user")
-        if cookie is None:
-            return None
-        else:
-            cookie = cookie.decode()
+        # APIHandler resolves the session cookie in prepare() and sets
+        #   current_user; anything else has no user
+        return None
 
-        #user_type, user_id = cookie.split(" ")
-        user_id = cookie
-        return user_id
+    @gen.coroutine
+    def resolve_session(self, db_read):
+        """Username of the session cookie of this request, or None
 
-    # @property
-    # def user_type(self):
-    #     cookie = self.get_secure_cookie("user")
-    #     if cookie is None:
-    #         return None
-    #     else:
-    #         cookie = cookie.decode()
-    #
-    #     user_type, user_id = cookie.split(" ")
-    #     return user_type
+        :param db_read: Runs a unit of work on the read lane, like
+            APIHandler.db_read
+        """
+        session_id = self.get_cookie(sessions.COOKIE_NAME)
+        if not session_id:
+            raise gen.Return(None)
+        store = self.settings['session_store']
+        if store.needs_recheck():
+            yield db_read(store.recheck)
+        resolved = store.get(session_id)
+        if resolved is None:
+            resolved = yield db_read(sessions.lookup, session_id)
+            store.put(session_id, resolved)
+        raise gen.Return(resolved.username)
 
 
 class APIHandler(AuthMixin, requesthandlers.APIHandler):
@@ -31,6 +45,151 @@ class APIHandler(AuthMixin, requesthandlers.APIHandler):
 
     # For PyCharm completion, since this is otherwise dynamically  inserted
     body = None
+    _sql_stats = None
+    # Set to False on handlers that legitimately run the same SELECT many
+    #   times per request, e.g., once per chunk of a stream
+    check_n_plus_one = True
+
+    @property
+    def sql_stats(self):
+        """QueryStats of this request; see wlsports.sqlstats"""
+        if self._sql_stats is None:
+            self._sql_stats = QueryStats()
+        return self._sql_stats
+
+    def initialize(self):
+        self.settings['metrics'].request_started()
+
+    @gen.coroutine
+    def prepare(self):
+        """Resolve the session cookie into ``current_user``"""
+        username = yield self.resolve_session(self.db_read)
+        if username is not None:
+            self.current_user = username
+
+    @gen.coroutine
+    def start_session(self, username):
+        """Log ``username`` in: create a session and set its cookie"""
+        days = self.settings['app_config'].session_timeout_days
+        session_id, resolved = yield self.db_write(
+            sessions.create, username, days
+        )
+        self.settings['session_store'].put(session_id, resolved)
+        self.set_cookie(sessions.COOKIE_NAME, session_id, expires_days=days,
+                        httponly=True)
+        self.current_user = username
+
+    @gen.coroutine
+    def end_session(self):
+        """Log out: revoke the current session and clear its cookie"""
+        session_id = self.get_cookie(sessions.COOKIE_NAME)
+        if session_id:
+            yield self.db_write(sessions.revoke, session_id)
+            self.settings['session_store'].discard(session_id)
+        self.clear_cookie(sessions.COOKIE_NAME)
+        self.current_user = None
+
+    def finish(self, chunk=None):
+        stats = self._sql_stats
+        if stats is not None and self.settings['app_config'].debug and \
+                not self._headers_written:
+            self.set_header("X-SQL-Queries", stats.count)
+            self.set_header("X-SQL-Time", "{:.3f}ms".format(stats.time * 1000))
+            self.set_header("X-SQL-Max-Repeated", stats.max_repeated())
+        return super(APIHandler, self).finish(chunk)
+
+    def on_finish(self):
+        stats = self._sql_stats
+        self.settings['metrics'].request_finished(
+            handler="{}.{}".format(type(self).__module__.rsplit(".", 1)[-1],
+                                   type(self).__name__),
+            method=self.request.method,
+            status=self.get_status(),
+            elapsed=self.request.request_time(),
+            db_time=stats.time if stats is not None else None
+        )
+        if stats is None:
+            return
+        record = {
+            "method": self.request.method,
+            "path": self.request.path,
+            "status": self.get_status(),
+            "queries": stats.count,
+            "sql_ms": round(stats.time * 1000, 3),
+        }
+        repeated = stats.repeated(
+            self.settings['app_config'].n_plus_one_threshold
+        ) if self.check_n_plus_one else []
+        if repeated:
+            record["repeated"] = [{"sql": shape, "count": n}
+                                  for shape, n in repeated]
+            sql_log.warning("N+1 queries suspected: %s", json.dumps(record))
+        else:
+            sql_log.info("%s", json.dumps(record))
+
+    def assert_admin(self):
+        """Only let players given with --admin past"""
+        api_assert(
+            self.current_user in self.settings['app_config'].admins,
+            403,
+            log_message="Only admins may do this!"
+        )
+
+    def db_read(self, fn, *args, **kwargs):
+        """Run ``fn`` in a db_session off the IOLoop; yield the result
+
+        See wlsports.dal
+        """
+        return self.settings['data_layer'].read(
+            self.sql_stats.wrap(fn), *args, **kwargs
+        )
+
+    def db_write(self, fn, *args, **kwargs):
+        """Like ``db_read``, but on the write lane"""
+        return self.settings['data_layer'].write(
+            self.sql_stats.wrap(fn), *args, **kwargs
+        )
+
+    def db_write_grouped(self, fn, *args, **kwargs):
+        """Like ``db_write``, for short writes that may be group committed
+        with those of other requests; ``fn`` must not commit, and must
+        leave cache invalidation and the like to
+        ``wlsports.dal.after_commit``
+        """
+        return self.settings['data_layer'].write_grouped(
+            self.sql_stats.wrap(fn), *args, **kwargs
+        )
+
+    @gen.coroutine
+    def get_cached(self, key, build):
+        """GET through the response cache (see wlsports.cache)
+
+        If the cached response for ``key`` is still current, the request
+        is finished straight from it (with a 304 if the client already
+        has it). Otherwise ``build`` runs on the read lane and must
+        return ``(data, versions)``; the data is cached and returned.
+        """
+        cache = self.settings['response_cache']
+        if generations.is_shared():
+            entry = yield self.db_read(cache.get, key)
+        else:
+            entry = cache.get(key)
+
+        if entry is not None:
+            self.set_header("Etag", entry.etag)
+            if self.check_etag_header():
+                self.set_status(304)
+                raise Finish()
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            raise Finish(entry.body)
+
+        data, versions = yield self.db_read(build)
+        entry = cache.put(key, data, versions)
+        self.set_header("Etag", entry.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            raise Finish()
+        raise gen.Return(data)
 
 
 class ViewHandler(AuthMixin, requesthandlers.ViewHandler):
@@ -0,0 +1,114 @@
+import hmac
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from tornado import gen
+
+from wlsports.metrics import Histogram
+
+
+def _hash_new(password, rounds):
+    """Generate a salt and hash ``password`` with it (runs in a worker)"""
+    started = time.time()
+    salt = bcrypt.gensalt(rounds=rounds)
+    hashed = bcrypt.hashpw(password, salt)
+    return salt, hashed, started, time.time()
+
+
+def _hash_check(password, salt, hashed):
+    """Check ``password`` hashed with ``salt`` against ``hashed``
+    (runs in a worker)
+    """
+    started = time.time()
+    match = hmac.compare_digest(bcrypt.hashpw(password, salt), hashed)
+    return match, started, time.time()
+
+
+class PasswordHasher(object):
+    """Runs bcrypt on a process pool so that the IOLoop is never
+    blocked by password hashing
+
+    Handlers ``yield`` the coroutines ``hash_password`` and
+    ``check_password``. Queue depth and timing are tracked and
+    available from ``stats()``.
+    """
+
+    def __init__(self, workers=0, rounds=12):
+        """
+        :param workers: Number of hashing processes; 0 means one per CPU
+        :param rounds: bcrypt cost factor for new passwords
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        self.rounds = rounds
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.queue_time = 0.0
+        self.hash_time = 0.0
+        self.queue_times = Histogram()
+
+    @gen.coroutine
+    def hash_password(self, password):
+        """Hash a new password
+
+        :type  password: str
+        :returns: (salt, hashed) both as str
+        """
+        salt, hashed = yield self._submit(
+            _hash_new, password.encode(), self.rounds
+        )
+        raise gen.Return((salt.decode(), hashed.decode()))
+
+    @gen.coroutine
+    def check_password(self, password, salt, hashed):
+        """Check whether ``password`` matches a stored salt and hash
+
+        :rtype: bool
+        """
+        match = yield self._submit(
+            _hash_check, password.encode(), salt.encode(), hashed.encode()
+        )
+        raise gen.Return(match)
+
+    @gen.coroutine
+    def _submit(self, fn, *args):
+        submitted = time.time()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            result = yield self._executor.submit(fn, *args)
+        finally:
+            self.queue_depth -= 1
+
+        started, finished = result[-2:]
+        self.completed += 1
+        self.queue_time += max(started - submitted, 0)
+        self.queue_times.observe(max(started - submitted, 0))
+        self.hash_time += finished - started
+        if self.queue_depth > self.workers:
+            logging.debug(
+                "Password hashing backlog: %s queued, %.1fms wait",
+                self.queue_depth, (started - submitted) * 1000
+            )
+
+        result = result[:-2]
+        raise gen.Return(result[0] if len(result) == 1 else result)
+
+    def stats(self):
+        """Queue depth and timing counters for the hashing pool"""
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "queue_time": self.queue_time,
+            "hash_time": self.hash_time,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
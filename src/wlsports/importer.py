@@ -0,0 +1,454 @@
+"""Bulk import of players, teams and games
+
+Records come as NDJSON, i.e., one JSON object per line with a ``type`` of
+"player", "team" or "game", or as CSV with a header line and either a
+``type`` column or one type of record per file. ``RecordParser`` turns
+input into records chunk by chunk as it arrives, so nothing ever holds a
+whole file in memory.
+
+``Importer`` collects records into batches. Every record is validated on
+its own as it comes in; then, per batch, all passwords are hashed in
+parallel on the password hashing pool and the batch is inserted in a
+single transaction. A record that fails is reported with its line number
+and skipped, and the rest of the batch goes in regardless.
+
+Records may refer to records before them, e.g., a team to players from
+earlier lines, since batches are inserted in order. Games are historical
+results: they are recorded as finished, with every player accepted, and
+update their teams' standings like ``/api/game/finish`` does.
+"""
+import csv
+import json
+import re
+from collections import Counter
+
+import jsonschema
+from pony.orm import select, commit
+from tornado import gen
+
+from wlsports import cache, scores
+from wlsports.db import Game as GameEntity
+from wlsports.db import Player as PlayerEntity
+from wlsports.db import Sport as SportEntity
+from wlsports.db import Team as TeamEntity
+from wlsports.ranking import bump as bump_rankings
+from wlsports.results import record_result
+from wlsports.util import validate_date_text
+
+
+FORMATS = ("ndjson", "csv")
+KINDS = ("player", "team", "game")
+BATCH_SIZE = 500
+# Errors beyond this many are counted but not listed
+MAX_ERRORS = 1000
+
+SCHEMAS = {
+    "player": {
+        "type": "object",
+        "properties": {
+            "username": {"type": "string", "minLength": 1},
+            "first": {"type": "string"},
+            "last": {"type": "string"},
+            "password": {"type": "string"},
+            "gender": {"enum": ["M", "F"]},
+            "birthday": {"type": "string"},
+            "city": {"type": "string"},
+            "country": {"type": "string"},
+            "bio": {"type": "string"},
+        },
+        "required": ["username", "first", "last", "password", "birthday",
+                     "city", "country"],
+    },
+    "team": {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string", "minLength": 1},
+            "sport": {"type": "string"},
+            "usernames": {
+                "type": "array",
+                "items": {"type": "string"},
+                "minItems": 1
+            },
+        },
+        "required": ["name", "sport", "usernames"],
+    },
+    "game": {
+        "type": "object",
+        "properties": {
+            "teams": {
+                "type": "array",
+                "items": {"type": "string"},
+                "minItems": 2,
+                "maxItems": 2
+            },
+            "final_score": {
+                "type": "object",
+                "additionalProperties": {"type": "number", "minimum": 0}
+            },
+            "host": {"type": "string"},
+            "date": {"type": "string"},
+            "location": {"type": "string"},
+        },
+        "required": ["teams", "final_score"],
+    },
+}
+
+
+class RecordError(ValueError):
+    """A record that cannot be imported; the message is reported back"""
+
+
+class RecordParser(object):
+    """Incremental NDJSON/CSV parser
+
+    ``feed()`` and ``close()`` return lists of ``(line_no, record, error)``
+    where exactly one of ``record`` and ``error`` is set. CSV records must
+    be on a single line each.
+    """
+
+    def __init__(self, fmt="ndjson", kind=None):
+        """
+        :param fmt: One of FORMATS
+        :param kind: Type of CSV records if there is no ``type`` column
+        """
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format {}".format(fmt))
+        self.fmt = fmt
+        self.kind = kind
+        self._pending = b""
+        self._line_no = 0
+        self._columns = None
+
+    def feed(self, data):
+        """Parse all complete lines in what was received so far"""
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        return self._parse_lines(lines)
+
+    def close(self):
+        """Parse the last line, if it had no line break"""
+        lines, self._pending = [self._pending], b""
+        return self._parse_lines(lines)
+
+    def _parse_lines(self, lines):
+        rows = []
+        for line in lines:
+            self._line_no += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = (self._parse_json(line) if self.fmt == "ndjson"
+                          else self._parse_csv(line))
+            except RecordError as e:
+                rows.append((self._line_no, None, str(e)))
+                continue
+            if record is not None:
+                rows.append((self._line_no, record, None))
+        return rows
+
+    def _parse_json(self, line):
+        try:
+            record = json.loads(line.decode("utf-8"))
+        except ValueError:
+            raise RecordError("Malformed JSON")
+        if not isinstance(record, dict):
+            raise RecordError("Record must be a JSON object")
+        return record
+
+    def _parse_csv(self, line):
+        values = [v.decode("utf-8") for v in next(csv.reader([line]))]
+        if self._columns is None:
+            self._columns = [c.strip().lower() for c in values]
+            return None
+        if len(values) != len(self._columns):
+            raise RecordError("Expected {} fields, got {}".format(
+                len(self._columns), len(values)))
+        # Empty fields are left out, like missing keys in JSON
+        row = {c: v for c, v in zip(self._columns, values) if v != u""}
+        kind = row.pop("type", None) or self.kind
+        if kind == "team":
+            row["usernames"] = [
+                u for u in re.split(r"[;\s]+", row.get("usernames", u""))
+                if u
+            ]
+        elif kind == "game":
+            teams = [row.pop("team_a", None), row.pop("team_b", None)]
+            scores = [row.pop("score_a", None), row.pop("score_b", None)]
+            if None in teams or None in scores:
+                raise RecordError("Games need team_a, team_b, score_a "
+                                  "and score_b")
+            row["teams"] = teams
+            row["final_score"] = {
+                team: _number(score) for team, score in zip(teams, scores)
+            }
+        row["type"] = kind
+        return row
+
+
+class Importer(object):
+    """Validates, hashes and inserts records in batches
+
+    ``add()`` and ``flush()`` are coroutines; yield each before adding
+    the next record, so that memory use is bounded by the batch size.
+    """
+
+    def __init__(self, password_hasher, db_read, db_write,
+                 batch_size=BATCH_SIZE, max_errors=MAX_ERRORS):
+        """
+        :type  password_hasher: wlsports.hashing.PasswordHasher
+        :param db_read, db_write: Functions running a unit of work in a
+            db_session and returning a future for its result, e.g.,
+            APIHandler.db_read and APIHandler.db_write
+        """
+        self.password_hasher = password_hasher
+        self.db_read = db_read
+        self.db_write = db_write
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+
+        self.imported = Counter()
+        self.errors = []
+        self.error_count = 0
+        self._batch = []
+
+    @gen.coroutine
+    def add(self, line_no, record, error=None):
+        """Queue ``record`` (from line ``line_no``) for insertion, or
+        report ``error`` for it if parsing already failed
+        """
+        if error is None:
+            try:
+                _validate(record)
+            except RecordError as e:
+                error = str(e)
+        if error is not None:
+            self._error(line_no, error)
+            return
+
+        self._batch.append((line_no, record))
+        if len(self._batch) >= self.batch_size:
+            yield self.flush()
+
+    @gen.coroutine
+    def flush(self):
+        """Insert all queued records"""
+        batch, self._batch = self._batch, []
+        batch = yield self._drop_taken_usernames(batch)
+        if not batch:
+            return
+
+        # Hash all new passwords of the batch at once
+        players = [r for _, r in batch if r["type"] == "player"]
+        hashes = yield [self.password_hasher.hash_password(r["password"])
+                        for r in players]
+        for record, (salt, hashed) in zip(players, hashes):
+            record["salt"], record["password"] = salt, hashed
+
+        try:
+            results = [(yield self.db_write(_insert_batch, batch))]
+        except Exception:
+            # Something only the database caught; retry one record per
+            #   transaction so it only takes the offending records down
+            results = []
+            for line_no, record in batch:
+                try:
+                    results.append(
+                        (yield self.db_write(_insert_batch,
+                                             [(line_no, record)]))
+                    )
+                except Exception as e:
+                    self._error(line_no, str(e) or type(e).__name__)
+
+        for imported, errors in results:
+            self.imported.update(imported)
+            for line_no, error in errors:
+                self._error(line_no, error)
+
+    def report(self):
+        return {
+            "imported": {"{}s".format(kind): self.imported[kind]
+                         for kind in KINDS},
+            "errors": [{"line": line_no, "error": error}
+                       for line_no, error in sorted(self.errors)],
+            "error_count": self.error_count,
+        }
+
+    @gen.coroutine
+    def _drop_taken_usernames(self, batch):
+        # Checked before hashing so that re-running an import doesn't
+        #   pay for bcrypt again on every player that already made it
+        usernames = [r["username"] for _, r in batch if r["type"] == "player"]
+        if not usernames:
+            raise gen.Return(batch)
+        taken = yield self.db_read(_existing_usernames, usernames)
+
+        seen = set()
+        kept = []
+        for line_no, record in batch:
+            if record["type"] == "player":
+                username = record["username"]
+                if username in taken or username in seen:
+                    self._error(line_no, "Username {} is already taken"
+                                .format(username))
+                    continue
+                seen.add(username)
+            kept.append((line_no, record))
+        raise gen.Return(kept)
+
+    def _error(self, line_no, error):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line_no, error))
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            raise RecordError("{} is not a number".format(text))
+
+
+def _validate(record):
+    kind = record.get("type")
+    if kind is None:
+        raise RecordError("Record has no type; expected one of {}".format(
+            ", ".join(KINDS)))
+    if kind not in SCHEMAS:
+        raise RecordError("Unknown record type {}".format(kind))
+    try:
+        jsonschema.validate(record, SCHEMAS[kind])
+    except jsonschema.ValidationError as e:
+        raise RecordError(e.message)
+
+    for field in ("birthday", "date"):
+        if field in record:
+            try:
+                validate_date_text(record[field])
+            except ValueError as e:
+                raise RecordError("{}: {}".format(field, e))
+    if kind == "game":
+        if record["teams"][0] == record["teams"][1]:
+            raise RecordError("A team can't play itself")
+        if set(record["final_score"]) != set(record["teams"]):
+            raise RecordError("final_score must have a score for each "
+                              "of the teams and nothing else")
+
+
+def _existing_usernames(usernames):
+    return set(select(
+        p.username for p in PlayerEntity if p.username in usernames
+    ))
+
+
+def _insert_batch(rows):
+    """Insert ``rows`` of (line_no, record) in one transaction
+
+    :returns: (Counter of imported records by type,
+               [(line_no, error), ...] for records that were skipped)
+    """
+    imported = Counter()
+    errors = []
+    sports = set()
+    for line_no, record in rows:
+        try:
+            sport = _INSERT[record["type"]](record)
+        except RecordError as e:
+            errors.append((line_no, str(e)))
+            continue
+        imported[record["type"]] += 1
+        if sport is not None:
+            sports.add(sport)
+
+    for sport in sports:
+        bump_rankings(sport)
+    commit()
+    cache.invalidate(*[cache.sport_key(sport) for sport in sports])
+
+    return imported, errors
+
+
+# Each of these checks everything that could go wrong before creating
+#   anything, so that a failing record leaves nothing behind; they return
+#   the name of the sport whose standings changed, if any
+
+def _insert_player(record):
+    if PlayerEntity.exists(username=record["username"]):
+        raise RecordError("Username {} is already taken"
+                          .format(record["username"]))
+    PlayerEntity(**{k: v for k, v in record.items() if k != "type"})
+
+
+def _insert_team(record):
+    if TeamEntity.exists(name=record["name"]):
+        raise RecordError("Team with name {} already exists!"
+                          .format(record["name"]))
+    sport = SportEntity.get(name=record["sport"])
+    if sport is None:
+        raise RecordError("No such sport {}".format(record["sport"]))
+    players = []
+    for username in record["usernames"]:
+        player = PlayerEntity.get(username=username)
+        if player is None:
+            raise RecordError("No player exists with name {}!"
+                              .format(username))
+        players.append(player)
+
+    TeamEntity(
+        name=record["name"],
+        users=players,
+        sport=sport,
+        wins=0,
+        losses=0,
+        ties=0,
+        points_ratio=0.0
+    )
+    return sport.name
+
+
+def _insert_game(record):
+    teams = []
+    for name in record["teams"]:
+        team = TeamEntity.get(name=name)
+        if team is None:
+            raise RecordError("Team with name {} does not exist!"
+                              .format(name))
+        teams.append(team)
+    team_a, team_b = teams
+    if team_a.sport != team_b.sport:
+        raise RecordError("Teams play different sports")
+
+    players = [p for team in teams for p in team.users]
+    if "host" in record:
+        host = PlayerEntity.get(username=record["host"])
+        if host is None or host not in players:
+            raise RecordError("Host {} is not part of this game!"
+                              .format(record["host"]))
+    elif players:
+        host = min(players, key=lambda p: p.username)
+    else:
+        raise RecordError("Neither team has any players")
+
+    record_result(team_a, team_b, record["final_score"])
+
+    game = GameEntity(
+        teams=teams,
+        host=host,
+        accepted_players=players,
+        location=record.get("location", ""),
+        date=record.get("date"),
+        cancelled=False,
+        final_score=json.dumps(record["final_score"])
+    )
+    scores.record(game, team_a, team_b, record["final_score"])
+    return team_a.sport.name
+
+
+_INSERT = {
+    "player": _insert_player,
+    "team": _insert_team,
+    "game": _insert_game,
+}
@@ -0,0 +1,70 @@
+"""Open game invitations
+
+A player has an open invitation to a game if they are on one of its
+teams, have not accepted it yet, and it has not been cancelled. These are
+kept as rows of the Invitation table, keyed by (player, game), so that
+listing and checking invitations are single index lookups instead of a
+walk over the player's teams and their games.
+
+Everything that changes one of the inputs above has to go through this
+module. All functions must be called inside a db_session.
+"""
+from pony.orm import select
+
+from wlsports.db import Game as GameEntity
+from wlsports.db import Invitation as InvitationEntity
+
+
+def get_player_invitations(username):
+    """IDs of games with an open invitation for ``username``"""
+    return list(select(
+        i.game.id for i in InvitationEntity if i.player.username == username
+    ))
+
+
+def is_invited(username, game_id):
+    return InvitationEntity.exists(player=username, game=game_id)
+
+
+def invite_teams(game):
+    """Invite everyone on ``game``'s teams who hasn't accepted yet"""
+    for username in _expected(game) - {
+            i.player.username for i in game.invitations}:
+        InvitationEntity(player=username, game=game)
+
+
+def accept(player, game):
+    game.accepted_players.add(player)
+    invitation = InvitationEntity.get(player=player, game=game)
+    if invitation is not None:
+        invitation.delete()
+
+
+def cancel(game):
+    game.cancelled = True
+    select(i for i in InvitationEntity if i.game == game).delete(bulk=True)
+
+
+def sync():
+    """Bring the Invitation table in line with games and rosters
+
+    Used to fill the table for databases that predate it, and to repair
+    it after changes made behind this module's back. Only games that are
+    neither cancelled nor finished can have open invitations.
+    """
+    expected = {}
+    for game in select(
+            g for g in GameEntity if not g.cancelled and not g.final_score):
+        invite_teams(game)
+        expected[game.id] = _expected(game)
+    for invitation in select(i for i in InvitationEntity):
+        if invitation.player.username not in expected.get(
+                invitation.game.id, ()):
+            invitation.delete()
+
+
+def _expected(game):
+    if game.cancelled or game.final_score:
+        return set()
+    accepted = {p.username for p in game.accepted_players}
+    return {p.username for team in game.teams for p in team.users} - accepted
@@ -0,0 +1,133 @@
+"""Leaderboard snapshots per sport
+
+A snapshot is every team of a sport in ranking order (see
+wlsports.ranking) with its stats, as of one generation of the sport's
+rankings. Snapshots are only rebuilt once that generation has moved on,
+i.e., after results were recorded or teams added; until then every
+leaderboard page is a slice of the same snapshot, and costs only as much
+as the teams on it.
+
+Every snapshot has a ``version`` derived from its content, so it is the
+same across worker processes and restarts for the same standings, and
+clients can cache pages by it.
+"""
+import hashlib
+import json
+import threading
+from collections import Counter, defaultdict
+
+from pony.orm import select
+
+from wlsports import ranking
+from wlsports.db import Sport as SportEntity, Team as TeamEntity
+
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+class Snapshot(object):
+    """Ranked teams of one sport"""
+
+    def __init__(self, sport_name, generation, rows):
+        """
+        :param rows: Team dicts, best ranked first
+        """
+        self.sport_name = sport_name
+        self.generation = generation
+        self.rows = rows
+        # Positions in ``rows`` of teams from each city
+        self.by_city = defaultdict(list)
+        for i, row in enumerate(rows):
+            self.by_city[row["city"]].append(i)
+        self.version = hashlib.sha1(
+            json.dumps(rows, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+
+    def page(self, offset, limit, city=None):
+        """Team dicts ``offset`` to ``offset + limit`` (of the teams from
+        ``city``)
+
+        :returns: (team dicts, number of matching teams)
+        """
+        if city is None:
+            return self.rows[offset:offset + limit], len(self.rows)
+        positions = self.by_city.get(city, [])
+        return ([self.rows[i] for i in positions[offset:offset + limit]],
+                len(positions))
+
+
+def get_snapshot(sport_name):
+    """Get the Snapshot of ``sport_name``, rebuilding it if it has missed a
+    change; needs a db_session
+
+    :returns: Snapshot, or None if there is no such sport
+    """
+    generation = ranking.current(sport_name)
+    snapshot = _snapshots.get(sport_name)
+    if snapshot is not None and snapshot.generation == generation:
+        return snapshot
+    if SportEntity.get(name=sport_name) is None:
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.get(sport_name)
+        if snapshot is None or snapshot.generation != generation:
+            snapshot = _build(sport_name, generation)
+            _snapshots[sport_name] = snapshot
+    return snapshot
+
+
+def current_snapshot(sport_name):
+    """The Snapshot of ``sport_name`` if it exists and is current, else
+    None; only needs a db_session with shared generations
+    """
+    snapshot = _snapshots.get(sport_name)
+    if snapshot is not None and \
+            snapshot.generation == ranking.current(sport_name):
+        return snapshot
+    return None
+
+
+def _build(sport_name, generation):
+    stats = {
+        name: (wins, losses, ties, points_ratio)
+        for name, wins, losses, ties, points_ratio in select(
+            (t.name, t.wins, t.losses, t.ties, t.points_ratio)
+            for t in TeamEntity if t.sport.name == sport_name
+        )
+    }
+    cities = defaultdict(Counter)
+    for name, city in select(
+            (t.name, p.city) for t in TeamEntity for p in t.users
+            if t.sport.name == sport_name):
+        cities[name][city] += 1
+
+    rows = []
+    for i, (name, _) in enumerate(
+            ranking.get_index(sport_name).ordered()):
+        if name not in stats:
+            # Added since the index was built; the next snapshot has it
+            continue
+        wins, losses, ties, points_ratio = stats[name]
+        rows.append({
+            "ranking": i + 1,
+            "name": name,
+            "city": _home_city(cities[name]),
+            "wins": wins,
+            "losses": losses,
+            "ties": ties,
+            "points_ratio": points_ratio,
+        })
+    return Snapshot(sport_name, generation, rows)
+
+
+def _home_city(city_counts):
+    """Most common city of a team's players; alphabetically first of the
+    most common ones if several are
+    """
+    if not city_counts:
+        return ""
+    return min(city_counts.items(), key=lambda item: (-item[1], item[0]))[0]
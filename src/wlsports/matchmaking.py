@@ -0,0 +1,120 @@
+"""Rival selection for matchmaking
+
+Rivals are picked straight from a sport's RankingIndex by walking
+outwards from the team's own summed ranking, so the work done per
+matchmake is bounded regardless of how many teams the sport has.
+``pair_teams`` does the same for many teams at once, pairing them with
+each other; see wlsports.matchqueue.
+"""
+from random import choice
+
+from pony.orm import select
+
+from wlsports.db import Team as TeamEntity
+
+
+# Rivals are picked at random among eligible teams whose summed ranking
+#   is at most this far away
+RANK_WINDOW = 10
+# Upper bound on the number of teams looked at for a single matchmake
+MAX_CHECKED = 200
+# Team names per query in conflicting_teams_of, well below SQLite's limit
+#   on the number of parameters
+NAMES_PER_QUERY = 500
+
+
+def conflicting_teams(team_name):
+    """Names of teams sharing at least one player with ``team_name``,
+    including ``team_name`` itself
+
+    This is answered from the Player_Team join table, which Pony fills in
+    as part of the same transaction that creates a team's roster. The
+    table is keyed by (player, team) and has a secondary index on team,
+    so the query is an index lookup per rostered player rather than a
+    walk over every roster. Must be called inside a db_session.
+    """
+    return set(select(
+        other.name for team in TeamEntity if team.name == team_name
+        for player in team.users for other in player.teams
+    ))
+
+
+def conflicting_teams_of(team_names):
+    """``conflicting_teams`` of each of ``team_names``, in a query per
+    NAMES_PER_QUERY teams instead of one each; needs a db_session
+
+    :returns: Dict of team name to set of names of conflicting teams
+    """
+    team_names = list(team_names)
+    conflicts = {name: {name} for name in team_names}
+    for first in range(0, len(team_names), NAMES_PER_QUERY):
+        names = team_names[first:first + NAMES_PER_QUERY]
+        for name, other in select(
+            (team.name, other.name) for team in TeamEntity
+            if team.name in names
+            for player in team.users for other in player.teams
+        ):
+            conflicts[name].add(other)
+    return conflicts
+
+
+def pair_teams(rankings, team_names, conflicts,
+               window=RANK_WINDOW, max_checked=MAX_CHECKED):
+    """Pair up ``team_names`` with each other, by summed ranking
+
+    Going from the best ranked down, each team is paired with the next
+    one below it that is still unpaired and shares no players with it,
+    if that one is within ``window``.
+
+    :type  rankings: wlsports.ranking.RankingIndex
+    :param conflicts: Dict of team name to set of names of teams it may
+        not be paired with, e.g., from ``conflicting_teams_of``
+    :returns: ([(team name, rival name), ...], [names of teams left
+        unpaired, in the order given])
+    """
+    ranks = rankings.overall()
+    waiting = sorted((ranks[name], name) for name in set(team_names)
+                     if name in ranks)
+    pairs = []
+    paired = set()
+    for i, (rank, name) in enumerate(waiting):
+        if name in paired:
+            continue
+        for other_rank, other in waiting[i + 1:i + 1 + max_checked]:
+            if other_rank - rank > window:
+                break
+            if other in paired or other in conflicts[name]:
+                continue
+            pairs.append((name, other))
+            paired.update((name, other))
+            break
+    return pairs, [name for name in team_names if name not in paired]
+
+
+def find_rival(rankings, team_name, excluded,
+               window=RANK_WINDOW, max_checked=MAX_CHECKED):
+    """Find a rival for ``team_name``
+
+    :type  rankings: wlsports.ranking.RankingIndex
+    :param excluded: Set of names of teams that may not be picked,
+        e.g., from ``conflicting_teams``
+    :returns: Name of a random eligible team within ``window`` of
+        ``team_name``'s summed ranking; if there is none, the closest
+        eligible team; ``None`` if no eligible team was found at all
+        within ``max_checked`` teams
+    """
+    candidates = []
+    for checked, (distance, name) in enumerate(
+            rankings.neighbours(team_name)):
+        if checked >= max_checked:
+            break
+        if distance > window and candidates:
+            break
+        if name in excluded:
+            continue
+        if distance > window:
+            # Nobody within the window; settle for the closest team
+            return name
+        candidates.append(name)
+
+    return choice(candidates) if candidates else None
@@ -0,0 +1,267 @@
+"""Batch matchmaking
+
+``POST /api/team/matchmake`` finds a rival for one team per request,
+looking up the sport's rankings and the team's rosters every time.
+Teams can instead join the queue here (``POST /api/team/matchqueue``)
+and get a ticket. ``interval`` seconds after the first of them joined,
+everyone waiting is matched at once, in a unit of work per sport: the
+rankings are looked up once, the rosters of all waiting teams are
+checked in one query, and all of the games are created in one
+transaction.
+
+Waiting teams are paired with each other where they are close enough in
+ranking (see wlsports.matchmaking.pair_teams); the rest get a rival from
+the whole sport, like with matchmake. So every ticket is settled by the
+first batch after it was taken, unless the database is too busy to take
+the batch, in which case it waits for the next one.
+
+Clients poll their ticket (``GET /api/team/ticket/<id>``), or get a
+``matchmaking`` event (see wlsports.events) once it is settled. Like
+the event bus, the queue lives in memory and only covers the server
+process the team joined it in; tickets are only known there too.
+
+Everything must be called on the IOLoop.
+"""
+import binascii
+import logging
+import os
+from collections import OrderedDict, defaultdict
+
+from pony.orm import flush
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado_json.exceptions import APIError
+
+from wlsports import cache
+from wlsports.dal import after_commit
+from wlsports.db import Game as GameEntity
+from wlsports.db import Player as PlayerEntity
+from wlsports.db import Team as TeamEntity
+from wlsports.invitations import invite_teams
+from wlsports.matchmaking import conflicting_teams_of, find_rival, \
+    pair_teams
+from wlsports.ranking import get_index
+
+
+WAITING = "waiting"
+MATCHED = "matched"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+NO_RIVAL = "There are no other teams with all different people!"
+
+
+class Ticket(object):
+    """A team's place in the queue, and what came of it"""
+
+    def __init__(self, team, sport, host, players):
+        """
+        :param host: Username of the player who queued the team, who
+            hosts its game
+        :param players: Usernames of everyone on the team, who may all
+            look at the ticket
+        """
+        self.id = binascii.hexlify(os.urandom(16)).decode()
+        self.team = team
+        self.sport = sport
+        self.host = host
+        self.players = frozenset(players)
+        self.status = WAITING
+        self.game_id = None
+        self.reason = None
+
+    def to_dict(self):
+        return {
+            "ticket": self.id,
+            "team": self.team,
+            "status": self.status,
+            "game_id": self.game_id,
+            "reason": self.reason,
+        }
+
+
+class MatchQueue(object):
+    """Teams waiting for a rival, matched in batches"""
+
+    def __init__(self, data_layer, event_bus, interval=1.0,
+                 max_settled=10000, io_loop=None):
+        """
+        :param interval: Seconds teams wait for others to be matched
+            along with, counted from the first of them
+        :param max_settled: Most settled tickets kept for polling; the
+            oldest are forgotten first
+        """
+        self.data_layer = data_layer
+        self.event_bus = event_bus
+        self.interval = interval
+        self.max_settled = max_settled
+        self.io_loop = io_loop or IOLoop.current()
+        self.batches = 0
+        self.settled = {MATCHED: 0, FAILED: 0, CANCELLED: 0}
+        # Team name to Ticket, for the next batch and the current ones
+        self._waiting = OrderedDict()
+        self._matching = {}
+        # Ticket ID to Ticket, of those above, and of settled tickets
+        self._unsettled = {}
+        self._settled = OrderedDict()
+        self._timeout = None
+
+    def submit(self, team, sport, host, players):
+        """Queue ``team`` of ``sport`` for the next batch
+
+        :returns: Ticket; the one the team already has if it is waiting
+        """
+        ticket = self._waiting.get(team) or self._matching.get(team)
+        if ticket is None:
+            ticket = Ticket(team, sport, host, players)
+            self._waiting[team] = ticket
+            self._unsettled[ticket.id] = ticket
+            self._schedule()
+        return ticket
+
+    def get(self, ticket_id):
+        """Ticket with ``ticket_id``, or None if there is none (anymore)"""
+        return self._unsettled.get(ticket_id) or \
+            self._settled.get(ticket_id)
+
+    def cancel(self, ticket):
+        """Take ``ticket``'s team out of the queue
+
+        :returns: Whether it was; it can't be once its batch has started
+        """
+        if self._waiting.get(ticket.team) is not ticket:
+            return False
+        del self._waiting[ticket.team]
+        self._settle(ticket, CANCELLED)
+        return True
+
+    def stats(self):
+        return {
+            "waiting": len(self._waiting) + len(self._matching),
+            "batches": self.batches,
+            "settled": dict(self.settled),
+        }
+
+    def _schedule(self):
+        if self._timeout is None and self._waiting:
+            self._timeout = self.io_loop.call_later(
+                self.interval, self._run_batches)
+
+    @gen.coroutine
+    def _run_batches(self):
+        by_sport = defaultdict(list)
+        for ticket in self._waiting.values():
+            by_sport[ticket.sport].append(ticket)
+        self._matching.update(self._waiting)
+        self._waiting = OrderedDict()
+        try:
+            yield [self._match_sport(sport, tickets)
+                   for sport, tickets in by_sport.items()]
+        finally:
+            self._timeout = None
+            self._schedule()
+
+    @gen.coroutine
+    def _match_sport(self, sport, tickets):
+        try:
+            game_ids, invitations = yield self.data_layer.write(
+                match, sport, [(t.id, t.team, t.host) for t in tickets])
+        except Exception as e:
+            for ticket in tickets:
+                del self._matching[ticket.team]
+            if isinstance(e, APIError) and e.status_code == 503:
+                # The write lane is full; back to the front of the queue
+                self._waiting = OrderedDict(
+                    [(t.team, t) for t in tickets] +
+                    list(self._waiting.items()))
+                return
+            logging.exception("Matchmaking for %s failed", sport)
+            for ticket in tickets:
+                self._settle(ticket, FAILED,
+                             reason="Matchmaking failed; please try again")
+            return
+
+        self.batches += 1
+        for ticket in tickets:
+            del self._matching[ticket.team]
+            game_id = game_ids.get(ticket.id)
+            if game_id is None:
+                self._settle(ticket, FAILED, reason=NO_RIVAL)
+            else:
+                self._settle(ticket, MATCHED, game_id=game_id)
+        for game_id, usernames in invitations:
+            self.event_bus.publish(
+                usernames, {"type": "invitation", "game_id": game_id})
+
+    def _settle(self, ticket, status, game_id=None, reason=None):
+        ticket.status = status
+        ticket.game_id = game_id
+        ticket.reason = reason
+        self.settled[status] += 1
+        del self._unsettled[ticket.id]
+        self._settled[ticket.id] = ticket
+        while len(self._settled) > self.max_settled:
+            self._settled.popitem(last=False)
+        if status != CANCELLED:
+            self.event_bus.publish([ticket.host], dict(
+                ticket.to_dict(), type="matchmaking"))
+
+
+def match(sport, requests):
+    """Create games for the teams of ``sport`` waiting in the queue; a
+    unit of work for the write lane
+
+    :param requests: [(ticket ID, team name, username of host), ...],
+        first come first
+    :returns: (dict of ticket ID to ID of its game, for those that got
+        one; [(game ID, usernames invited), ...])
+    """
+    hosts = OrderedDict((team, host) for _, team, host in requests)
+    rankings = get_index(sport)
+    conflicts = conflicting_teams_of(hosts)
+    pairs, unpaired = pair_teams(rankings, list(hosts), conflicts)
+
+    # Team name to the (team, rival) it plays in
+    matchups = {}
+    for pair in pairs:
+        matchups[pair[0]] = matchups[pair[1]] = pair
+    for team in unpaired:
+        if team in matchups or team not in rankings:
+            # Picked as the rival of a team before it
+            continue
+        rival = find_rival(rankings, team, conflicts[team])
+        if rival is None:
+            continue
+        matchups[team] = (team, rival)
+        if rival in hosts and rival not in matchups:
+            matchups[rival] = matchups[team]
+
+    games = OrderedDict()
+    names = {name for pair in matchups.values() for name in pair}
+    # Rosters of all teams at once, for invite_teams
+    TeamEntity.select(lambda t: t.name in names).prefetch(
+        TeamEntity.users)[:]
+    for team in hosts:
+        pair = matchups.get(team)
+        if pair is None or pair in games:
+            continue
+        accepted = [PlayerEntity[hosts[name]] for name in pair
+                    if matchups.get(name) == pair]
+        game = GameEntity(
+            teams=[TeamEntity[name] for name in pair],
+            host=PlayerEntity[hosts[pair[0]]],
+            accepted_players=accepted
+        )
+        invite_teams(game)
+        games[pair] = game
+    # For the games' IDs
+    flush()
+
+    after_commit(cache.invalidate,
+                 *[cache.team_key(name) for name in names])
+    return (
+        {ticket_id: games[matchups[team]].id
+         for ticket_id, team, _ in requests if team in matchups},
+        [(game.id, [i.player.username for i in game.invitations])
+         for game in games.values()]
+    )
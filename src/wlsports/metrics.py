@@ -0,0 +1,253 @@
+"""In-process metrics in the Prometheus text format
+
+Everything is aggregated as it happens into plain counters and
+fixed-bucket histograms (one list of counts each), so recording a request
+is a bisect and a few increments; rendering does the rest.
+
+Metrics are per server process. With --workers > 1, every scrape of
+``/api/metrics`` is answered by whichever worker accepts it; each
+worker's ``pid`` label keeps their series apart.
+"""
+import os
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from tornado.ioloop import IOLoop
+
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class Histogram(object):
+    """Counts of observations per bucket, plus their sum"""
+
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for observations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """Prometheus samples, with cumulative buckets"""
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield "{}_bucket".format(name), \
+                dict(labels, le=repr(bound)), total
+        total += self.counts[-1]
+        yield "{}_bucket".format(name), dict(labels, le="+Inf"), total
+        yield "{}_sum".format(name), labels, self.sum
+        yield "{}_count".format(name), labels, total
+
+
+class Metrics(object):
+    """Request, database, hashing and IOLoop metrics of this process"""
+
+    def __init__(self, password_hasher=None, data_layer=None,
+                 response_cache=None, session_store=None, event_bus=None,
+                 match_queue=None):
+        """Stats of the given objects are rendered along with the rest"""
+        self.password_hasher = password_hasher
+        self.data_layer = data_layer
+        self.response_cache = response_cache
+        self.session_store = session_store
+        self.event_bus = event_bus
+        self.match_queue = match_queue
+
+        self.in_flight = 0
+        # By (handler, method)
+        self.latency = defaultdict(Histogram)
+        self.db_time = defaultdict(Histogram)
+        # By (handler, method, status)
+        self.responses = Counter()
+        self.ioloop_lag = Histogram(LAG_BUCKETS)
+
+    def request_started(self):
+        self.in_flight += 1
+
+    def request_finished(self, handler, method, status, elapsed,
+                         db_time=None):
+        self.in_flight -= 1
+        self.latency[handler, method].observe(elapsed)
+        if db_time is not None:
+            self.db_time[handler, method].observe(db_time)
+        self.responses[handler, method, status] += 1
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        pid = {"pid": str(os.getpid())}
+
+        def add(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for sample_name, labels, value in samples:
+                lines.append("{}{{{}}} {}".format(
+                    sample_name,
+                    ",".join('{}="{}"'.format(k, _escape(v))
+                             for k, v in sorted(labels.items())),
+                    _format(value)
+                ))
+
+        add("wlsports_requests_in_flight", "gauge",
+            "Requests being handled",
+            [("wlsports_requests_in_flight", pid, self.in_flight)])
+        add("wlsports_request_duration_seconds", "histogram",
+            "Time from receiving a request to finishing the response",
+            _histogram_samples("wlsports_request_duration_seconds",
+                               self.latency, pid))
+        add("wlsports_responses_total", "counter",
+            "Responses by status code",
+            [("wlsports_responses_total",
+              dict(pid, handler=handler, method=method, status=str(status)),
+              n)
+             for (handler, method, status), n in sorted(
+                 self.responses.items())])
+        add("wlsports_request_db_seconds", "histogram",
+            "Time spent running SQL statements per request",
+            _histogram_samples("wlsports_request_db_seconds",
+                               self.db_time, pid))
+        add("wlsports_ioloop_lag_seconds", "histogram",
+            "How late timed IOLoop callbacks run",
+            self.ioloop_lag.samples("wlsports_ioloop_lag_seconds", pid))
+
+        if self.password_hasher is not None:
+            hasher = self.password_hasher
+            add("wlsports_bcrypt_queue_seconds", "histogram",
+                "Time password hashing jobs wait for a hashing process",
+                hasher.queue_times.samples("wlsports_bcrypt_queue_seconds",
+                                           pid))
+            add("wlsports_bcrypt_hash_seconds_total", "counter",
+                "Time spent hashing passwords",
+                [("wlsports_bcrypt_hash_seconds_total", pid,
+                  hasher.hash_time)])
+            add("wlsports_bcrypt_queue_depth", "gauge",
+                "Password hashing jobs submitted and not finished",
+                [("wlsports_bcrypt_queue_depth", pid, hasher.queue_depth)])
+
+        if self.data_layer is not None:
+            lanes = self.data_layer.stats()
+            add("wlsports_db_pending", "gauge",
+                "Units of database work queued or running",
+                [("wlsports_db_pending", dict(pid, lane=lane),
+                  stats["pending"]) for lane, stats in sorted(lanes.items())])
+            add("wlsports_db_rejected_total", "counter",
+                "Units of database work turned away with a 503",
+                [("wlsports_db_rejected_total", dict(pid, lane=lane),
+                  stats["rejected"]) for lane, stats in sorted(lanes.items())])
+            if self.data_layer.group_commit is not None:
+                stats = self.data_layer.group_commit.stats()
+                add("wlsports_db_group_commits_total", "counter",
+                    "Transactions committed for grouped writes",
+                    [("wlsports_db_group_commits_total", pid,
+                      stats["batches"])])
+                add("wlsports_db_grouped_writes_total", "counter",
+                    "Grouped writes committed",
+                    [("wlsports_db_grouped_writes_total", pid,
+                      stats["units"])])
+                add("wlsports_db_group_commit_retries_total", "counter",
+                    "Grouped writes run again because another one of "
+                    "their transaction failed",
+                    [("wlsports_db_group_commit_retries_total", pid,
+                      stats["retries"])])
+
+        if self.response_cache is not None:
+            stats = self.response_cache.stats()
+            add("wlsports_response_cache_requests_total", "counter",
+                "Response cache lookups by result",
+                [("wlsports_response_cache_requests_total",
+                  dict(pid, result=result), stats[key])
+                 for result, key in [("hit", "hits"), ("miss", "misses")]])
+            add("wlsports_response_cache_entries", "gauge",
+                "Responses in the response cache",
+                [("wlsports_response_cache_entries", pid,
+                  stats["entries"])])
+
+        if self.session_store is not None:
+            stats = self.session_store.stats()
+            add("wlsports_session_cache_requests_total", "counter",
+                "Session store lookups by result; misses query the "
+                "database",
+                [("wlsports_session_cache_requests_total",
+                  dict(pid, result=result), stats[key])
+                 for result, key in [("hit", "hits"), ("miss", "misses")]])
+            add("wlsports_session_cache_entries", "gauge",
+                "Sessions in the session store",
+                [("wlsports_session_cache_entries", pid, stats["entries"])])
+
+        if self.event_bus is not None:
+            stats = self.event_bus.stats()
+            add("wlsports_events_published_total", "counter",
+                "Events published to players",
+                [("wlsports_events_published_total", pid,
+                  stats["published"])])
+            add("wlsports_event_subscribers", "gauge",
+                "Open long polls and WebSockets waiting for events",
+                [("wlsports_event_subscribers", pid, stats["subscribers"])])
+
+        if self.match_queue is not None:
+            stats = self.match_queue.stats()
+            add("wlsports_matchmaking_waiting", "gauge",
+                "Teams queued for matchmaking, or being matched",
+                [("wlsports_matchmaking_waiting", pid, stats["waiting"])])
+            add("wlsports_matchmaking_batches_total", "counter",
+                "Batches of queued teams matched",
+                [("wlsports_matchmaking_batches_total", pid,
+                  stats["batches"])])
+            add("wlsports_matchmaking_tickets_total", "counter",
+                "Matchmaking tickets settled, by outcome",
+                [("wlsports_matchmaking_tickets_total",
+                  dict(pid, status=status), count)
+                 for status, count in sorted(stats["settled"].items())])
+
+        return "\n".join(lines) + "\n"
+
+
+class LagMonitor(object):
+    """Measures IOLoop lag: how late a callback scheduled every
+    ``interval`` seconds actually runs
+    """
+
+    def __init__(self, histogram, interval=0.5):
+        self.histogram = histogram
+        self.interval = interval
+        self._expected = None
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        self._expected = time.time() + self.interval
+        IOLoop.current().call_later(self.interval, self._tick)
+
+    def _tick(self):
+        self.histogram.observe(max(time.time() - self._expected, 0))
+        self._schedule()
+
+
+def _histogram_samples(name, histograms, labels):
+    for (handler, method), histogram in sorted(histograms.items()):
+        for sample in histogram.samples(
+                name, dict(labels, handler=handler, method=method)):
+            yield sample
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
@@ -0,0 +1,92 @@
+"""Versioned changes to existing databases
+
+``generate_mapping(create_tables=True)`` creates missing tables, along
+with the indexes declared on entities (``index=True`` and
+``composite_index``), in new and existing databases alike. It never
+changes anything that already exists, though, and Pony can't declare
+indexes on the join tables of many-to-many relationships. Everything
+else is a migration: a numbered list of SQL statements, or of functions
+for changes that take more than SQL, e.g., filling a new table from
+data that has to be parsed.
+
+The number of the last migration applied is kept in SQLite's
+``user_version``. ``migrate()`` applies the ones after it in order, each
+in a transaction of its own along with the new number, so a failure
+leaves the database at the last migration that succeeded. It runs right
+after ``generate_mapping``, i.e., once every table exists, so new
+databases go through all migrations too.
+
+Never change a migration that has shipped; add another one.
+"""
+from collections import namedtuple
+
+from pony.orm import db_session
+
+from wlsports import scores
+from wlsports.db import database
+
+
+Migration = namedtuple("Migration", ["version", "description", "statements"])
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "Covering indexes on join tables for lookups by team",
+        [
+            # Games of a team (find_games, exports)
+            'CREATE INDEX IF NOT EXISTS "idx_game_team__team_game" '
+            'ON "Game_Team" ("team", "game")',
+            # Rosters (conflicting_teams, leaderboard cities)
+            'CREATE INDEX IF NOT EXISTS "idx_player_team__team_player" '
+            'ON "Player_Team" ("team", "player")',
+        ]
+    ),
+    Migration(
+        2,
+        "Scores by team of games finished before there were any",
+        [
+            # Records of a team, overall and against one opponent
+            'CREATE INDEX IF NOT EXISTS '
+            '"idx_gamescore__team_opponent_points" ON "GameScore" '
+            '("team", "opponent", "points_for", "points_against")',
+            scores.backfill,
+        ]
+    ),
+]
+
+LATEST = MIGRATIONS[-1].version
+
+
+def current_version():
+    """Number of the last migration applied; needs a db_session"""
+    # Not database.select, which would prepend SELECT to a PRAGMA
+    return database.execute("PRAGMA user_version").fetchone()[0]
+
+
+def pending():
+    """Migrations not applied yet; needs a db_session"""
+    version = current_version()
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def migrate():
+    """Apply pending migrations; call outside of a db_session, with the
+    database bound and mapped
+
+    :returns: Migrations applied
+    """
+    applied = []
+    for migration in MIGRATIONS:
+        with db_session:
+            if migration.version <= current_version():
+                continue
+            for statement in migration.statements:
+                if callable(statement):
+                    # Called in the migration's db_session
+                    statement()
+                else:
+                    database.execute(statement)
+            database.execute(
+                "PRAGMA user_version = {:d}".format(migration.version))
+        applied.append(migration)
+    return applied
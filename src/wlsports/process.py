@@ -0,0 +1,85 @@
+"""Pre-fork worker supervision"""
+import errno
+import logging
+import os
+import signal
+import sys
+import time
+
+
+# A worker dying sooner than this after starting counts as a crash loop
+MIN_WORKER_UPTIME = 1.0
+
+
+def fork_workers(num_workers, max_restarts=100):
+    """Fork ``num_workers`` worker processes and supervise them
+
+    Call after binding listening sockets so that all workers share them.
+    Returns the worker's id (0 to ``num_workers - 1``) in each worker;
+    the master process never returns from here. It restarts workers that
+    die unless it is shutting down, and on SIGTERM or SIGINT it passes
+    SIGTERM on to every worker, waits for them to finish, and exits.
+    """
+    children = {}
+    started = {}
+    stopping = []
+
+    def start(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            # Workers install their own handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            return worker_id
+        children[pid] = worker_id
+        started[worker_id] = time.time()
+        return None
+
+    def stop(sig, frame):
+        logging.warning('Master caught signal: %s', sig)
+        stopping.append(sig)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    for worker_id in range(num_workers):
+        if start(worker_id) is not None:
+            return worker_id
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+
+        if os.WIFSIGNALED(status):
+            reason = "killed by signal {}".format(os.WTERMSIG(status))
+        else:
+            reason = "exit status {}".format(os.WEXITSTATUS(status))
+        restarts += 1
+        if restarts > max_restarts:
+            logging.error("Too many worker restarts; shutting down")
+            stop(signal.SIGTERM, None)
+            continue
+        logging.warning("Worker %d (pid %d) died (%s); restarting",
+                        worker_id, pid, reason)
+        if time.time() - started[worker_id] < MIN_WORKER_UPTIME:
+            time.sleep(MIN_WORKER_UPTIME)
+            if stopping:
+                continue
+        if start(worker_id) is not None:
+            return worker_id
+
+    logging.info("All workers stopped")
+    sys.exit(0)
@@ -0,0 +1,120 @@
+"""Query plan check for the hot queries
+
+``check()`` runs the queries behind the most frequent requests (see
+``_hot_queries``) against the bound database, through the same functions
+the handlers use, so that the SQL is exactly what Pony generates, and
+asks SQLite how it would run each statement with EXPLAIN QUERY PLAN. A
+statement that reads a whole table, or a whole index, instead of
+searching it gets slower with every row added, so any such full scan
+fails the check.
+
+The queries run in a transaction that is rolled back, with sample
+arguments taken from the database (or made up for an empty one). Plans
+may change with the data once ANALYZE has been run, so check against a
+database of realistic size; see ./check_query_plans.py.
+"""
+import datetime
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+
+from pony.orm import db_session, rollback, select
+
+from wlsports import games, invitations, leaderboard, scores, search, \
+    sessions
+from wlsports.db import Game as GameEntity
+from wlsports.db import Player as PlayerEntity
+from wlsports.db import Sport as SportEntity
+from wlsports.db import Team as TeamEntity
+from wlsports.db import database
+from wlsports.matchmaking import conflicting_teams
+from wlsports.ranking import RankingIndex
+
+
+# Statement of a hot query and SQLite's plan for it, one line per step
+Plan = namedtuple("Plan", ["query", "sql", "steps", "full_scans"])
+
+# "SCAN Game" on SQLite 3.36 and later, "SCAN TABLE Game AS g" before
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\S+)")
+
+
+def check():
+    """Plans of every statement of the hot queries; call outside of a
+    db_session
+
+    :returns: [Plan, ...]; the check failed if any has ``full_scans``
+    """
+    plans = []
+    with db_session:
+        for name, query in _hot_queries(*_samples()):
+            with _capturing() as statements:
+                query()
+            for sql, arguments in statements:
+                if not sql.lstrip().upper().startswith(
+                        ("SELECT", "UPDATE", "DELETE")):
+                    continue
+                steps = [row[-1] for row in database.get_connection().execute(
+                    "EXPLAIN QUERY PLAN " + sql, arguments or ()
+                ).fetchall()]
+                plans.append(Plan(name, sql, steps, _full_scans(steps)))
+        rollback()
+    return plans
+
+
+def _hot_queries(sport, team, player, game_ids):
+    day = datetime.date(2015, 6, 13)
+    return [
+        ("rankings", lambda: RankingIndex(sport).load()),
+        ("leaderboard", lambda: leaderboard._build(sport, 0)),
+        ("invitations", lambda: invitations.get_player_invitations(player)),
+        ("invitation check",
+         lambda: invitations.is_invited(player, game_ids[0])),
+        ("conflicting teams", lambda: conflicting_teams(team)),
+        ("games by ID", lambda: games.get_games(game_ids)),
+        ("games of a team", lambda: games.find_games(team=team)),
+        ("games of a player", lambda: games.find_games(player=player)),
+        ("games by date", lambda: games.find_games(
+            date_from=day, date_to=day + datetime.timedelta(days=7))),
+        ("games after an ID",
+         lambda: games.find_games(after=game_ids[0])),
+        ("export of a team", lambda: games.export_chunk(team=team)),
+        ("team record", lambda: scores.team_record(team)),
+        ("head to head", lambda: scores.head_to_head(team, team)),
+        ("session", lambda: sessions.lookup("0" * 48)),
+        ("logout everywhere", lambda: sessions.revoke_player(player)),
+        ("expired sessions", lambda: sessions.purge_expired()),
+        ("player search", lambda: search.search_players(player[:3] or "a")),
+    ]
+
+
+def _samples():
+    """(sport, team, player, game IDs) that exist if there are any"""
+    sport = select(s.name for s in SportEntity).first() or u"Soccer"
+    team = select(t.name for t in TeamEntity).first() or u"team"
+    player = select(p.username for p in PlayerEntity).first() or u"player"
+    game_ids = list(select(g.id for g in GameEntity).limit(2)) or [1, 2]
+    return sport, team, player, game_ids
+
+
+def _full_scans(steps):
+    return [step for step in steps if _SCAN.match(step) and not (
+        "VIRTUAL TABLE" in step or
+        _SCAN.match(step).group(1).startswith(("(", "SUBQUERY", "CONSTANT"))
+    )]
+
+
+@contextmanager
+def _capturing():
+    """Collect the (SQL, arguments) of statements Pony runs meanwhile"""
+    statements = []
+    exec_sql = database._exec_sql
+
+    def capture(sql, arguments=None, *args, **kwargs):
+        statements.append((sql, arguments))
+        return exec_sql(sql, arguments, *args, **kwargs)
+
+    database._exec_sql = capture
+    try:
+        yield statements
+    finally:
+        database._exec_sql = exec_sql
@@ -0,0 +1,271 @@
+"""In-process ranking index per sport
+
+A team's overall ranking is the sum of its position among teams of its
+sport sorted by win/loss ratio and its position sorted by points ratio
+(both descending; ties keep team creation order). Both orderings are kept
+as sorted lists, so a team's summed ranking is two bisects, and teams
+are re-slotted individually when their stats change instead of
+re-sorting the whole sport on every request.
+
+The order by summed ranking (for positions and matchmaking) is sorted
+once, when first needed, and then kept sorted the same way: when a team
+is re-slotted, only the teams it moved past in either ordering have
+their sum changed, so only those are taken out of the order and put
+back in.
+
+Writers call ``bump()`` as part of the transaction that changes a team's
+stats and ``refresh_team()`` once it has committed; the index is rebuilt
+whenever it has missed a change, e.g., one made by another worker
+process (see wlsports.generations).
+"""
+import threading
+from bisect import bisect_left, insort
+
+from pony.orm import select
+
+from wlsports import generations
+from wlsports.db import Team as TeamEntity
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class RankingIndex(object):
+    """Rankings for all teams of one sport"""
+
+    def __init__(self, sport_name):
+        self.sport_name = sport_name
+        # Generation of the sport's rankings this index is current as of
+        self.generation = None
+        self._lock = threading.RLock()
+        self._next_seq = 0
+        # name -> (wl_key, points_key); keys are (-ratio, seq, name)
+        self._keys = {}
+        self._by_wl = []
+        self._by_points = []
+        # Ordering by summed ranking, built lazily: sorted list of
+        #   (sum, wl position, name), and name -> its entry
+        self._order = None
+        self._ranks = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, team_name):
+        return team_name in self._keys
+
+    def load(self, generation=None):
+        """(Re)build the index from the database; needs a db_session"""
+        rows = select(
+            (t.name, t.wins, t.losses, t.points_ratio) for t in TeamEntity
+            if t.sport.name == self.sport_name
+        )[:]
+        with self._lock:
+            self._next_seq = 0
+            self._keys = {}
+            self._by_wl = []
+            self._by_points = []
+            for name, wins, losses, points_ratio in rows:
+                wl_key, points_key = self._make_keys(
+                    name, wins, losses, points_ratio
+                )
+                self._keys[name] = (wl_key, points_key)
+                self._by_wl.append(wl_key)
+                self._by_points.append(points_key)
+            self._by_wl.sort()
+            self._by_points.sort()
+            self._invalidate()
+            self.generation = generation
+
+    def update(self, name, wins, losses, points_ratio, generation=None):
+        """Insert team ``name`` or re-slot it with its new stats
+
+        :param generation: Generation that the change was recorded as;
+            the index only becomes current as of it if it did not miss
+            any earlier change
+        """
+        with self._lock:
+            old = self._keys.get(name)
+            if old is not None:
+                old_wl = bisect_left(self._by_wl, old[0])
+                old_points = bisect_left(self._by_points, old[1])
+                del self._by_wl[old_wl]
+                del self._by_points[old_points]
+            wl_key, points_key = self._make_keys(
+                name, wins, losses, points_ratio,
+                seq=old[0][1] if old is not None else None
+            )
+            self._keys[name] = (wl_key, points_key)
+            new_wl = bisect_left(self._by_wl, wl_key)
+            new_points = bisect_left(self._by_points, points_key)
+            self._by_wl.insert(new_wl, wl_key)
+            self._by_points.insert(new_points, points_key)
+            if old is None:
+                # Every team after it moves down; start over
+                self._invalidate()
+            elif self._order is not None:
+                self._reorder(old_wl, new_wl, old_points, new_points)
+            if generation is not None and \
+                    self.generation in (generation - 1, generation):
+                self.generation = generation
+
+    def rank_sum(self, name):
+        """Summed ranking of team ``name`` (lower is better)"""
+        with self._lock:
+            wl_key, points_key = self._keys[name]
+            return (bisect_left(self._by_wl, wl_key) +
+                    bisect_left(self._by_points, points_key))
+
+    def position(self, name):
+        """0-based place of team ``name`` when ordered by summed ranking"""
+        with self._lock:
+            self._build_order()
+            return bisect_left(self._order, self._ranks[name])
+
+    def neighbours(self, name):
+        """Yield (distance, team name) for every other team, closest
+        summed ranking first
+
+        Walks outwards from ``name`` in the summed ranking order, so
+        consumers only pay for the teams they actually look at.
+        """
+        with self._lock:
+            self._build_order()
+            # Changes replace this list rather than mutating it, so it's
+            #   safe to keep walking it outside of the lock
+            order = self._order
+            i = bisect_left(order, self._ranks[name])
+        mine = order[i][0]
+        lo, hi = i - 1, i + 1
+        while lo >= 0 or hi < len(order):
+            if hi >= len(order) or (
+                lo >= 0 and mine - order[lo][0] <= order[hi][0] - mine
+            ):
+                yield mine - order[lo][0], order[lo][2]
+                lo -= 1
+            else:
+                yield order[hi][0] - mine, order[hi][2]
+                hi += 1
+
+    def ordered(self):
+        """[(team name, summed ranking), ...] of every team, best first"""
+        with self._lock:
+            self._build_order()
+            return [(name, rank_sum) for rank_sum, _, name in self._order]
+
+    def overall(self):
+        """Dict of team name to summed ranking for every team"""
+        with self._lock:
+            self._build_order()
+            return {name: rank_sum for rank_sum, _, name in self._order}
+
+    def _make_keys(self, name, wins, losses, points_ratio, seq=None):
+        if seq is None:
+            seq = self._next_seq
+            self._next_seq += 1
+        wlratio = float(wins) / (losses or 1)
+        return (-wlratio, seq, name), (-points_ratio, seq, name)
+
+    def _invalidate(self):
+        self._order = self._ranks = None
+
+    def _build_order(self):
+        if self._order is not None:
+            return
+        # Ties on the sum are broken by win/loss position
+        sums = {}
+        for i, (_, _, name) in enumerate(self._by_wl):
+            sums[name] = i
+        for i, (_, _, name) in enumerate(self._by_points):
+            sums[name] += i
+        self._ranks = {
+            name: (sums[name], i, name)
+            for i, (_, _, name) in enumerate(self._by_wl)
+        }
+        self._order = sorted(self._ranks.values())
+
+    def _reorder(self, old_wl, new_wl, old_points, new_points):
+        """Re-slot the teams whose positions changed when one team moved
+        from ``old_wl`` to ``new_wl`` by win/loss ratio and from
+        ``old_points`` to ``new_points`` by points ratio
+
+        Those are the teams between the two positions in either ordering;
+        everyone else keeps their sum and place.
+        """
+        # name -> [wl position, points position], new ones where known
+        moved = {}
+        wl_lo, wl_hi = sorted((old_wl, new_wl))
+        for i in range(wl_lo, wl_hi + 1):
+            name = self._by_wl[i][2]
+            rank_sum, wl, _ = self._ranks[name]
+            moved[name] = [i, rank_sum - wl]
+        points_lo, points_hi = sorted((old_points, new_points))
+        for i in range(points_lo, points_hi + 1):
+            name = self._by_points[i][2]
+            if name not in moved:
+                rank_sum, wl, _ = self._ranks[name]
+                moved[name] = [wl, i]
+            else:
+                moved[name][1] = i
+
+        # A copy, as neighbours() may be walking the current one
+        order = list(self._order)
+        for name in moved:
+            del order[bisect_left(order, self._ranks[name])]
+        for name, (wl, points) in moved.items():
+            self._ranks[name] = (wl + points, wl, name)
+            insort(order, self._ranks[name])
+        self._order = order
+
+
+def get_index(sport_name):
+    """Get the RankingIndex for ``sport_name``, (re)building it if it is
+    missing or has missed a change
+
+    Must be called inside a db_session.
+    """
+    generation = current(sport_name)
+    index = _indexes.get(sport_name)
+    if index is None or index.generation != generation:
+        with _indexes_lock:
+            index = _indexes.get(sport_name)
+            if index is None:
+                index = RankingIndex(sport_name)
+                _indexes[sport_name] = index
+            if index.generation != generation:
+                index.load(generation)
+    return index
+
+
+def current(sport_name):
+    """Current generation of the rankings of ``sport_name``; with shared
+    generations, this needs a db_session
+    """
+    return generations.current(_generation_name(sport_name))
+
+
+def bump(sport_name):
+    """Record that rankings of ``sport_name`` are changing
+
+    Call inside the transaction making the change; returns the generation
+    to pass to ``refresh_team``.
+    """
+    return generations.bump(_generation_name(sport_name))
+
+
+def refresh_team(team, generation):
+    """Update the index with the current stats of ``team``
+
+    Call after the change to ``team`` has been committed.
+    """
+    index = _indexes.get(team.sport.name)
+    if index is None:
+        # Not built yet; it will pick up the team when it is
+        return
+    index.update(team.name, team.wins, team.losses, team.points_ratio,
+                 generation)
+
+
+def _generation_name(sport_name):
+    return "ranking:{}".format(sport_name)
@@ -0,0 +1,188 @@
+"""Rebuilding team standings from the full game history
+
+Standings (wins, losses, ties and points ratio) are otherwise only ever
+updated in place, one finished game at a time, by
+``wlsports.results.record_result``. ``recompute()`` throws them away and
+derives them again from the ``final_score`` of every finished game, e.g.,
+after a wrong score has been fixed, with the same formula:
+
+* one win, loss or tie per game
+* after its k-th game, a team's points ratio grows by that game's ratio
+  of its score to the other team's, divided by k (or not at all, if the
+  other team scored zero)
+
+Games count in the order of their IDs, i.e., the order they were
+created in, as the order they finished in is not recorded.
+
+All games are loaded into NumPy arrays (one entry per team per game) and
+the stats of every team of every sport come out of one pass of
+vectorized operations, so it is parsing ``final_score`` that takes most
+of the time.
+"""
+from __future__ import division
+
+import json
+import time
+from collections import namedtuple
+
+import numpy as np
+from pony.orm import commit
+
+from wlsports import cache, scores
+from wlsports.db import database
+from wlsports.ranking import bump as bump_rankings
+
+
+# Teams updated per transaction
+WRITE_BATCH_SIZE = 10000
+
+# One array entry per team; see compute_stats
+TeamStats = namedtuple(
+    "TeamStats",
+    ["wins", "losses", "ties", "points_ratio"]
+)
+
+
+def recompute():
+    """Recompute the standings of all teams from finished games and write
+    them back; needs a db_session
+
+    Writes are committed every WRITE_BATCH_SIZE teams. The scores by
+    team that records are aggregated from (see wlsports.scores) are
+    rebuilt from the same games afterwards, in a transaction of their
+    own. Rankings and cached responses of every sport are invalidated.
+
+    :returns: Dict with the numbers of teams updated, games counted and
+        games skipped because their final score was unusable, and the
+        seconds taken
+    """
+    started = time.time()
+    teams = database.select('SELECT name, sport FROM "Team" ORDER BY name')
+    names = [name for name, _ in teams]
+    sports = sorted({sport for _, sport in teams})
+
+    rows = database.select(
+        'SELECT final_score FROM "Game" '
+        'WHERE final_score <> \'\' AND NOT coalesce(cancelled, 0) '
+        'ORDER BY id'
+    )
+    team_a, team_b, score_a, score_b, skipped = parse_scores(
+        rows, {name: i for i, name in enumerate(names)}
+    )
+    stats = compute_stats(len(names), team_a, team_b, score_a, score_b)
+
+    for first in range(0, len(names), WRITE_BATCH_SIZE):
+        last = first + WRITE_BATCH_SIZE
+        # Going around Pony's entity cache; nothing here loaded Teams
+        database.get_connection().executemany(
+            'UPDATE "Team" SET wins = ?, losses = ?, ties = ?, '
+            'points_ratio = ? WHERE name = ?',
+            zip(stats.wins[first:last].tolist(),
+                stats.losses[first:last].tolist(),
+                stats.ties[first:last].tolist(),
+                stats.points_ratio[first:last].tolist(),
+                names[first:last])
+        )
+        # Every transaction leaves the ranking indexes stale, in case
+        #   one is rebuilt from a half-written sport in between
+        for sport in sports:
+            bump_rankings(sport)
+        commit()
+
+    # Going around Pony's entity cache, like the standings
+    database.execute('DELETE FROM "GameScore"')
+    scores.backfill()
+    commit()
+    cache.invalidate(*(cache.sport_key(sport) for sport in sports))
+
+    return {
+        "teams": len(names),
+        "games": len(team_a),
+        "skipped": skipped,
+        "seconds": time.time() - started,
+    }
+
+
+def parse_scores(rows, team_index):
+    """Teams and scores of finished games from their ``final_score``
+
+    Games whose final score isn't a JSON object of two known team names
+    to numbers of zero or more are skipped.
+
+    :param rows: ``final_score`` of every game
+    :param team_index: Dict of team name to index
+    :returns: (team_a, team_b, score_a, score_b, number skipped), with
+        arrays of team indexes and scores of each game counted
+    """
+    try:
+        # One parse of all of them is much faster than one each
+        scores = json.loads("[{}]".format(",".join(rows)))
+    except ValueError:
+        scores = []
+        for row in rows:
+            try:
+                scores.append(json.loads(row))
+            except ValueError:
+                scores.append(None)
+
+    team_a, team_b, score_a, score_b = [], [], [], []
+    for score in scores:
+        try:
+            (name_a, a), (name_b, b) = score.items()
+            i, j = team_index[name_a], team_index[name_b]
+            a, b = float(a), float(b)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            continue
+        if a >= 0 and b >= 0:
+            team_a.append(i)
+            team_b.append(j)
+            score_a.append(a)
+            score_b.append(b)
+
+    return (
+        np.array(team_a, dtype=np.intp),
+        np.array(team_b, dtype=np.intp),
+        np.array(score_a, dtype=np.float64),
+        np.array(score_b, dtype=np.float64),
+        len(scores) - len(team_a),
+    )
+
+
+def compute_stats(num_teams, team_a, team_b, score_a, score_b):
+    """Standings of ``num_teams`` teams after the given games, in order
+
+    :returns: TeamStats of arrays indexed by team
+    """
+    # One entry per team per game, in the order of the games: the team,
+    #   its score and the other team's
+    team = np.column_stack([team_a, team_b]).ravel()
+    own = np.column_stack([score_a, score_b]).ravel()
+    other = np.column_stack([score_b, score_a]).ravel()
+
+    wins = np.bincount(team, weights=own > other, minlength=num_teams)
+    losses = np.bincount(team, weights=own < other, minlength=num_teams)
+    ties = np.bincount(team, weights=own == other, minlength=num_teams)
+
+    # k, the number of the game for its team, from entries sorted by team
+    #   and then position; sorting one combined key is several times
+    #   faster than a stable argsort of the teams
+    m = len(team)
+    keys = np.sort(team.astype(np.int64) * m + np.arange(m))
+    team = keys // m
+    order = keys % m
+    games_played = np.bincount(team, minlength=num_teams)
+    firsts = np.cumsum(games_played) - games_played
+    k = np.arange(len(team)) - firsts[team] + 1
+    # Like record_result, games against a score of zero count for k but
+    #   add nothing, as their ratio is undefined
+    ratio = np.zeros(m)
+    np.divide(own, other, out=ratio, where=other > 0)
+    points_ratio = np.bincount(team, weights=ratio[order] / k,
+                               minlength=num_teams)
+
+    return TeamStats(
+        wins=wins.astype(np.int64),
+        losses=losses.astype(np.int64),
+        ties=ties.astype(np.int64),
+        points_ratio=points_ratio.astype(np.float64),
+    )
@@ -0,0 +1,37 @@
+"""Recording game results in team standings"""
+from __future__ import division
+
+
+def record_result(team_a, team_b, final_score):
+    """Update wins, losses, ties and points ratios of ``team_a`` and
+    ``team_b`` for a game that ended with ``final_score``
+
+    A team's ratio of its score to the other team's is undefined if the
+    other team scored zero (or both did); the game then counts as a win,
+    loss or tie, but leaves the team's points ratio as it was.
+
+    :param final_score: Dict of team name to score
+    """
+    score_a, score_b = final_score[team_a.name], final_score[team_b.name]
+    ratio_a = score_a / score_b if score_b else None
+    ratio_b = score_b / score_a if score_a else None
+
+    # Set wins, losses and ties
+    if score_a > score_b:
+        team_a.wins += 1
+        team_b.losses += 1
+    elif score_a < score_b:
+        team_b.wins += 1
+        team_a.losses += 1
+    else:
+        team_a.ties += 1
+        team_b.ties += 1
+
+    # Calculate new points_ratio
+    for team, ratio in [(team_a, ratio_a), (team_b, ratio_b)]:
+        if ratio is None:
+            continue
+        total_games = team.wins + team.losses + team.ties
+        team.points_ratio = (
+            (team.points_ratio * max(total_games, 0)) + ratio
+        ) / total_games
@@ -0,0 +1,109 @@
+"""Schema validation of API handler input and output
+
+A drop-in replacement for ``tornado_json.schema.validate``, which calls
+``jsonschema.validate`` on every request: that checks the schema itself
+against the JSON Schema meta-schema and builds a new validator each
+time, for the input and again for the output. Here, both validators are
+built (and the schemas checked) once, when handler modules are imported
+to register their routes, and reused for every request.
+
+Output validation only catches mistakes of ours, so it can be sampled or
+turned off with ``Config.output_validation_rate`` (--output-validation-
+rate); input is always validated.
+"""
+import json
+import random
+from functools import wraps
+
+import jsonschema
+from jsonschema.validators import validator_for
+from tornado import gen
+from tornado.concurrent import is_future
+from tornado_json.exceptions import APIError
+from tornado_json.schema import input_schema_clean
+from tornado_json.utils import container
+
+
+def compile_schema(schema, format_checker=None):
+    """Check ``schema`` and return a validator for it
+
+    :raises jsonschema.SchemaError: If ``schema`` is invalid
+    """
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema, format_checker=format_checker)
+
+
+def validate(input_schema=None, output_schema=None,
+             input_example=None, output_example=None,
+             format_checker=None, on_empty_404=False, use_defaults=False):
+    """Parameterized decorator for schema validation; takes the same
+    arguments as ``tornado_json.schema.validate``, and sets the same
+    attributes on the handler method for the API documentation
+    """
+    input_validator = None
+    if input_schema is not None:
+        input_validator = compile_schema(input_schema, format_checker)
+    output_validator = None
+    if output_schema is not None:
+        # Output is wrapped in an object before validating in case it is
+        #   a string (and ergo not a validatable JSON object)
+        output_validator = compile_schema({
+            "type": "object",
+            "properties": {
+                "result": output_schema
+            },
+            "required": ["result"]
+        })
+
+    # container keeps the method as orig_func, which get_routes inspects
+    #   for URL arguments
+    @container
+    def _validate(rh_method):
+        @wraps(rh_method)
+        @gen.coroutine
+        def _wrapper(self, *args, **kwargs):
+            # With no input_schema, the body is left alone (and
+            #   self.body is None)
+            if input_validator is not None:
+                try:
+                    input_ = json.loads(self.request.body.decode("UTF-8"))
+                except ValueError:
+                    raise jsonschema.ValidationError(
+                        "Input is malformed; could not decode JSON object."
+                    )
+                if use_defaults:
+                    input_ = input_schema_clean(input_, input_schema)
+                input_validator.validate(input_)
+            else:
+                input_ = None
+
+            self.body = input_
+            output = rh_method(self, *args, **kwargs)
+            if is_future(output):
+                output = yield output
+
+            if not output and on_empty_404:
+                raise APIError(404, "Resource not found.")
+
+            if output_validator is not None and _should_validate_output(
+                    self.settings['app_config'].output_validation_rate):
+                try:
+                    output_validator.validate({"result": output})
+                except jsonschema.ValidationError as e:
+                    # Re-raised as a TypeError so that the client only
+                    #   sees a 500, not details of our own mistake
+                    raise TypeError(str(e))
+
+            self.success(output)
+
+        _wrapper.input_schema = input_schema
+        _wrapper.output_schema = output_schema
+        _wrapper.input_example = input_example
+        _wrapper.output_example = output_example
+        return _wrapper
+    return _validate
+
+
+def _should_validate_output(rate):
+    return rate >= 1 or (rate > 0 and random.random() < rate)
@@ -0,0 +1,120 @@
+"""Scores of finished games by team, and records aggregated from them
+
+``Game.final_score`` keeps the JSON object of team name to score that
+clients get; alongside it, every finished game has a GameScore for each
+of its two teams, with the team's score and its opponent's. A team's
+record, overall or against one opponent, is then one aggregate query
+over the (team, opponent, points_for, points_against) index, however
+many games have been played, instead of parsing every game's JSON.
+
+``record()`` adds them when a game finishes; ``backfill()`` derives them
+for games that finished before there were any. Both the index and the
+backfill come from migration 2 (see wlsports.migrations).
+"""
+import json
+from itertools import groupby
+
+from wlsports.db import GameScore, database
+
+
+# Aggregates of GameScore rows that make up a record; see _record
+_RECORD = (
+    'count(*), '
+    'coalesce(sum(points_for > points_against), 0), '
+    'coalesce(sum(points_for < points_against), 0), '
+    'coalesce(sum(points_for = points_against), 0), '
+    'coalesce(sum(points_for), 0), '
+    'coalesce(sum(points_against), 0)'
+)
+
+
+def record(game, team_a, team_b, final_score):
+    """Add the scores of ``game``, which ``team_a`` and ``team_b`` just
+    finished with ``final_score``; needs a db_session
+
+    :param final_score: Dict of team name to score
+    """
+    score_a, score_b = final_score[team_a.name], final_score[team_b.name]
+    GameScore(game=game, team=team_a, opponent=team_b,
+              points_for=score_a, points_against=score_b)
+    GameScore(game=game, team=team_b, opponent=team_a,
+              points_for=score_b, points_against=score_a)
+
+
+def team_record(team):
+    """Record of the team named ``team`` in all of its finished games;
+    needs a db_session
+
+    :returns: Dict of the numbers of games, wins, losses and ties, and
+        the points scored for and against the team
+    """
+    rows = database.select(
+        'SELECT ' + _RECORD + ' FROM "GameScore" WHERE team = $team'
+    )
+    return _record(rows[0])
+
+
+def head_to_head(team, opponent):
+    """Record of the team named ``team`` in its finished games against
+    ``opponent``, like ``team_record``; needs a db_session
+    """
+    rows = database.select(
+        'SELECT ' + _RECORD + ' FROM "GameScore" '
+        'WHERE team = $team AND opponent = $opponent'
+    )
+    return _record(rows[0])
+
+
+def _record(row):
+    games, wins, losses, ties, points_for, points_against = row
+    return {
+        "games": games,
+        "wins": wins,
+        "losses": losses,
+        "ties": ties,
+        "points_for": points_for,
+        "points_against": points_against,
+    }
+
+
+def backfill():
+    """Add the scores of finished games that have none from their
+    ``final_score``; needs a db_session
+
+    Games whose final score isn't a JSON object of the game's two teams
+    to numbers of zero or more are skipped, like ratings.recompute does.
+
+    :returns: (number of games backfilled, number skipped)
+    """
+    rows = database.select(
+        'SELECT g.id, g.final_score, gt.team '
+        'FROM "Game" g JOIN "Game_Team" gt ON gt.game = g.id '
+        'WHERE g.final_score <> \'\' AND NOT coalesce(g.cancelled, 0) '
+        'AND g.id NOT IN (SELECT game FROM "GameScore") '
+        'ORDER BY g.id'
+    )
+    scores = []
+    skipped = 0
+    for (game_id, final_score), game_rows in groupby(
+            rows, key=lambda row: row[:2]):
+        teams = {team for _, _, team in game_rows}
+        try:
+            (name_a, a), (name_b, b) = json.loads(final_score).items()
+            a, b = float(a), float(b)
+        except (AttributeError, TypeError, ValueError):
+            skipped += 1
+            continue
+        if {name_a, name_b} != teams or a < 0 or b < 0:
+            skipped += 1
+            continue
+        scores.append((game_id, name_a, name_b, a, b))
+        scores.append((game_id, name_b, name_a, b, a))
+
+    # Going around Pony's entity cache, like wlsports.ratings
+    database.get_connection().executemany(
+        'INSERT INTO "GameScore" '
+        '(game, team, opponent, points_for, points_against) '
+        'VALUES (?, ?, ?, ?, ?)',
+        scores
+    )
+    return len(scores) // 2, skipped
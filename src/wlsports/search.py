@@ -0,0 +1,134 @@
+"""Player search
+
+Players are indexed by username, first and last name and city in an
+SQLite FTS5 table that mirrors the Player table through triggers, so
+every write path (registration, bulk loads, manual edits) keeps it
+current without any application code. If SQLite was built without FTS5,
+search falls back to a prefix range scan on the username primary key.
+"""
+import re
+
+from pony.orm import select, OperationalError
+
+from wlsports.db import database, Player as PlayerEntity
+
+
+# Column weights for bm25(): username matches rank highest
+RANK_WEIGHTS = (10.0, 2.0, 2.0, 1.0)
+MAX_LIMIT = 50
+
+_FTS_TABLE = '''
+CREATE VIRTUAL TABLE "PlayerSearch" USING fts5(
+    username, first, last, city,
+    content="Player",
+    prefix="1 2 3",
+    tokenize="unicode61 remove_diacritics 2"
+)
+'''
+_FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS "PlayerSearch_ai" AFTER INSERT ON "Player"
+    BEGIN
+        INSERT INTO "PlayerSearch" (rowid, username, first, last, city)
+        VALUES (new.rowid, new.username, new.first, new.last, new.city);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "PlayerSearch_ad" AFTER DELETE ON "Player"
+    BEGIN
+        INSERT INTO "PlayerSearch"
+            ("PlayerSearch", rowid, username, first, last, city)
+        VALUES ('delete', old.rowid, old.username, old.first, old.last,
+                old.city);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS "PlayerSearch_au" AFTER UPDATE ON "Player"
+    BEGIN
+        INSERT INTO "PlayerSearch"
+            ("PlayerSearch", rowid, username, first, last, city)
+        VALUES ('delete', old.rowid, old.username, old.first, old.last,
+                old.city);
+        INSERT INTO "PlayerSearch" (rowid, username, first, last, city)
+        VALUES (new.rowid, new.username, new.first, new.last, new.city);
+    END
+    ''',
+]
+
+_use_fts = False
+
+
+def setup():
+    """Create the search index and its triggers if missing
+
+    Must be called inside a db_session once the database is bound.
+    Returns whether full-text search is available.
+    """
+    global _use_fts
+
+    exists = database.select(
+        "SELECT name FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'PlayerSearch'"
+    )
+    if not exists:
+        try:
+            database.execute(_FTS_TABLE)
+        except OperationalError:
+            # No FTS5 in this SQLite build
+            _use_fts = False
+            return _use_fts
+        # Index players that were registered before the table existed
+        database.execute(
+            'INSERT INTO "PlayerSearch" ("PlayerSearch") VALUES (\'rebuild\')'
+        )
+    for trigger in _FTS_TRIGGERS:
+        database.execute(trigger)
+
+    _use_fts = True
+    return _use_fts
+
+
+def search_players(query, limit=10, offset=0):
+    """Search for players matching every word in ``query`` as a prefix
+
+    Must be called inside a db_session.
+
+    :returns: (usernames, next_offset) where ``next_offset`` is ``None``
+        when there are no more results
+    """
+    terms = re.findall(r"\w+", query, re.UNICODE)
+    if not terms:
+        return [], None
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    # Fetch one extra row to find out whether there is another page
+    if _use_fts:
+        usernames = _fts_search(terms, limit + 1, offset)
+    else:
+        usernames = _prefix_search(query, limit + 1, offset)
+
+    if len(usernames) > limit:
+        return usernames[:limit], offset + limit
+    return usernames, None
+
+
+def _fts_search(terms, limit, offset):
+    match = " ".join(u'"{}"*'.format(term) for term in terms)
+    return list(database.select(
+        'SELECT username FROM "PlayerSearch" '
+        'WHERE "PlayerSearch" MATCH $match '
+        'ORDER BY bm25("PlayerSearch", {}), rowid '
+        'LIMIT $limit OFFSET $offset'.format(
+            ", ".join(str(w) for w in RANK_WEIGHTS)
+        )
+    ))
+
+
+def _prefix_search(query, limit, offset):
+    # A range on the primary key rather than LIKE, so SQLite can use
+    #   the index
+    upper = query + u"\uffff"
+    return select(
+        p.username for p in PlayerEntity
+        if p.username >= query and p.username < upper
+    ).order_by(1)[offset:offset + limit]
@@ -0,0 +1,225 @@
+"""Server-side login sessions
+
+Logging in creates a Session row with a random, opaque ID, which becomes
+the value of the session cookie; logging out or revoking deletes rows.
+APIHandler resolves the cookie once per request, before the handler
+method runs, through a SessionStore: an LRU of resolved sessions kept
+by every server process, so authenticating a request is a dict lookup
+unless the session has not been seen by this process yet.
+
+Revoking a session bumps the ``sessions`` generation (see
+wlsports.generations). A single server process drops revoked sessions
+from its store right away. With several workers, each store checks the
+shared generation at most every ``SessionStore.recheck_interval``
+seconds and starts over when it changed, so revocations reach every
+worker within that time.
+
+Expired sessions are deleted when the server starts, and every
+``PURGE_INTERVAL`` seconds while it runs.
+
+Functions taking or returning entities or touching the database must
+be called inside a db_session.
+"""
+import binascii
+import calendar
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+from pony.orm import select
+
+from wlsports import generations
+from wlsports.db import Session as SessionEntity
+
+
+COOKIE_NAME = "session"
+GENERATION = "sessions"
+
+# ``expires`` is a Unix timestamp, or None for sessions that last until
+#   logout
+ResolvedSession = namedtuple("ResolvedSession", ["username", "expires"])
+
+# Cached for session IDs that don't exist, so that made up cookies don't
+#   cost a query each; apart from real sessions, see SessionStore
+INVALID = ResolvedSession(username=None, expires=None)
+
+# Seconds between purges of expired sessions by a running server
+PURGE_INTERVAL = 3600
+
+
+def create(username, days):
+    """Create a session for ``username`` lasting ``days`` days (or until
+    logout if ``None``)
+
+    :returns: (session ID, ResolvedSession)
+    """
+    now = datetime.utcnow()
+    expires = None if days is None else now + timedelta(days=days)
+    session = SessionEntity(
+        id=binascii.hexlify(os.urandom(24)).decode(),
+        player=username,
+        created=now,
+        expires=expires
+    )
+    return session.id, ResolvedSession(username, _timestamp(expires))
+
+
+def lookup(session_id):
+    """ResolvedSession of ``session_id``; ``INVALID`` if there is no such
+    session or it has expired
+    """
+    session = SessionEntity.get(id=session_id)
+    if session is None:
+        return INVALID
+    resolved = ResolvedSession(session.player.username,
+                               _timestamp(session.expires))
+    return INVALID if is_expired(resolved) else resolved
+
+
+def revoke(session_id):
+    """Delete the session ``session_id``
+
+    :returns: Whether it existed
+    """
+    session = SessionEntity.get(id=session_id)
+    if session is None:
+        return False
+    session.delete()
+    generations.bump(GENERATION)
+    return True
+
+
+def revoke_player(username):
+    """Delete all sessions of ``username``
+
+    :returns: Number of sessions deleted
+    """
+    count = select(s for s in SessionEntity
+                   if s.player.username == username).delete(bulk=True)
+    if count:
+        generations.bump(GENERATION)
+    return count
+
+
+def purge_expired():
+    """Delete expired sessions
+
+    :returns: Number of sessions deleted
+    """
+    now = datetime.utcnow()
+    return select(s for s in SessionEntity
+                  if s.expires is not None and s.expires < now) \
+        .delete(bulk=True)
+
+
+def is_expired(resolved):
+    return resolved.expires is not None and resolved.expires < time.time()
+
+
+class SessionStore(object):
+    """LRU of ResolvedSession by session ID
+
+    Session IDs found to be ``INVALID`` go in a separate, smaller LRU, so
+    that clients sending made up cookies can't push real sessions out.
+    """
+
+    def __init__(self, max_entries=10000, recheck_interval=1.0,
+                 max_invalid=1000):
+        self.max_entries = max_entries
+        self.max_invalid = max_invalid
+        self.recheck_interval = recheck_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._invalid = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id):
+        """Cached ResolvedSession of ``session_id`` (possibly ``INVALID``),
+        or ``None`` if it has to be looked up
+        """
+        with self._lock:
+            entries = self._entries
+            resolved = entries.pop(session_id, None)
+            if resolved is None:
+                entries = self._invalid
+                resolved = entries.pop(session_id, None)
+            if resolved is not None:
+                if is_expired(resolved):
+                    resolved = None
+                else:
+                    # Most recently used entries go last
+                    entries[session_id] = resolved
+            if resolved is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return resolved
+
+    def put(self, session_id, resolved):
+        if resolved.username is None:
+            entries, max_entries = self._invalid, self.max_invalid
+        else:
+            entries, max_entries = self._entries, self.max_entries
+        with self._lock:
+            self._entries.pop(session_id, None)
+            self._invalid.pop(session_id, None)
+            entries[session_id] = resolved
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    def discard(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+            self._invalid.pop(session_id, None)
+
+    def discard_player(self, username):
+        with self._lock:
+            for session_id, resolved in list(self._entries.items()):
+                if resolved.username == username:
+                    del self._entries[session_id]
+
+    def needs_recheck(self):
+        """Whether ``recheck()`` is due; only ever with shared generations
+
+        Returns True once per interval, to whoever asks first.
+        """
+        if not generations.is_shared():
+            return False
+        now = time.time()
+        with self._lock:
+            if now - self._checked < self.recheck_interval:
+                return False
+            self._checked = now
+            return True
+
+    def recheck(self):
+        """Forget all sessions if any were revoked since the last check,
+        possibly by another process; needs a db_session
+        """
+        generation = generations.current(GENERATION)
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._invalid.clear()
+                self._generation = generation
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "invalid_entries": len(self._invalid),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _timestamp(dt):
+    return None if dt is None else calendar.timegm(dt.utctimetuple())
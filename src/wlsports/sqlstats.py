@@ -0,0 +1,102 @@
+"""Per-request SQL statistics
+
+``install()`` wraps the function Pony sends every statement through, so
+that statements run while a QueryStats is active on the current thread
+are counted and timed. APIHandler activates its request's QueryStats
+around every unit of work it hands to the data layer.
+
+Statements are grouped by shape: their SQL with whitespace collapsed and
+``IN`` lists shortened, parameters being placeholders already. The same
+SELECT shape running many times within one request is the signature of
+an N+1 pattern, e.g., a lazy collection load inside a loop.
+"""
+import re
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from pony.orm import flush
+
+
+_local = threading.local()
+
+
+class QueryStats(object):
+    """Number, total time and shapes of the statements of one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, sql, elapsed):
+        shape = _shape(sql)
+        with self._lock:
+            self.count += 1
+            self.time += elapsed
+            self.shapes[shape] += 1
+
+    def wrap(self, fn):
+        """``fn`` with these stats active on whichever thread runs it;
+        ``fn`` must run inside a db_session
+        """
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_local, "stats", None)
+            _local.stats = self
+            try:
+                result = fn(*args, **kwargs)
+                # Send pending changes while still counting, instead of
+                #   when the db_session ends
+                flush()
+                return result
+            finally:
+                _local.stats = previous
+        return wrapper
+
+    def repeated(self, threshold):
+        """[(shape, count), ...] of SELECTs that ran at least
+        ``threshold`` times, most frequent first
+        """
+        if threshold <= 0:
+            return []
+        with self._lock:
+            return [(shape, n) for shape, n in self.shapes.most_common()
+                    if n >= threshold and shape.startswith("SELECT")]
+
+    def max_repeated(self):
+        """Most times any one SELECT shape ran"""
+        with self._lock:
+            return max([n for shape, n in self.shapes.items()
+                        if shape.startswith("SELECT")] or [0])
+
+
+def install(database):
+    """Record statements run through ``database`` in the active
+    QueryStats; call once, before binding
+    """
+    exec_sql = database._exec_sql
+
+    @wraps(exec_sql)
+    def _exec_sql(sql, *args, **kwargs):
+        stats = getattr(_local, "stats", None)
+        if stats is None:
+            return exec_sql(sql, *args, **kwargs)
+        started = time.time()
+        try:
+            return exec_sql(sql, *args, **kwargs)
+        finally:
+            stats.record(sql, time.time() - started)
+
+    database._exec_sql = _exec_sql
+
+
+_IN_LIST = re.compile(r"IN \(\?(?:, \?)*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _shape(sql):
+    sql = _WHITESPACE.sub(" ", sql).strip()
+    return _IN_LIST.sub("IN (...)", sql)
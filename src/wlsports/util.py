@@ -9,7 +9,11 @@ def invert_dict_nonunique(d):
 
 
 def validate_date_text(date_text):
+    parse_date(date_text)
+
+
+def parse_date(date_text):
     try:
-        datetime.datetime.strptime(date_text, '%Y-%m-%d')
+        return datetime.datetime.strptime(date_text, '%Y-%m-%d').date()
     except ValueError:
         raise ValueError("Incorrect data format, should be YYYY-MM-DD")